@@ -4,9 +4,8 @@ import numpy as np
 import pandas as pd
 # Copyright (c) 2008-2012, AQR Capital Management, LLC, Lambda Foundry, Inc. and PyData Development Team
 
-import statsmodels.api as sm
-
 import os
+from contextlib import nullcontext
 
 # Inkluderer funksjoner fra filen "funksjoner.py"
 from funksjoner import *
@@ -14,231 +13,450 @@ from funksjoner import *
 ##############################################
 ## Definer hvilke kostnader som skal analyseres
 ##############################################
-costs_for_response = 'Varekostnader'
+costs_for_response_list = [
+    'Driftskostnader',
+    'Varekostnader',
+]
 
 # Mulige verdier:
 # 'Driftskostnader'
 # 'Varekostnader'
 
-if (costs_for_response != 'Driftskostnader') & (costs_for_response != 'Varekostnader'):
-    raise Exception("Feil: costs_for_response må være 'Driftskostnader' eller 'Varekostnader'")
-
-##############################################
-## Lager data frames for å sette inn resultater
-##############################################
-results_df = pd.DataFrame()
-results_df.index.name = costs_for_response
-
-sample_selection_table = pd.DataFrame()
-
-##############################################
-## Laster data som ble behandlet i 
-## "behandle_data_og_lag_variabler.py"
-##############################################
-data_all = pd.read_csv('../data_behandlet/data_behandlet.csv',sep=';',low_memory=False)
-
-# De aller minste bedriftene har begrenset med kostnader knyttet til ansatte og 
-# varige eiendeler. Vi begrenser derfor vårt utvalg til bedrifter med 
-# lønnskostnader over kroner 5 millioner.
-data_all = data_all[data_all['Lonnskostnader_ikke_deflatert']>5e6].reset_index(drop=True)
-
-# Sjekker at alle observasjoner er unike firma-år
-unique_orgnr = data_all.groupby(['orgnr','regnaar']).size().reset_index()
-temp = unique_orgnr[0].unique()
-if len(temp)!=1:
-    raise Exception("Feil: ikke alle firma-år er unike")
-
-##############################################
-##  Modell 1
-##############################################
-file_name   = '1'
-
-# Antall tidligere regnskapsår som blir brukt i regresjon
-num_prev = 1
-
-# Sample selection
-var_log = [
-    costs_for_response,
-    costs_for_response+'_prev',
-    'Salg',
-    'Salg_prev',
-]
-data,sample_selection_table = sample_selection(data_all,num_prev,var_log,file_name,sample_selection_table,costs_for_response)
-
-# Lager variabler for regresjon
-data['lnCost_'+costs_for_response]  = np.log((data[costs_for_response]/data[costs_for_response+'_prev']).astype(float))
-data['lnSalg']     = np.log((data['Salg']/data['Salg_prev']).astype(float))
-data['DlnSalg']    = (data['lnSalg']<0)*data['lnSalg']
-
-# Definerer hvilke variabler som skal brukes i regresjon
-var = [
-    'lnCost_'+costs_for_response,
-    'lnSalg',
+for costs_for_response in costs_for_response_list:
+    if (costs_for_response != 'Driftskostnader') & (costs_for_response != 'Varekostnader'):
+        raise Exception("Feil: costs_for_response må være 'Driftskostnader' eller 'Varekostnader'")
+
+# Estimeringsmetode i regression_rrw():
+# 'formula': faste effekter som dummyvariabler (statsmodels)
+# 'absorb':  faste effekter absorbert ved demeaning (raskere for store
+#            data, og kreves for faste effekter for foretak og bransje x år,
+#            se ols_absorb() i "funksjoner_estimering.py")
+# Koeffisientene er de samme med begge metodene, bortsett fra konstantleddet,
+# som med 'absorb' er gjennomsnittet av de faste effektene. Antall 
+# observasjoner, R2 og standardfeilene er de samme kun når det ikke finnes
+# singletons (eller fjern_singletons = False) og ingen fast effekt er 
+# nøstet i en klyngeinndeling. Med 'absorb' telles ikke slike faste 
+# effekter med i småutvalgskorreksjonen (som i Statas reghdfe), f.eks. 
+# regnaar med cluster = ['orgnr','regnaar'], og standardfeilene blir da
+# litt mindre enn med 'formula'.
+engine = 'formula'
+
+# Faste effekter i modellene (se fe_navn i "funksjoner.py"): kolonner i
+# data, eller kombinasjoner av kolonner med '*'. Med engine='formula' kan
+# kun 'regnaar' og 'Bransje' brukes. Faste effekter for foretak ('orgnr') og
+# for bransje x år ('Bransje*regnaar') krever engine='absorb'.
+faste_effekter = ['regnaar','Bransje']
+
+# Sett til 'True' for å fjerne observasjoner som er alene i en gruppe for
+# en av de faste effektene (singletons) med engine='absorb', som i Statas
+# reghdfe. Antall observasjoner og R2 kan da avvike fra engine='formula'.
+fjern_singletons = True
+
+# Kolonnen(e) det klynges på for standardfeilene. Bruk ['orgnr','regnaar']
+# for toveis klynging på foretak og regnskapsår.
+cluster = ['orgnr']
+
+# Antall bootstrap-replikasjoner (klyngene i cluster[0] trekkes med 
+# tilbakelegging) og placebo-replikasjoner (responsvariabelen permuteres 
+# innenfor hvert regnskapsår). Resultatene legges til som egne rader for 
+# variablene i resampling_vars (None = alle variablene i modellen).
+# Sett til 0 for å ikke kjøre replikasjonene.
+bootstrap = 0
+placebo = 0
+resampling_seed = 20220814
+resampling_vars = [
     'DlnSalg',
-]
-
-# Gjennomfører regresjon og lagrer resultater i results_df
-results_df = regression_rrw(var,data,results_df,file_name)
-
-
-##############################################
-##  Modell 2
-##############################################
-file_name   = '2'
-
-# Antall tidligere regnskapsår som blir brukt i regresjon
-num_prev = 1
-
-# Sample selection
-var_log = [
-    costs_for_response,
-    costs_for_response+'_prev',
-    'Salg',
-    'Salg_prev',
-    'Eiendeler',
-    'Lonnskostnader',
-]
-data,sample_selection_table = sample_selection(data_all,num_prev,var_log,file_name,sample_selection_table,costs_for_response)
-
-# Lager variabler for regresjon
-data['lnCost_'+costs_for_response]  = np.log((data[costs_for_response]/data[costs_for_response+'_prev']).astype(float))
-data['lnSalg']     = np.log((data['Salg']/data['Salg_prev']).astype(float))
-data['DlnSalg']    = (data['lnSalg']<0)*data['lnSalg']
-
-data['EINT']    = np.log((data['Eiendeler']/data['Salg']).astype(float))
-data['AINT']    = np.log((data['Lonnskostnader']/data['Eiendeler']).astype(float))
-data['BNP']     = (data['bnp']/data['bnp_prev']).astype(float)-1
-
-data['lnSalgEINT'] = data['lnSalg']*data['EINT']
-data['lnSalgAINT'] = data['lnSalg']*data['AINT']
-data['lnSalgBNP']  = data['lnSalg']*data['BNP']
-
-data['DlnSalgEINT'] = data['DlnSalg']*data['EINT']
-data['DlnSalgAINT'] = data['DlnSalg']*data['AINT']
-data['DlnSalgBNP']  = data['DlnSalg']*data['BNP']
-
-
-# Definerer hvilke variabler som skal brukes i regresjon
-var = [
-    'lnCost_'+costs_for_response,
-    'lnSalg',
-    'DlnSalg',
-    'lnSalgEINT',
-    'lnSalgAINT',
-    'lnSalgBNP',
     'DlnSalgEINT',
     'DlnSalgAINT',
     'DlnSalgBNP',
+    'DlnSalgPrev',
+    'I_prev_DlnSalg',
+    'D_prev_DlnSalg',
 ]
-
-# Gjennomfører regresjon og lagrer resultater i results_df
-results_df = regression_rrw(var,data,results_df,file_name)
-
+resampling_workers = 1
+
+# Sett til 'True' for også å estimere modellene per bransje og for 
+# rullerende vinduer med rullerende_vindu regnskapsår. Resultatene lagres
+# i 'Results_grupper_<kostnad>.xlsx' med én rad per gruppe og variabel.
+# Gruppene estimeres med faste_effekter, engine og fjern_singletons som
+# over, men de faste effektene må være konstante innenfor (Bransje, 
+# regnaar)-cellene, så faste effekter for foretak ('orgnr') gir feil.
+gruppeestimering = False
+rullerende_vindu = 5
+
+# Sett til 'True' for også å estimere modellene for delutvalgene i 
+# delutvalg. Alle firma-år (også de med lønnskostnader under 5 millioner)
+# deles i celler etter bransje, regnskapsår, lønnskostnader, SMB og 
+# organisasjonsform, og summene per celle beregnes én gang per modell (se
+# Cellestatistikk i "funksjoner_estimering.py"). Hvert delutvalg er en 
+# union av celler og estimeres fra cellesummene, uten å lese data, lage
+# utvalget eller gå gjennom radene på nytt. Resultatene lagres i 
+# 'Results_delutvalg_<kostnad>.xlsx' med én rad per delutvalg, modell og
+# variabel. Som for gruppeestimering brukes faste_effekter, engine og 
+# fjern_singletons over, og faste effekter for foretak gir feil.
+delutvalg_estimering = False
+
+# Tersklene for lønnskostnader (ikke deflatert) som delutvalgene kan bruke
+# (se terskelklasse() i "funksjoner_panel.py")
+lonnskostnader_terskler = [1e6,2e6,5e6,10e6,20e6]
+
+# Delutvalgene: navn -> funksjon av tabellen med cellene, som gir en boolsk
+# array over cellene. Kolonnene er 'Bransje', 'regnaar', 'orgform', 'SMB'
+# (1 for små og mellomstore bedrifter) og 'Lonnskostnader_over' (den 
+# største terskelen i lonnskostnader_terskler som lønnskostnadene er over).
+delutvalg = {
+    'Lønnskostnader > 5 mill.':      lambda c: c['Lonnskostnader_over']>=5e6,
+    'Lønnskostnader > 2 mill.':      lambda c: c['Lonnskostnader_over']>=2e6,
+    'Lønnskostnader > 10 mill.':     lambda c: c['Lonnskostnader_over']>=10e6,
+    'SMB, lønnskostnader > 5 mill.': lambda c: (c['Lonnskostnader_over']>=5e6) & (c['SMB']==1),
+    'AS, lønnskostnader > 5 mill.':  lambda c: (c['Lonnskostnader_over']>=5e6) & (c['orgform']=='AS'),
+}
+
+# Sett til 'False' for å beregne standardfeilene for delutvalgene uten 
+# klynging fra cellesummene alene. Med 'True' klynges det på cluster, som
+# krever én gjennomgang av radene i hvert delutvalg.
+delutvalg_klyngerobust = True
+
+# Profilering av hvert steg: None, 'cprofile' eller 'pyinstrument'. Tid og
+# minnebruk per steg lagres uansett i 'resultater/maaling_analysere.json' (og .csv).
+profiler = None
+maaling.profiler = profiler
+
+# Maksimal størrelse på mellomlageret for utvalg, variabler og
+# designmatriser som deles mellom modellene (se Mellomlager i "funksjoner.py")
+mellomlager_max_bytes = 2*1024**3
+
+# Mappe for modellageret: resultatene for hver modell lagres på disk, og 
+# modeller som ikke er endret (samme data, utvalg, variabler og 
+# spesifikasjon) hentes derfra ved neste kjøring i stedet for å estimeres 
+# på nytt (se Modellager i "funksjoner.py"). Filene som er brukt minst 
+# nylig slettes når mappen blir større enn modellager_max_bytes. 
+# Sett til None for å estimere alle modellene på nytt.
+modellager_folder = '../modellager'
+modellager_max_bytes = 512*1024**2
+
+# Antall regresjoner som kjøres samtidig, og om det brukes prosesser
+# ('process') eller tråder ('thread')
+num_workers = 1
+parallel_backend = 'process'
+
+# Formatene resultattabellene lagres i: 'xlsx', 'csv' (semikolon som 
+# skilletegn), 'parquet' og/eller 'tex' (LaTeX-tabell)
+resultatformater = ['xlsx']
 
 ##############################################
-##  Modell 3
+## Laster data som ble behandlet i
+## "behandle_data_og_lag_variabler.py"
 ##############################################
-file_name   = '3'
-
-# Antall tidligere regnskapsår som blir brukt i regresjon
-num_prev = 2
-
-# Sample selection
-var_log = [
-    costs_for_response,
-    costs_for_response+'_prev',
+# Sett til 'csv' for å lese "data_behandlet.csv" i stedet for
+# den partisjonerte Parquet-lagringen
+data_format = 'parquet'
+
+# Kolonner som benyttes i modellene under
+columns_needed = [
+    'orgnr',
+    'regnaar',
+    'Bransje',
     'Salg',
     'Salg_prev',
     'Salg_prev_prev',
+    'Eiendeler',
+    'Lonnskostnader',
+    'bnp',
+    'bnp_prev',
+    'Lonnskostnader_ikke_deflatert',
 ]
-data,sample_selection_table = sample_selection(data_all,num_prev,var_log,file_name,sample_selection_table,costs_for_response)
-
-# Lager variabler for regresjon
-data['lnCost_'+costs_for_response]  = np.log((data[costs_for_response]/data[costs_for_response+'_prev']).astype(float))
-data['lnSalg']     = np.log((data['Salg']/data['Salg_prev']).astype(float))
-data['DlnSalg']    = (data['lnSalg']<0)*data['lnSalg']
-data['lnSalgPrev']     = np.log((data['Salg_prev']/data['Salg_prev_prev']).astype(float))
-data['DlnSalgPrev']    = (data['lnSalgPrev']<0)*data['lnSalg']
-
+for costs_for_response in costs_for_response_list:
+    columns_needed += [costs_for_response,costs_for_response+'_prev']
+if delutvalg_estimering:
+    columns_needed += ['orgform']
+with maaling.steg('Lesing av data') as steg:
+    data_all = les_data_behandlet('../data_behandlet',columns=columns_needed,data_format=data_format)
+    steg['rader'] = data_all.shape[0]
+
+# De aller minste bedriftene har begrenset med kostnader knyttet til ansatte og
+# varige eiendeler. Vi begrenser derfor vårt utvalg til bedrifter med
+# lønnskostnader over kroner 5 millioner.
+rader_utvalg = np.flatnonzero(data_all['Lonnskostnader_ikke_deflatert'].to_numpy()>5e6)
 
-# Definerer hvilke variabler som skal brukes i regresjon
-var = [
-    'lnCost_'+costs_for_response,
-    'lnSalg',
-    'DlnSalg',
-    'lnSalgPrev',
-    'DlnSalgPrev',
-]
+# Indeks over alle firma-år (også de som ikke er med i utvalget), slik at
+# variabler fra et vilkårlig antall år tilbake i tid kan brukes i modellene
+# uten å kjøre "behandle_data_og_lag_variabler.py" på nytt (se Panel i
+# "funksjoner_panel.py"). Kolonnene som trengs leses når de brukes.
+panel_alle = Panel(data_all[['orgnr','regnaar']],
+    les=lambda columns: les_data_behandlet('../data_behandlet',columns=columns,data_format=data_format),
+    kolonner=kolonner_behandlet('../data_behandlet',data_format),
+    )
+panel = panel_alle.med_rader(rader_utvalg)
 
-# Gjennomfører regresjon og lagrer resultater i results_df
-results_df = regression_rrw(var,data,results_df,file_name)
+# Alle firma-år beholdes for delutvalgene (se delutvalg)
+data_behandlet = data_all if delutvalg_estimering else None
+data_all = data_all.iloc[rader_utvalg].reset_index(drop=True)
 
+# Sjekker at alle observasjoner er unike firma-år (se "funksjoner_validering.py")
+validering.valider('Data',sjekk_unike(data_all),data_all.shape[0])
 
 ##############################################
-##  Modell 4
+## Variabler for regresjon
 ##############################################
-file_name   = '4'
-
-# Antall tidligere regnskapsår som blir brukt i regresjon
-num_prev = 2
-
-# Sample selection
-var_log = [
-    costs_for_response,
-    costs_for_response+'_prev',
-    'Salg',
-    'Salg_prev',
-    'Salg_prev_prev',
-]
-data,sample_selection_table = sample_selection(data_all,num_prev,var_log,file_name,sample_selection_table,costs_for_response)
-
-# Lager variabler for regresjon
-data['lnCost_'+costs_for_response]  = np.log((data[costs_for_response]/data[costs_for_response+'_prev']).astype(float))
-
-data['lnSalg']     = np.log((data['Salg']/data['Salg_prev']).astype(float))
-data['DlnSalg']    = (data['lnSalg']<0)*data['lnSalg']
-
-data['lnSalgPrev'] = np.log((data['Salg_prev']/data['Salg_prev_prev']).astype(float))
-data['I_prev']      = (data['lnSalgPrev']>0)
-data['D_prev']      = (data['lnSalgPrev']<0)
-
-data['I_prev_lnSalg']    = data['I_prev']*data['lnSalg']
-data['I_prev_DlnSalg']    = data['I_prev']*data['DlnSalg']
-
-data['D_prev_lnSalg']    = data['D_prev']*data['lnSalg']
-data['D_prev_DlnSalg']    = data['D_prev']*data['DlnSalg']
-
-# Definerer hvilke variabler som skal brukes i regresjon
-var = [
-    'lnCost_'+costs_for_response,
-    'I_prev_lnSalg',
-    'I_prev_DlnSalg',
-    'D_prev_lnSalg',
-    'D_prev_DlnSalg',
-]
-
-# Gjennomfører regresjon og lagrer resultater i results_df
-results_df = regression_rrw(var,data,results_df,file_name)
+# Hver variabel er en funksjon av k, der k('navn') gir kolonnen 'navn' i
+# data_all, en variabel fra tidligere år ('navn_prev', 'navn_prev_prev',
+# 'navn_prev_prev_prev' osv., se Panel) eller en annen variabel definert
+# her. Variablene beregnes én gang for alle rader, når de brukes første
+# gang, og gjenbrukes i alle modellene. Se "funksjoner_panel.py" for vekst(),
+# nedgang(), oppgang(), ved_nedgang() og produkt().
+variabeldefinisjoner = {
+    'lnSalg':      vekst('Salg'),
+    'DlnSalg':     ved_nedgang('lnSalg'),
+
+    'EINT':        log_forhold('Eiendeler','Salg'),
+    'AINT':        log_forhold('Lonnskostnader','Eiendeler'),
+    'BNP':         lambda k: k('bnp')/k('bnp_prev')-1,
+
+    'lnSalgEINT':  produkt('lnSalg','EINT'),
+    'lnSalgAINT':  produkt('lnSalg','AINT'),
+    'lnSalgBNP':   produkt('lnSalg','BNP'),
+
+    'DlnSalgEINT': produkt('DlnSalg','EINT'),
+    'DlnSalgAINT': produkt('DlnSalg','AINT'),
+    'DlnSalgBNP':  produkt('DlnSalg','BNP'),
+
+    'lnSalgPrev':  vekst('Salg',1),
+    'DlnSalgPrev': ved_nedgang('lnSalgPrev','lnSalg'),
+
+    'I_prev':      oppgang('lnSalgPrev'),
+    'D_prev':      nedgang('lnSalgPrev'),
+
+    'I_prev_lnSalg':  produkt('I_prev','lnSalg'),
+    'I_prev_DlnSalg': produkt('I_prev','DlnSalg'),
+
+    'D_prev_lnSalg':  produkt('D_prev','lnSalg'),
+    'D_prev_DlnSalg': produkt('D_prev','DlnSalg'),
+}
+for costs_for_response in costs_for_response_list:
+    variabeldefinisjoner['lnCost_'+costs_for_response] = vekst(costs_for_response)
+
+# Cellene for delutvalgene. SMB er små og mellomstore bedrifter
+# (https://ec.europa.eu/growth/smes/sme-definition_en), som i det 
+# utkommenterte filteret i "behandle_data_og_lag_variabler.py".
+variabeldefinisjoner['SMB'] = lambda k: ((k('sum_eiendeler_EUR')<=43e6)|(k('sum_omsetning_EUR')<=50e6)) &\
+    (k('sum_eiendeler_EUR')>2e6) & (k('sum_omsetning_EUR')>2e6)
+variabeldefinisjoner['Lonnskostnader_over'] = terskel('Lonnskostnader_ikke_deflatert',lonnskostnader_terskler)
 
 ##############################################
-## Omorganiserer resultattabellen
+##  Modeller
 ##############################################
-results_df = shift_row_to_bottom('Konstant',results_df)
-results_df = shift_row_to_bottom('År FE',results_df)
-results_df = shift_row_to_bottom('Bransje FE',results_df)
-results_df = shift_row_to_bottom('R2',results_df)
-results_df = shift_row_to_bottom('Antall observasjoner',results_df)
+# Hver modell angir:
+#   file_name: navnet på modellen i tabellene, 'Modell (file_name)'
+#   num_prev:  antall tidligere regnskapsår som blir brukt i regresjon
+#   var_log:   variabler som må være positive (sample selection)
+#   var:       variabler som skal brukes i regresjon (responsvariabelen først)
+# '{cost}' erstattes med kostnaden som analyseres (costs_for_response).
+modeller = [
+    {
+        'file_name': '1',
+        'num_prev': 1,
+        'var_log': [
+            '{cost}',
+            '{cost}_prev',
+            'Salg',
+            'Salg_prev',
+        ],
+        'var': [
+            'lnCost_{cost}',
+            'lnSalg',
+            'DlnSalg',
+        ],
+    },
+    {
+        'file_name': '2',
+        'num_prev': 1,
+        'var_log': [
+            '{cost}',
+            '{cost}_prev',
+            'Salg',
+            'Salg_prev',
+            'Eiendeler',
+            'Lonnskostnader',
+        ],
+        'var': [
+            'lnCost_{cost}',
+            'lnSalg',
+            'DlnSalg',
+            'lnSalgEINT',
+            'lnSalgAINT',
+            'lnSalgBNP',
+            'DlnSalgEINT',
+            'DlnSalgAINT',
+            'DlnSalgBNP',
+        ],
+    },
+    {
+        'file_name': '3',
+        'num_prev': 2,
+        'var_log': [
+            '{cost}',
+            '{cost}_prev',
+            'Salg',
+            'Salg_prev',
+            'Salg_prev_prev',
+        ],
+        'var': [
+            'lnCost_{cost}',
+            'lnSalg',
+            'DlnSalg',
+            'lnSalgPrev',
+            'DlnSalgPrev',
+        ],
+    },
+    {
+        'file_name': '4',
+        'num_prev': 2,
+        'var_log': [
+            '{cost}',
+            '{cost}_prev',
+            'Salg',
+            'Salg_prev',
+            'Salg_prev_prev',
+        ],
+        'var': [
+            'lnCost_{cost}',
+            'I_prev_lnSalg',
+            'I_prev_DlnSalg',
+            'D_prev_lnSalg',
+            'D_prev_DlnSalg',
+        ],
+    },
+]
 
-string_for_save = '_'+costs_for_response
-results_df.index.name = string_for_save
+# Spesifikasjoner som alle modellene estimeres med (argumenter til
+# estimer_modell()). Resultatene for spesifikasjonen '' lagres i
+# 'Results_<kostnad>.xlsx', de andre i 'Results_<kostnad>_<navn>.xlsx'.
+# For eksempel: 'toveis': {'engine': engine, 'cluster': ['orgnr','regnaar']}
+# eller 'foretak': {'engine': 'absorb', 'cluster': cluster,
+#                   'fixed_effects': ['orgnr','Bransje*regnaar']}
+spesifikasjoner = {
+    '': {
+        'engine': engine,
+        'cluster': cluster,
+        'fixed_effects': faste_effekter,
+        'fjern_singletons': fjern_singletons,
+        'bootstrap': bootstrap,
+        'placebo': placebo,
+        'seed': resampling_seed,
+        'resampling_vars': resampling_vars,
+        'resampling_workers': resampling_workers,
+    },
+}
 
 ##############################################
-##  Lagrer resultater i mappen 'resutater'
+##  Gjennomfører regresjonene og lagrer 
+##  resultatene i mappen 'resultater'
 ##############################################
 folder_name = 'resultater/'
 if not os.path.exists(folder_name):
     os.makedirs(folder_name)
 
-results_df.to_excel(folder_name+'Results'+string_for_save+'.xlsx')
-sample_selection_table.to_excel(folder_name+'Sample_selection'+string_for_save+'.xlsx')
-
+def lagre_resultater(costs_for_response,spec_name,results_df,sample_selection_table):
+    string_for_save = '_'+costs_for_response
+    if spec_name != '':
+        string_for_save = string_for_save+'_'+spec_name
+    results_df.index.name = string_for_save
+
+    lagre_tabell(results_df,folder_name+'Results'+string_for_save,resultatformater,skriver,erstatt=True)
+    lagre_tabell(sample_selection_table,folder_name+'Sample_selection'+string_for_save,resultatformater,skriver,erstatt=True)
+
+modellager = None
+if modellager_folder is not None:
+    modellager = Modellager(modellager_folder,dataversjon('../data_behandlet',data_format),modellager_max_bytes)
+mellomlager = Mellomlager(data_all,variabeldefinisjoner,mellomlager_max_bytes,modellager,panel)
+
+# statsmodels og scipy importeres først når de brukes (se "funksjoner.py").
+# Importen måles her som et eget steg, før prosessene for regresjonene 
+# startes, slik at den ikke regnes med i tiden for den første regresjonen.
+with maaling.steg('Import av statsmodels og scipy'):
+    import statsmodels.formula.api
+    import scipy.stats
+
+# Utvalg og variabler beregnes før prosessene for regresjonene startes, og
+# prosessene startes før skriveren (se start_executor() i
+# "funksjoner_behandling.py")
+jobber = forbered_modeller(modeller,costs_for_response_list,spesifikasjoner,mellomlager)
+executor = start_executor(num_workers,parallel_backend) if num_workers > 1 else None
+
+# Tabellene skrives i bakgrunnen (se Skriver i "funksjoner_behandling.py")
+# hver gang en modell er ferdig, slik at resultatene for ferdige modeller
+# ligger i filene mens de andre modellene estimeres. Tabellene som er 
+# ferdige skrives også om en senere modell feiler.
+skriver = Skriver()
+try:
+    with (executor if executor is not None else nullcontext()):
+        resultater = kjor_modeller(jobber,executor,ved_modell=lagre_resultater)
+
+    ##############################################
+    ##  Estimering per bransje og for rullerende vinduer
+    ##############################################
+    if gruppeestimering:
+        grupper = lambda celler: {
+            **grupper_per_verdi(celler,'Bransje'),
+            **rullerende_vinduer(celler,'regnaar',rullerende_vindu),
+        }
+        for costs_for_response in costs_for_response_list:
+            tabell = []
+            for modell in modeller:
+                data,temp_table = mellomlager.sample_selection(modell['num_prev'],
+                    fyll_inn_kostnad(modell['var_log'],costs_for_response),
+                    modell['file_name'],pd.DataFrame(),costs_for_response)
+                with maaling.steg('Gruppeestimering (Modell {}) {}'.format(modell['file_name'],costs_for_response),data.shape[0]):
+                    tabell_modell = estimer_grupper(fyll_inn_kostnad(modell['var'],costs_for_response),data,grupper,
+                        cluster=cluster,
+                        mellomlager=mellomlager,
+                        fe_columns=faste_effekter,
+                        engine=engine,
+                        fjern_singletons=fjern_singletons,
+                        )
+                tabell_modell.insert(0,'Modell',modell['file_name'])
+                tabell.append(tabell_modell)
+            skriver.skriv(folder_name+'Results_grupper_'+costs_for_response+'.xlsx',
+                lambda file_path,tabell: tabell.to_excel(file_path,index=False),pd.concat(tabell,ignore_index=True))
+
+    ##############################################
+    ##  Estimering for delutvalg fra summer per celle
+    ##############################################
+    if delutvalg_estimering:
+        # Utvalg og variabler for alle firma-år, uten filteret på lønnskostnader
+        mellomlager_delutvalg = Mellomlager(data_behandlet,variabeldefinisjoner,mellomlager_max_bytes,panel=panel_alle)
+        grupper = lambda celler: {name: np.asarray(fun(celler),dtype=bool) for name,fun in delutvalg.items()}
+        for costs_for_response in costs_for_response_list:
+            tabell = []
+            for modell in modeller:
+                data,temp_table = mellomlager_delutvalg.sample_selection(modell['num_prev'],
+                    fyll_inn_kostnad(modell['var_log'],costs_for_response),
+                    modell['file_name'],pd.DataFrame(),costs_for_response)
+                with maaling.steg('Delutvalg (Modell {}) {}'.format(modell['file_name'],costs_for_response),data.shape[0]):
+                    tabell_modell = estimer_grupper(fyll_inn_kostnad(modell['var'],costs_for_response),data,grupper,
+                        cluster=cluster,
+                        mellomlager=mellomlager_delutvalg,
+                        cell_columns=['Bransje','regnaar','Lonnskostnader_over','SMB','orgform'],
+                        fe_columns=faste_effekter,
+                        klyngerobust=delutvalg_klyngerobust,
+                        engine=engine,
+                        fjern_singletons=fjern_singletons,
+                        )
+                tabell_modell = tabell_modell.rename(columns={'Gruppe': 'Delutvalg'})
+                tabell_modell.insert(1,'Modell',modell['file_name'])
+                tabell.append(tabell_modell)
+            skriver.skriv(folder_name+'Results_delutvalg_'+costs_for_response+'.xlsx',
+                lambda file_path,tabell: tabell.to_excel(file_path,index=False),pd.concat(tabell,ignore_index=True))
+finally:
+    with maaling.steg('Venter på skriving av resultater'):
+        skriver.lukk()
+
+# Tid og minnebruk per steg, og resultatene av sjekkene
+maaling.lagre(folder_name,'analysere')
+validering.lagre(folder_name,'analysere')
+
+print('Mellomlager: {} treff, {} beregnet, {:,.0f} MB'.format(mellomlager.hits,mellomlager.misses,mellomlager.bytes/1024**2))
+if modellager is not None:
+    antall_modeller,bytes_modellager = modellager.storrelse()
+    print('Modellager: {} modeller, {:,.0f} MB'.format(antall_modeller,bytes_modellager/1024**2))
@@ -4,111 +4,68 @@ import numpy as np
 import pandas as pd
 # Copyright (c) 2008-2012, AQR Capital Management, LLC, Lambda Foundry, Inc. and PyData Development Team
 
-import time
 import os
+from contextlib import nullcontext
 
-from tqdm import tqdm # Showing progress bar in for-loops
+# Inkluderer funksjoner fra filen "funksjoner_behandling.py"
+from funksjoner_behandling import *
 
-##################################################################
-##  Load data
-##################################################################
-print('-----------------------------------------')
-print('Loading data:')
-print('-----------------------------------------')
-folder_name = '../../datasett_aarsregnskaper/data4/'
-files = os.listdir(folder_name)
-for current_file in files:
-    file_year = int(current_file[0:4])
+# Siste regnskapsår som tas med i analysene
+regnaar_max = 2021
 
-    # LOADING DATA
-    data_loaded = pd.read_csv(folder_name+current_file,sep=';',low_memory=False)
+# Sett til 'True' for å lagre regnskapstallene som float32 i stedet for
+# float64. Dette halverer minnebruken, men resultatene blir ikke identiske.
+amounts_float32 = False
 
-    # Adding all data together into data
-    if current_file == files[0]:
-        data = data_loaded.copy()
-    else:
-        data = pd.concat([data,data_loaded])
-    print('Imported for accounting year {}'.format(file_year))
+# Antall årsfiler som leses og behandles samtidig. Med 1 blir filene
+# behandlet etter hverandre. Resultatet er det samme uansett antall.
+num_workers = 1
 
-# Reset index 
-data = data.reset_index(drop=True)
+# 'process' (prosesser) eller 'thread' (tråder)
+parallel_backend = 'process'
 
-# Free memory
-del data_loaded
+# Sett til 'True' for også å lagre data_behandlet som CSV (i tillegg til Parquet)
+lagre_csv = True
 
-# Considering only financial year <= 2021
-data = data[data.regnaar<=2021]
-data = data.reset_index(drop=True) # Reset index
+# Komprimering av Parquet-filene ('snappy', 'zstd', 'gzip' eller None) og av
+# CSV-filen (None, 'gzip', 'bz2', 'xz' eller 'zstd', som gir filendelsen 
+# '.gz', '.bz2', osv.). Filene skrives i bakgrunnen mens data behandles.
+komprimering_parquet = 'snappy'
+komprimering_csv = None
 
-##################################################################
-##  Lager variabler
-##################################################################
-# Argumentasjon for .fillna(0):
-# "There are no missing values for the financial information in Appendix A. If a value is missing in 
-# the dataset for any of the items listed in Appendix A, it indicates that no value was provided when 
-# the financial statement was reported, that is, the value is zero."
-# Wahlstrøm, R. R. (2022). Financial statements of companies in Norway. arXiv:2203.12842. https://doi.org/10.48550/arXiv.2203.12842
-
-# Salg
-data['Salg']   = data['Salgsinntekt'].fillna(0)
+# Sett til 'True' for kun å behandle regnskapsårene som er berørt av nye 
+# eller endrede årsfiler siden forrige kjøring (se manifest.json i mappen 
+# data_behandlet). Kjør med 'False' dersom koden i behandlingen er endret.
+inkrementell = False
 
-# Driftskostnader
-data['Driftskostnader'] = data['Sum inntekter'].fillna(0)-data['Driftsresultat'].fillna(0)
+# Sett til 'True' for å behandle data uten å holde alle regnskapsår i
+# minnet samtidig (for data som er større enn minnet). Årsfilene behandles
+# én og én, og regnskapsårene deretter ett og ett (se behandle_out_of_core() 
+# i "funksjoner_behandling.py"). Resultatet er det samme. Brukes ikke ved 
+# inkrementell behandling.
+out_of_core = False
 
-# Varekostnader
-data['Varekostnader']  =\
-    data['Varekostnad'].fillna(0)+\
-    data['Endring i beholdning av varer under tilvirkning og ferdig tilvirkede varer'].fillna(0)
+# Profilering av hvert steg: None, 'cprofile' eller 'pyinstrument'. Tid og
+# minnebruk per steg lagres uansett i 'resultater/maaling_behandle.json' (og .csv).
+profiler = None
+maaling.profiler = profiler
 
-# Eiendeler
-data['Eiendeler']   = data['SUM EIENDELER'].fillna(0)
-
-# Lønnskostnader
-data['Lonnskostnader'] = data['Loennskostnad'].fillna(0)
-
-# Bruttonasjonalprodukt (BNP) 
-# Vi benytter deflatert BNP hentet fra tabell 09189 fra SSB: https://www.ssb.no/en/statbank/table/09189
-bnp_data    = pd.read_csv('../data_BNP_KPI/GDP.csv',sep=';')
-bnp_data.columns = bnp_data.columns.astype(int)
-bnp_data = bnp_data.T[0]
-
-# Bransje
-data = data.rename(columns={
-    'naeringskoder_level_1': 'Bransje',
-    })
-
-# Varelager
-inventories = data['Varer']
-ind = pd.isnull(inventories)
-inventories.loc[ind] = data['Sum varer'].loc[ind]
-data['Varelager']         = inventories.fillna(0) + data['Biologiske eiendeler'].fillna(0)
-
-# Kundefordringer
-kundefordringer = data['Sum fordringer']
-ind = pd.isnull(kundefordringer)
-kundefordringer.loc[ind] = data['Kundefordringer'].loc[ind]
-data['Kundefordringer'] = kundefordringer.fillna(0)
-
-# Leverandørgjeld
-data['Leverandorgjeld']        = data['Leverandoergjeld'].fillna(0)
-
-# Omsetning og eiendeler i EUR
-data['sum_eiendeler_EUR'] = data['sum_eiendeler_EUR'].fillna(0)
-data['sum_omsetning_EUR'] = data['sum_omsetning_EUR'].fillna(0)
+# Første regnskapsår som analyseres (se 'Filtering data' under)
+regnaar_min = 2008
 
-##################################################################
-##  Filtering  data
-##################################################################
-# Våre modeller bruker variabler som er utledet med verdier for opptil de to 
-# foregående regnskapsårene. Dermed utfører vi analysene våre på 
-# årsregnskaper fra og med 2008, mens årsregnskapene fra 2006 og 2007 
-# kun brukes til å utlede variabelverdier.
-
-ind = data['regnaar']>=2008
-
-# For å analysere kun små og mellomstore bedrifter (SMB) (https://ec.europa.eu/growth/smes/sme-definition_en)
-# ind = ind & ((data['sum_eiendeler_EUR'].fillna(0)<=43e6)|(data['sum_omsetning_EUR'].fillna(0)<=50e6))
-# ind = ind & ((data['sum_eiendeler_EUR'].fillna(0)>2e6)&(data['sum_omsetning_EUR'].fillna(0)>2e6))
+# Regnskapstall fra ett og to år tilbake i tid for samme foretak ('orgnr')
+columns_lags = {
+    1: [
+        'Salg',
+        'Driftskostnader',
+        'Varekostnader',
+        'Varelager',
+    ],
+    2: [
+        'Salg',
+    ],
+}
+max_lag = max(columns_lags.keys())
 
 ##################################################################
 ##  CPI: Consumer Price Index (konsumprisindeksen)
@@ -116,90 +73,21 @@ ind = data['regnaar']>=2008
 # For å kontrollere for inflasjon deflaterer vi alle regnskapstall 
 # basert på konsumprisindeksen fra Statistisk sentralbyrå (SSB).
 # Se tabell 03013 fra SSB: https://www.ssb.no/en/statbank/table/03013
-
-CPI_data = pd.read_csv('../data_BNP_KPI/03013_20220814-033754.csv',
-    sep=';',
-    skiprows=2
-    )
-CPI_data.index.name = None
-del CPI_data['consumption group']
-CPI_data.rename(columns = {'Consumer Price Index (2015=100)':'CPI'}, inplace = True)
-
-def fun_CPI(x):
-    return x.replace('M','')
-CPI_data['month'] = CPI_data['month'].apply(fun_CPI).astype(int)
-CPI_data = CPI_data.set_index('month')
-CPI_data.index.name = None
-CPI_data = CPI_data['CPI']
-
-# Avslutningsdato = Balansedato og sluttdato for regnskapets regnskapsår
-data_avslutningsdato    = data['avslutningsdato']
-def fun_avslutningsdato(x):
-    return x[0:7].replace('-','')
-data_avslutningsdato = data_avslutningsdato.apply(fun_avslutningsdato).astype(int)
-
-data['Salg_ikke_deflatert']           = data['Salg']
-data['Lonnskostnader_ikke_deflatert'] = data['Lonnskostnader']
-data['Eiendeler_ikke_deflatert']      = data['Eiendeler']
-columns_to_deflate = [
-    'Salg',
-    'Driftskostnader',
-    'Varekostnader',
-    'Eiendeler',
-    'Lonnskostnader',
-    'Leverandorgjeld',
-    'Varelager',
-    'Kundefordringer',
-]
-data = data.reset_index(drop=True)
-CPIs = CPI_data.loc[data_avslutningsdato].values
-for c in columns_to_deflate:
-    data[c] = data[c] / CPIs
+CPI_data = read_KPI('../data_BNP_KPI/03013_20220814-033754.csv')
 
 ##################################################################
-##  Lager variabler basert på tidligere regnskapsår
+##  BNP: Bruttonasjonalprodukt
 ##################################################################
-data['bnp']                     = None
-data['bnp_prev']                = None
-
-data_for_saving_variables = pd.DataFrame(index=data.index)
-data_for_saving_variables['Salg_prev']              = None
-data_for_saving_variables['Salg_prev_prev']         = None
-data_for_saving_variables['Driftskostnader_prev']    = None
-data_for_saving_variables['Varekostnader_prev']      = None
-data_for_saving_variables['Varelager_prev']        = None
-
-for regnaar in tqdm(data.loc[ind, 'regnaar'].unique()):
-    
-    # Inkluderer kun gjeldende og to foregående regnskapsår
-    curr_data = data[ind & (data['regnaar'] == regnaar)]
-    prev_data = data[data['regnaar'] == regnaar - 1]
-    prev_prev_data = data[data['regnaar'] == regnaar - 2]
-    
-    # Slå sammen data på 'orgnr' for å få regnskapstall fra 
-    # ett og to år tilbake i tid
-    columns_prev = [
-        'Salg',
-        'Driftskostnader',
-        'Varekostnader',
-        'Varelager',
-    ]
-    columns_prev_prev = [
-        'Salg',
-    ]
-    merged_data = curr_data.merge(prev_data[['orgnr']+columns_prev], on='orgnr', how='left', suffixes=('', '_prev'))
-    merged_data = merged_data.merge(prev_prev_data[['orgnr']+columns_prev_prev], on='orgnr',how='left', suffixes=('', '_prev_prev'))
-    merged_data.index = curr_data.index
-
-    for c in columns_prev:
-        data_for_saving_variables.loc[merged_data.index,c+'_prev'] = merged_data[c+'_prev']
-    for c in columns_prev_prev:
-        data_for_saving_variables.loc[merged_data.index,c+'_prev_prev'] = merged_data[c+'_prev_prev']
-
-    data.loc[curr_data.index,'bnp']       = bnp_data.loc[regnaar]
-    data.loc[curr_data.index,'bnp_prev']  = bnp_data.loc[regnaar - 1]
+# Vi benytter deflatert BNP hentet fra tabell 09189 fra SSB: https://www.ssb.no/en/statbank/table/09189
+bnp_data = read_BNP('../data_BNP_KPI/GDP.csv')
 
-data = pd.concat([data,data_for_saving_variables],axis=1)
+# Makroserier fra SSB som kobles på hver rad: kolonnenavn -> (serie, 
+# nøkkelkolonne, forskyvning i nøkkelen). Flere serier, f.eks. 
+# bransjedeflatorer med nøkkel ['Bransje','regnaar'], kan legges til her.
+makroserier = {
+    'bnp':      (bnp_data,'regnaar',0),
+    'bnp_prev': (bnp_data,'regnaar',-1),
+}
 
 # Definerer hvilke kolonner som skal beholdes
 columns_to_keep = [
@@ -228,11 +116,169 @@ columns_to_keep = [
     'sum_eiendeler_EUR',
     'sum_omsetning_EUR',
 ]
-data = data.loc[ind,columns_to_keep].reset_index(drop=True)
-
-# Lagrer prossesert data fo videre analyser i filen "analysere.py"
-folder_name = '../data_behandlet'
-if not os.path.exists(folder_name):
-    os.makedirs(folder_name)
-data.to_csv(folder_name+'/data_behandlet.csv',index=False,sep=';')
 
+##################################################################
+##  Load data og lager variabler
+##################################################################
+print('-----------------------------------------')
+print('Loading data:')
+print('-----------------------------------------')
+# Leser kun kolonnene som benyttes, med datatyper satt ved innlesing,
+# og tar kun med regnskapsår <= regnaar_max. Variablene (Salg, 
+# Driftskostnader, Varekostnader, Varelager, Kundefordringer, osv.) 
+# blir laget og deflatert for hver årsfil i funksjonene lag_variabler() 
+# og deflater() i "funksjoner_behandling.py".
+folder_name = '../../datasett_aarsregnskaper/data4/'
+folder_name_behandlet = '../data_behandlet'
+parquet_folder = folder_name_behandlet+'/data_behandlet_parquet'
+csv_path = csv_behandlet_path(folder_name_behandlet,komprimering_csv)
+manifest_path = folder_name_behandlet+'/manifest.json'
+
+# Sammenligner årsfilene med manifestet fra forrige kjøring. Inkrementell 
+# behandling krever at innstillingene er de samme som sist.
+innstillinger = {
+    'regnaar_min': regnaar_min,
+    'regnaar_max': regnaar_max,
+    'amounts_float32': amounts_float32,
+    'columns_lags': {str(k): v for k,v in columns_lags.items()},
+}
+manifest = les_manifest(manifest_path)
+files_changed,files_deleted,files_info = sammenlign_med_manifest(folder_name,manifest,hash_filer=inkrementell)
+run_incremental = inkrementell & (manifest is not None) & os.path.exists(parquet_folder)
+run_incremental = run_incremental and (manifest['innstillinger']==innstillinger)
+ingen_endringer = run_incremental and (len(files_changed)+len(files_deleted) == 0)
+
+if ingen_endringer:
+    print('Ingen nye eller endrede årsfiler siden forrige kjøring')
+    regnaar_per_fil = {}
+elif run_incremental:
+    # Leser de nye og endrede filene, og finner hvilke regnskapsår som 
+    # må behandles på nytt: de endrede årene og de max_lag påfølgende 
+    # årene (som har variabler fra tidligere regnskapsår)
+    with maaling.steg('Lasting') as steg:
+        data = load_aarsregnskaper(folder_name,regnaar_max,amounts_float32,
+            CPI_data=CPI_data,
+            num_workers=num_workers,
+            parallel_backend=parallel_backend,
+            files=files_changed,
+            )
+        steg['rader'] = data.shape[0]
+    regnaar_per_fil = data.attrs.get('regnaar_per_fil',{})
+    regnaar_changed = set()
+    for f in files_changed:
+        regnaar_changed.update(regnaar_per_fil[f])
+    for f in files_changed+files_deleted:
+        if f in manifest['files']:
+            regnaar_changed.update(manifest['files'][f]['regnaar'])
+    regnaar_to_process = [r for r in berorte_regnaar(regnaar_changed,max_lag) if regnaar_min<=r<=regnaar_max]
+    regnaar_needed = {r-k for r in regnaar_to_process for k in range(max_lag+1)}
+    print('Behandler regnskapsårene {} på nytt'.format(regnaar_to_process))
+
+    # Leser i tillegg uendrede filer med regnskapsår som trengs for å lage
+    # variablene fra tidligere regnskapsår
+    files_other = [f for f in files_info if (f not in files_changed) and (len(regnaar_needed & set(files_info[f]['regnaar']))>0)]
+    with maaling.steg('Lasting') as steg:
+        data_other = load_aarsregnskaper(folder_name,regnaar_max,amounts_float32,
+            CPI_data=CPI_data,
+            num_workers=num_workers,
+            parallel_backend=parallel_backend,
+            files=files_other,
+            )
+        steg['rader'] = data_other.shape[0]
+    data = concat_med_kategorier([data,data_other])
+    data = data[data['regnaar'].isin(regnaar_needed)].reset_index(drop=True)
+elif out_of_core:
+    if not os.path.exists(folder_name_behandlet):
+        os.makedirs(folder_name_behandlet)
+    with maaling.steg('Behandling (out-of-core)'):
+        regnaar_per_fil = behandle_out_of_core(folder_name,folder_name_behandlet+'/tmp_out_of_core',parquet_folder,
+            columns_lags,makroserier,columns_to_keep,regnaar_min,regnaar_max,amounts_float32,
+            CPI_data=CPI_data,
+            num_workers=num_workers,
+            parallel_backend=parallel_backend,
+            csv_path=csv_path if lagre_csv else None,
+            komprimering_parquet=komprimering_parquet,
+            komprimering_csv=komprimering_csv,
+            )
+else:
+    with maaling.steg('Lasting') as steg:
+        data = load_aarsregnskaper(folder_name,regnaar_max,amounts_float32,
+            CPI_data=CPI_data,
+            num_workers=num_workers,
+            parallel_backend=parallel_backend,
+            )
+        steg['rader'] = data.shape[0]
+    regnaar_per_fil = data.attrs.get('regnaar_per_fil',{})
+
+for f in regnaar_per_fil:
+    files_info[f]['regnaar'] = regnaar_per_fil[f]
+
+# Med out_of_core er data allerede lagret av behandle_out_of_core(), og
+# uten nye eller endrede årsfiler er data_behandlet uendret
+if (run_incremental or not out_of_core) and not ingen_endringer:
+    ##################################################################
+    ##  Filtering  data
+    ##################################################################
+    # Våre modeller bruker variabler som er utledet med verdier for opptil de to 
+    # foregående regnskapsårene. Dermed utfører vi analysene våre på 
+    # årsregnskaper fra og med 2008, mens årsregnskapene fra 2006 og 2007 
+    # kun brukes til å utlede variabelverdier.
+
+    ind = data['regnaar']>=regnaar_min
+
+    # For å analysere kun små og mellomstore bedrifter (SMB) (https://ec.europa.eu/growth/smes/sme-definition_en)
+    # ind = ind & ((data['sum_eiendeler_EUR'].fillna(0)<=43e6)|(data['sum_omsetning_EUR'].fillna(0)<=50e6))
+    # ind = ind & ((data['sum_eiendeler_EUR'].fillna(0)>2e6)&(data['sum_omsetning_EUR'].fillna(0)>2e6))
+
+    # Sjekker at alle firma-år er unike, og at makroseriene har verdier for 
+    # alle regnskapsårene som analyseres, før variablene lages (se 
+    # "funksjoner_validering.py"). Årsfilene er allerede sjekket ved innlesing.
+    with maaling.steg('Validering',data.shape[0]):
+        validering.valider('Data',sjekk_unike(data)+sjekk_makroserier(data,makroserier,ind),data.shape[0])
+
+    ##################################################################
+    ##  Lager variabler basert på tidligere regnskapsår
+    ##################################################################
+    with maaling.steg('Variabler fra tidligere år',data.shape[0]):
+        data = pd.concat([data,lag_lagget_variabler(data,columns_lags)],axis=1)
+    with maaling.steg('Makroserier',data.shape[0]):
+        data = koble_makroserier(data,makroserier,ind)
+
+    data = data.loc[ind,columns_to_keep].reset_index(drop=True)
+
+    # Datatypene i data_behandlet (se dtype_behandlet() i "funksjoner_behandling.py")
+    data = bruk_schema(data,amounts_float32)
+
+    # Sorterer radene på regnskapsår (radene innenfor hvert år beholder 
+    # rekkefølgen fra årsfilene), som i Parquet-lagringen
+    data = data.iloc[np.argsort(data['regnaar'].to_numpy(),kind='stable')].reset_index(drop=True)
+
+    # Lagrer prossesert data fo videre analyser i filen "analysere.py".
+    # Data lagres som Parquet partisjonert på regnskapsår i mappen 
+    # "data_behandlet_parquet", og i tillegg som CSV dersom lagre_csv = True.
+    # Ved inkrementell behandling blir kun partisjonene for de berørte 
+    # regnskapsårene erstattet. Parquet-filene og CSV-filen skrives ett 
+    # regnskapsår om gangen i hver sin tråd (se Skriver i 
+    # "funksjoner_behandling.py"), og hver fil får endelig navn først når den
+    # er ferdig skrevet. Med num_workers>1 formateres CSV-filen i egne prosesser.
+    if not os.path.exists(folder_name_behandlet):
+        os.makedirs(folder_name_behandlet)
+    with maaling.steg('Lagring',data.shape[0]):
+        with (start_executor(num_workers,parallel_backend) if num_workers > 1 else nullcontext()) as executor, \
+                Skriver() as skriver_parquet, Skriver() as skriver_csv:
+            if run_incremental:
+                lagre_partisjoner(data,parquet_folder,regnaar_to_process,komprimering_parquet,skriver_parquet)
+            else:
+                lagre_parquet(data,parquet_folder,komprimering_parquet,skriver_parquet)
+            if lagre_csv:
+                if run_incremental:
+                    # CSV-filen lages fra alle partisjonene
+                    skriver_parquet.vent()
+                    data = les_partisjoner(parquet_folder)
+                lagre_csv_per_aar(data,csv_path,komprimering_csv,skriver_csv,executor)
+
+lagre_manifest({'innstillinger': innstillinger, 'files': files_info},manifest_path)
+
+# Tid og minnebruk per steg, og resultatene av sjekkene
+maaling.lagre('resultater','behandle')
+validering.lagre('resultater','behandle')
@@ -0,0 +1,245 @@
+import numpy as np
+# Copyright © 2005-2019, NumPy Developers.
+
+import pandas as pd
+# Copyright (c) 2008-2012, AQR Capital Management, LLC, Lambda Foundry, Inc. and PyData Development Team
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import subprocess
+
+# Måler tiden for stegene i "behandle_data_og_lag_variabler.py" og 
+# "analysere.py" på syntetiske data med samme struktur som årsfilene i 
+# 'data4'. Skriptene kjøres som de er, med innstillingene i skriptene 
+# (num_workers, engine, osv.), og tidene per steg leses fra målingene 
+# skriptene lagrer (se "funksjoner_maaling.py"). Tidene sammenlignes med en
+# lagret baseline, og skriptet feiler dersom et steg er blitt tregere enn
+# terskelen. Eksempel:
+#
+#   python benchmark.py 10k 1M                # sammenligner med baseline
+#   python benchmark.py 10k --lagre-baseline  # lagrer ny baseline
+
+##################################################################
+##  Innstillinger
+##################################################################
+# Antall rader (firma-år) for hver størrelse
+storrelser = {
+    '10k': 10_000,
+    '1M':  1_000_000,
+    '10M': 10_000_000,
+}
+
+# Regnskapsår i de syntetiske årsfilene. De to første årene brukes kun
+# til variabler fra tidligere regnskapsår, som i analysene.
+regnaar_syntetisk = list(range(2006,2022))
+
+# Andel av bransjene (naeringskoder_level_1) i de syntetiske dataene
+bransjer_andel = {
+    'C': 0.10, 'F': 0.15, 'G': 0.20, 'H': 0.05, 'I': 0.05, 'J': 0.05,
+    'M': 0.10, 'N': 0.05, 'Q': 0.05, 'S': 0.05,
+    'L': 0.05, 'K': 0.02, 'D': 0.01, 'E': 0.01, '0': 0.05, 'MISSING': 0.01,
+}
+
+# Andel manglende verdier i regnskapstallene, og andel av foretakene som
+# leverer årsregnskap hvert år (resten gir hull i tidsseriene)
+andel_manglende = 0.05
+andel_aktive = 0.85
+
+# Et steg har blitt tregere dersom tiden er mer enn terskel (andel) over
+# baseline og minst terskel_sekunder lenger
+terskel = 0.25
+terskel_sekunder = 0.05
+
+# Øvre grense (sekunder) for tiden det tar å importere modulene, i tillegg
+# til numpy og pandas. Måles i en ny prosess.
+importtid_budsjett = {
+    'funksjoner': 0.3,
+    'funksjoner_behandling': 0.3,
+}
+
+benchmark_folder = 'benchmark'
+
+# Skriptene kjøres med arbeidsmappen benchmark/data_<størrelse>/prosjekt/kode,
+# slik at de relative stiene i skriptene ('../../datasett_aarsregnskaper/data4/',
+# '../data_BNP_KPI/', '../data_behandlet' og '../modellager') peker på de
+# syntetiske dataene. Skriptene og navnet på målingen de lagrer:
+skript = {
+    'behandle_data_og_lag_variabler.py': 'behandle',
+    'analysere.py': 'analysere',
+}
+kpi_fil = '03013_20220814-033754.csv' # som i "behandle_data_og_lag_variabler.py"
+
+
+##################################################################
+##  Syntetiske data
+##################################################################
+def lag_syntetisk_panel(folder_name,num_rows,regnaar=regnaar_syntetisk,bransjer=bransjer_andel,
+                        andel_manglende=andel_manglende,andel_aktive=andel_aktive,seed=0):
+    # Lager årsfiler med samme kolonner som i 'data4' (ett år per fil,
+    # '<år>_regnskaper.csv') i folder_name/datasett_aarsregnskaper, og KPI
+    # og BNP som i 'data_BNP_KPI' i folder_name/prosjekt
+    rng = np.random.default_rng(seed)
+    num_firms = max(int(np.ceil(num_rows/(len(regnaar)*andel_aktive))),1)
+    orgnr = 800_000_000+rng.choice(200_000_000,num_firms,replace=False)
+    bransje = rng.choice(list(bransjer.keys()),num_firms,p=np.array(list(bransjer.values()))/np.sum(list(bransjer.values())))
+    orgform = rng.choice(['AS','ASA','ANS','DA','ENK'],num_firms,p=[0.80,0.01,0.07,0.02,0.10])
+    size = np.exp(rng.normal(16,1.5,num_firms))
+
+    folder_data4 = os.path.join(folder_name,'datasett_aarsregnskaper','data4')
+    folder_kpi = os.path.join(folder_name,'prosjekt','data_BNP_KPI')
+    os.makedirs(folder_data4,exist_ok=True)
+    os.makedirs(folder_kpi,exist_ok=True)
+
+    def manglende(values):
+        return np.where(rng.random(len(values))<andel_manglende,np.nan,values)
+
+    for year in regnaar:
+        aktive = rng.random(num_firms)<andel_aktive
+        n = int(np.sum(aktive))
+        size[aktive] = size[aktive]*np.exp(rng.normal(0.02,0.2,n))
+        s = size[aktive]
+        data = pd.DataFrame({
+            'orgnr': orgnr[aktive],
+            'regnaar': year,
+            'avslutningsdato': np.where(rng.random(n)<0.95,'{}-12-31'.format(year),'{}-06-30'.format(year)),
+            'Salgsinntekt': manglende(s),
+            'Sum inntekter': manglende(s*1.05),
+            'Driftsresultat': manglende(s*rng.normal(0.05,0.1,n)),
+            'Varekostnad': manglende(s*0.5*np.exp(rng.normal(0,0.2,n))),
+            'Endring i beholdning av varer under tilvirkning og ferdig tilvirkede varer': np.where(rng.random(n)<0.7,np.nan,rng.normal(0,1e5,n)),
+            'SUM EIENDELER': manglende(s*0.8*np.exp(rng.normal(0,0.3,n))),
+            'Loennskostnad': manglende(s*0.3*np.exp(rng.normal(0,0.2,n))),
+            'naeringskoder_level_1': bransje[aktive],
+            'Varer': manglende(s*0.1),
+            'Sum varer': manglende(s*0.11),
+            'Biologiske eiendeler': np.where(rng.random(n)<0.95,np.nan,1000.0),
+            'Sum fordringer': manglende(s*0.2),
+            'Kundefordringer': manglende(s*0.15),
+            'Leverandoergjeld': manglende(s*0.1),
+            'sum_eiendeler_EUR': manglende(s*0.08),
+            'sum_omsetning_EUR': manglende(s*0.1),
+            'orgform': orgform[aktive],
+            'annen_kolonne': rng.random(n), # kolonner som ikke benyttes
+            })
+        data.to_csv(os.path.join(folder_data4,'{}_regnskaper.csv'.format(year)),sep=';',index=False)
+
+    years = range(min(regnaar)-2,max(regnaar)+2)
+    pd.DataFrame({str(y): [1000+10*(y-2000)+rng.normal()] for y in years}).to_csv(
+        os.path.join(folder_kpi,'GDP.csv'),sep=';',index=False)
+    with open(os.path.join(folder_kpi,kpi_fil),'w') as f:
+        f.write('"Syntetisk KPI"\n\n')
+        f.write('consumption group;month;Consumer Price Index (2015=100)\n')
+        for y in years:
+            for m in range(1,13):
+                f.write('TOTAL;{}M{:02d};{:.1f}\n'.format(y,m,80+(y-2000)*2+m*0.1))
+
+
+##################################################################
+##  Benchmark
+##################################################################
+def kjor_skript(file_name,name,folder_name):
+    # Kjører skriptet i en ny prosess med folder_name som arbeidsmappe, og
+    # returnerer målingen skriptet lagrer (se maaling.lagre())
+    kode_folder = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ,PYTHONPATH=os.pathsep.join([kode_folder]+[p for p in [os.environ.get('PYTHONPATH')] if p]))
+    output = subprocess.run([sys.executable,os.path.join(kode_folder,file_name)],cwd=folder_name,env=env,
+        capture_output=True,text=True)
+    if output.returncode != 0:
+        raise Exception("Feil: {} feilet:\n{}".format(file_name,output.stderr[-5000:]))
+    with open(os.path.join(folder_name,'resultater','maaling_'+name+'.json'),'r') as f:
+        return json.load(f)
+
+
+def kjor_benchmark(name,num_rows):
+    # Kjører skriptene på de syntetiske dataene og returnerer veggtiden i 
+    # sekunder per steg
+    folder_name = os.path.join(benchmark_folder,'data_'+name)
+    if not os.path.exists(os.path.join(folder_name,'datasett_aarsregnskaper','data4')):
+        print('Lager syntetiske data ({:,} rader) i {}'.format(num_rows,folder_name))
+        lag_syntetisk_panel(folder_name,num_rows)
+    kode_folder = os.path.join(folder_name,'prosjekt','kode')
+    os.makedirs(kode_folder,exist_ok=True)
+
+    # Uten data og modeller fra forrige kjøring, slik at alle stegene kjøres
+    for folder in ['data_behandlet','modellager']:
+        shutil.rmtree(os.path.join(folder_name,'prosjekt',folder),ignore_errors=True)
+
+    tider = {}
+    for file_name,maaling_name in skript.items():
+        for steg in kjor_skript(file_name,maaling_name,kode_folder)['steg']:
+            if steg['nivaa'] == 0:
+                key = maaling_name+': '+steg['steg']
+                tider[key] = tider.get(key,0)+steg['veggtid_s']
+    return tider
+
+
+def mal_importtid(module,repetisjoner=3):
+    # Tiden det tar å importere modulen i en ny prosess, utenom numpy og
+    # pandas (den raskeste av repetisjoner kjøringer)
+    code = 'import time,numpy,pandas; t = time.perf_counter(); import {}; print(time.perf_counter()-t)'.format(module)
+    tider = []
+    for repetisjon in range(repetisjoner):
+        output = subprocess.run([sys.executable,'-c',code],cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,text=True,check=True)
+        tider.append(float(output.stdout.strip()))
+    return min(tider)
+
+
+def sammenlign_med_baseline(resultater,baseline):
+    # Returnerer stegene som er blitt tregere enn terskelen
+    regresjoner = []
+    for name,tider in resultater.items():
+        for steg,seconds in tider.items():
+            if steg not in baseline.get(name,{}):
+                continue
+            seconds_baseline = baseline[name][steg]
+            if (seconds > seconds_baseline*(1+terskel)) & (seconds-seconds_baseline > terskel_sekunder):
+                regresjoner.append('{} {}: {:.3f} s (baseline {:.3f} s)'.format(name,steg,seconds,seconds_baseline))
+    return regresjoner
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark på syntetiske data')
+    parser.add_argument('storrelser',nargs='*',default=['10k'],choices=list(storrelser.keys()))
+    parser.add_argument('--lagre-baseline',action='store_true',help='lagrer tidene som ny baseline')
+    parser.add_argument('--repetisjoner',type=int,default=1,help='antall kjøringer (den raskeste tiden brukes)')
+    args = parser.parse_args()
+
+    os.makedirs(benchmark_folder,exist_ok=True)
+    baseline_path = os.path.join(benchmark_folder,'baseline.json')
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path,'r') as f:
+            baseline = json.load(f)
+
+    resultater = {}
+    for name in args.storrelser:
+        for repetisjon in range(args.repetisjoner):
+            tider = kjor_benchmark(name,storrelser[name])
+            if name in resultater:
+                tider = {steg: min(seconds,resultater[name].get(steg,np.inf)) for steg,seconds in tider.items()}
+            resultater[name] = tider
+
+    # Importtid
+    importtider = {module: mal_importtid(module) for module in importtid_budsjett}
+    resultater['import'] = {'Import av '+module: seconds for module,seconds in importtider.items()}
+
+    print(pd.DataFrame(resultater).round(3).to_string())
+
+    if args.lagre_baseline:
+        baseline.update(resultater)
+        with open(baseline_path+'.tmp','w') as f:
+            json.dump(baseline,f,indent=1)
+        os.replace(baseline_path+'.tmp',baseline_path)
+        print('Baseline lagret i '+baseline_path)
+    else:
+        regresjoner = sammenlign_med_baseline(resultater,baseline)
+        for module,seconds in importtider.items():
+            if seconds > importtid_budsjett[module]:
+                regresjoner.append('Import av {}: {:.3f} s (budsjett {:.3f} s)'.format(module,seconds,importtid_budsjett[module]))
+        if len(regresjoner) > 0:
+            raise Exception("Feil: stegene er blitt tregere enn baseline:\n"+'\n'.join(regresjoner))
+        print('Ingen steg er blitt tregere enn baseline (terskel {:.0%})'.format(terskel))
@@ -1,19 +1,133 @@
 import numpy as np
 import pandas as pd
 
-from statsmodels.formula.api import ols
+from funksjoner_behandling import les_partisjoner, start_executor, bruk_schema, sjekk_schema, \
+    csv_komprimering, csv_behandlet_path, Skriver, skriv_atomisk
+from funksjoner_estimering import ols_absorb, ols_formula, Resampling, Cellestatistikk, kombiner
+from funksjoner_maaling import maaling
+from funksjoner_validering import validering, sjekk_unike
+from funksjoner_panel import Panel, log_forhold, vekst, nedgang, oppgang, ved_nedgang, produkt, terskel, terskelklasse
 
 import os
+import hashlib
+import types
+import pickle
+from collections import OrderedDict
+from concurrent.futures import as_completed
+import threading
 
-from scipy.stats import pearsonr
+# Funksjonene som hentes med "from funksjoner import *" (se "analysere.py").
+# statsmodels og scipy importeres først når de brukes (se 
+# "funksjoner_estimering.py"), slik at importen går raskt.
+__all__ = [
+    'les_data_behandlet',
+    'kolonner_behandlet',
+    'add_tailing_zeros_decimals',
+    'formater_tall',
+    'shift_row_to_bottom',
+    'model_preparing',
+    'fe_dummies',
+    'fe_navn',
+    'fe_prefiks',
+    'fe_verdier',
+    'regression_rrw',
+    'estimer_modell',
+    'estimer_modell_tall',
+    'stjerner_terskler',
+    'stjerner_tegn',
+    'rader_nederst',
+    'formater_tall_array',
+    'stjerner',
+    'formater_resultater',
+    'ordne_resultattabell',
+    'tabellformater',
+    'til_latex',
+    'skriv_tabell',
+    'lagre_tabell',
+    'Skriver',
+    'grupper_per_verdi',
+    'rullerende_vinduer',
+    'terskelklasse',
+    'estimer_grupper',
+    'bransjer_ekskludert',
+    'maske_bransjer',
+    'maske_ikke_manglende',
+    'maske_positiv',
+    'Utvalgsmasker',
+    'exclude_missing_prev_year',
+    'thousand_seperator',
+    'exclude_industries',
+    'removing_zero_and_negative_ratios',
+    'sample_selection',
+    'antall_bytes',
+    'Mellomlager',
+    'dataversjon',
+    'kode_hash',
+    'Modellager',
+    'fyll_inn_kostnad',
+    'forbered_modeller',
+    'kjor_modeller',
+    'start_executor',
+    'maaling',
+    'validering',
+    'sjekk_unike',
+    'Panel',
+    'log_forhold',
+    'vekst',
+    'nedgang',
+    'oppgang',
+    'ved_nedgang',
+    'produkt',
+    'terskel',
+]
 
-from sklearn import preprocessing
+def les_data_behandlet(folder_name='../data_behandlet',columns=None,years=None,data_format='parquet'):
+    # Leser data som ble lagret i "behandle_data_og_lag_variabler.py". Med 
+    # data_format='parquet' blir kun de gitte kolonnene og regnskapsårene 
+    # lest, og filene blir minnekartlagt (memory_map) i stedet for kopiert.
+    # Datatypene sjekkes (se dtype_behandlet() i "funksjoner_behandling.py").
+    if data_format == 'csv':
+        data = pd.read_csv(csv_behandlet_nyeste(folder_name),sep=';',low_memory=False,usecols=columns)
+        if years is not None:
+            data = data[data['regnaar'].isin(years)].reset_index(drop=True)
+        return bruk_schema(data,amounts_float32=None)
+    if data_format != 'parquet':
+        raise Exception("Feil: data_format må være 'parquet' eller 'csv'")
+
+    data = les_partisjoner(os.path.join(folder_name,'data_behandlet_parquet'),columns,years)
+    return sjekk_schema(data)
+
+def csv_behandlet_nyeste(folder_name):
+    # Den sist lagrede CSV-filen, som kan være komprimert (se 
+    # komprimering_csv i "behandle_data_og_lag_variabler.py")
+    file_paths = [csv_behandlet_path(folder_name,k) for k in csv_komprimering]
+    file_paths = [p for p in file_paths if os.path.exists(p)]
+    if len(file_paths) == 0:
+        raise Exception("Feil: finner ikke data_behandlet.csv i {}".format(folder_name))
+    return max(file_paths,key=os.path.getmtime)
+
+def kolonner_behandlet(folder_name='../data_behandlet',data_format='parquet'):
+    # Alle kolonnene i data_behandlet, uten å lese dataene
+    if data_format == 'csv':
+        return list(pd.read_csv(csv_behandlet_nyeste(folder_name),sep=';',nrows=0).columns)
+    import pyarrow.parquet as pq
+    parquet_folder = os.path.join(folder_name,'data_behandlet_parquet')
+    columns = []
+    for root,dirs,files in os.walk(parquet_folder):
+        for f in sorted(files):
+            if not f.startswith('.'):
+                columns += pq.read_schema(os.path.join(root,f)).names
+    return list(dict.fromkeys(columns))
 
 def add_tailing_zeros_decimals(num,num_decimals):
     while len(num[num.rfind('.')+1:])!=num_decimals:
         num = num+'0'
     return num
 
+def formater_tall(number,num_decimals):
+    number = add_tailing_zeros_decimals(np.round(number,num_decimals).astype(str),num_decimals)
+    return number.replace('.', ',')
+
 # https://stackoverflow.com/questions/67113820/function-to-move-specific-row-to-top-or-bottom-of-pandas-dataframe
 def shift_row_to_bottom(col_to_shift,df):
   idx = df.index.tolist()
@@ -31,95 +145,465 @@ def model_preparing(X,y,data):
             string_formula = string_formula+' + '+str(i)
     return df,string_formula
 
-def regression_rrw(var,data,results_df,file_name):
+def fe_dummies(column,prefix):
+    # Dummyvariabler for en fast effekt, der den siste kategorien utelates
+    if column.name == 'regnaar':
+        column = column.astype(int)
+    else:
+        column = column.astype(object)
+    temp = pd.get_dummies(column).iloc[:,:-1]
+    for i in temp.columns:
+        temp=temp.rename(columns = {i:prefix+str(i)})
+    return temp
+
+# Navnene på de faste effektene i resultattabellene. En fast effekt er en
+# kolonne i data, eller en kombinasjon av kolonner med '*' (f.eks. 
+# 'Bransje*regnaar' for bransje x år).
+fe_navn = {
+    'orgnr': 'Foretak FE',
+    'regnaar': 'År FE',
+    'Bransje': 'Bransje FE',
+    'Bransje*regnaar': 'Bransje x år FE',
+}
+
+# Prefiksene til dummyvariablene for de faste effektene som kan brukes med
+# engine='formula'. De andre (f.eks. foretak) har for mange nivåer til å 
+# lages som dummyvariabler, og krever engine='absorb'.
+fe_prefiks = {
+    'regnaar': 'dy',
+    'Bransje': 'di',
+}
+
+def fe_verdier(data,fe):
+    # Verdiene til den faste effekten fe (se fe_navn) for radene i data
+    if '*' in fe:
+        return kombiner([data[c].to_numpy() for c in fe.split('*')])
+    return data[fe]
+
+def regression_rrw(var,data,results_df,file_name,engine='formula',cluster=('orgnr',),mellomlager=None,
+                   bootstrap=0,placebo=0,seed=0,resampling_vars=None,resampling_workers=1,
+                   fixed_effects=('regnaar','Bransje'),fjern_singletons=True):
+    # Estimerer modellen (se estimer_modell()) og legger resultatene til 
+    # tabellen med resultater fra andre modeller
+    series_results = estimer_modell(var,data,file_name,engine,cluster,mellomlager,
+        bootstrap,placebo,seed,resampling_vars,resampling_workers,fixed_effects,fjern_singletons)
+    results_df = pd.concat([results_df,series_results],axis=1)
+    return results_df
+
+def estimer_modell(var,data,file_name,engine='formula',cluster=('orgnr',),mellomlager=None,
+                   bootstrap=0,placebo=0,seed=0,resampling_vars=None,resampling_workers=1,
+                   fixed_effects=('regnaar','Bransje'),fjern_singletons=True):
+    # Estimerer modellen (se estimer_modell_tall()) og returnerer kolonnen
+    # med formaterte resultater (se formater_resultater())
+    resultat = estimer_modell_tall(var,data,file_name,engine,cluster,mellomlager,
+        bootstrap,placebo,seed,resampling_vars,resampling_workers,fixed_effects,fjern_singletons)
+    return formater_resultater([resultat]).iloc[:,0]
+
+def estimer_modell_tall(var,data,file_name,engine='formula',cluster=('orgnr',),mellomlager=None,
+                        bootstrap=0,placebo=0,seed=0,resampling_vars=None,resampling_workers=1,
+                        fixed_effects=('regnaar','Bransje'),fjern_singletons=True):
+    # engine='formula': faste effekter som dummyvariabler i statsmodels 
+    # engine='absorb':  faste effekter absorbert ved demeaning, se 
+    #                   ols_absorb() i "funksjoner_estimering.py"
+    # cluster: kolonnen(e) det klynges på, f.eks. ['orgnr'] eller 
+    #          ['orgnr','regnaar'] for toveis klynging
+    # mellomlager: Mellomlager som data kommer fra (se Mellomlager under). 
+    #          Variablene i var og dummyvariablene hentes da derfra.
+    # bootstrap: antall bootstrap-replikasjoner (klynget på cluster[0]) for
+    #          konfidensintervallene til resampling_vars. 0 = ingen.
+    # placebo: antall placebo-replikasjoner der responsvariabelen permuteres
+    #          innenfor hvert regnskapsår. 0 = ingen.
+    # seed:    frø for replikasjonene (samme resultat for samme frø)
+    # resampling_vars: variablene det lages rader for (standard: var[1:])
+    # resampling_workers: antall prosesser for replikasjonene
+    # fixed_effects: de faste effektene (se fe_navn), f.eks. 
+    #          ['orgnr','regnaar'] for foretak og år (krever engine='absorb')
+    # fjern_singletons: fjerner observasjoner som er alene i en gruppe for en
+    #          av de faste effektene med engine='absorb' (se uten_singletons()
+    #          i "funksjoner_estimering.py")
+    #
+    # Returnerer en dict med uformaterte tall for modellen, som formateres
+    # sammen med de andre modellene i formater_resultater()
+    if engine not in ['formula','absorb']:
+        raise Exception("Feil: engine må være 'formula' eller 'absorb'")
+    if engine == 'formula':
+        for fe in fixed_effects:
+            if fe not in fe_prefiks:
+                raise Exception("Feil: faste effekter for '{}' krever engine='absorb'".format(fe))
 
-    # Sett til 'True'/'False' for å inkludere/ikke inkludere 
-    # faste effekter av regnskapsår 
-    fixed_effects_year = True
+    # Henter resultatet fra modellageret dersom modellen er estimert før
+    # (se Modellager). Navnet på modellen er ikke en del av nøkkelen.
+    modell_key = None
+    if (mellomlager is not None) and (mellomlager.modellager is not None):
+        modell_key = mellomlager.modell_nokkel(var,data,engine=engine,cluster=list(cluster),
+            bootstrap=bootstrap,placebo=placebo,seed=seed,resampling_vars=resampling_vars,
+            fixed_effects=list(fixed_effects),fjern_singletons=fjern_singletons)
+        with maaling.steg('Modellager (Modell {})'.format(file_name),data.shape[0]):
+            resultat = mellomlager.modellager.hent(modell_key)
+        if resultat is not None:
+            resultat['name'] = 'Modell ('+file_name+')'
+            return resultat
 
-    # Sett til 'True'/'False' for å inkludere/ikke inkludere 
-    # faste effekter av bransje 
-    fixed_effects_Bransje = True
+    # Faste effekter som dummyvariabler: (kolonne, prefiks)
+    fe_columns = []
+    if engine == 'formula':
+        fe_columns = [(fe,fe_prefiks[fe]) for fe in fixed_effects]
 
-    # Antall desimaler etter komma i tabellene med resultater
-    num_decimals = 3
+    if mellomlager is not None:
+        y,X = mellomlager.design(var,data,fe_columns)
+    else:
+        y = data[var[0]]
+        X = data[var[1:]]
 
-    y = data[var[0]]
-    X = data[var[1:]]
+        # Add fixed effects
+        for column,prefix in fe_columns:
+            X = pd.concat([X,fe_dummies(data[column],prefix)],axis=1)
 
-    # Add fixed effects
-    if fixed_effects_year:
-        temp = pd.get_dummies(data['regnaar'].astype(int)).iloc[:,:-1]
-        for i in temp.columns:
-            temp=temp.rename(columns = {i:'dy'+str(i)})
-        X = pd.concat([X,temp],axis=1)
-    if fixed_effects_Bransje:
-        temp = pd.get_dummies(data['Bransje']).iloc[:,:-1]
-        for i in temp.columns:
-            temp=temp.rename(columns = {i:'di'+str(i)})
-        X = pd.concat([X,temp],axis=1)
+    fe_values = [fe_verdier(data,fe) for fe in fixed_effects]
 
-    df,string_formula = model_preparing(X,y,data)
+    with maaling.steg('Regresjon (Modell {})'.format(file_name),X.shape[0]):
+        if engine == 'absorb':
+            model = ols_absorb(y,X,fe_values,[data[c] for c in cluster],fjern_singletons)
 
-    model = ols(formula=string_formula,data=df).fit(cov_type='cluster', cov_kwds={'groups': df['orgnr']})
+        if engine == 'formula':
+            df,string_formula = model_preparing(X,y,data)
+            model = ols_formula(string_formula,df,[data[c] for c in cluster])
 
     list_variables = ['Intercept'] + var[1:]
-    series_results     = pd.Series(dtype=object)
-    for i in list_variables:
-        coef = np.round(model.params[i],num_decimals).astype(str)
-        coef = add_tailing_zeros_decimals(coef,num_decimals)
-        coef = coef.replace('.', ',')
-        
-        pval = model.pvalues[i]
-        if pval<0.001:
-            coef = coef+'****'
-        elif pval<0.01:
-            coef = coef+'***'
-        elif pval<0.05:
-            coef = coef+'**'
-        elif pval<0.10:
-            coef = coef+'*'
-
-        if i == 'Intercept':
-            series_results['Konstant'] = coef
+    resultat = {
+        'name': 'Modell ('+file_name+')',
+        'params': pd.Series(model.params,dtype=float)[list_variables],
+        'pvalues': pd.Series(model.pvalues,dtype=float)[list_variables],
+        'cov': model.cov_params().loc[list_variables,list_variables],
+        'nobs': model.nobs,
+        'rsquared': model.rsquared,
+        'fe': {fe_navn.get(fe,fe+' FE'): True for fe in fixed_effects},
+        'ki': None,
+        'placebo': None,
+    }
+
+    # Bootstrap-konfidensintervaller og placebotester
+    if (bootstrap > 0) | (placebo > 0):
+        if resampling_vars is None:
+            resampling_vars = var[1:]
+        resampling_vars = [i for i in resampling_vars if i in var[1:]]
+        resampling = Resampling(y,X[var[1:]],fe_values,[data[c] for c in cluster],
+            permutation_groups=data['regnaar'],fjern_singletons=fjern_singletons and (engine == 'absorb'))
+        if bootstrap > 0:
+            with maaling.steg('Bootstrap (Modell {})'.format(file_name),X.shape[0]):
+                params_bootstrap = resampling.bootstrap(bootstrap,seed,resampling_workers)
+            resultat['ki'] = resampling.konfidensintervall(params_bootstrap)[resampling_vars]
+        if placebo > 0:
+            with maaling.steg('Placebo (Modell {})'.format(file_name),X.shape[0]):
+                pvalues = resampling.placebo_pvalues(resampling.placebo(placebo,seed,resampling_workers))
+            resultat['placebo'] = pd.Series(pvalues,dtype=float)[resampling_vars]
+
+    if modell_key is not None:
+        mellomlager.modellager.lagre(modell_key,resultat)
+    return resultat
+
+
+##################################################################
+##  Formatering og lagring av resultattabellene
+##################################################################
+# Signifikansnivåer og stjernene som legges til koeffisientene
+stjerner_terskler = [0.001, 0.01, 0.05, 0.10]
+stjerner_tegn     = ['****','***','**','*']
+
+# Radene som står nederst i resultattabellene, i denne rekkefølgen. Radene
+# for År FE og Bransje FE er alltid med, de andre faste effektene kun når
+# de brukes i en av modellene.
+rader_nederst = ['Konstant']+list(fe_navn.values())+['R2','Antall observasjoner']
+
+def formater_tall_array(values,num_decimals):
+    # Som formater_tall(), men for en hel array på én gang. Manglende 
+    # verdier blir NaN.
+    values = np.asarray(values,dtype=float)
+    numbers = np.char.mod('%.{}f'.format(num_decimals),np.round(values,num_decimals))
+    numbers = np.char.replace(numbers,'.',',').astype(object)
+    numbers[np.isnan(values)] = np.nan
+    return numbers
+
+def stjerner(pvalues):
+    # Signifikansstjerner for en array med p-verdier (se stjerner_terskler)
+    pvalues = np.asarray(pvalues,dtype=float)
+    return np.select([pvalues<t for t in stjerner_terskler],stjerner_tegn,'')
+
+def formater_resultater(resultater,num_decimals=3):
+    # Formaterer resultatene fra estimer_modell_tall() for alle modellene på
+    # én gang, med én kolonne per modell: koeffisientene med komma som 
+    # desimaltegn og stjerner for signifikans, eventuelle rader fra 
+    # bootstrap og placebo, og til slutt radene i rader_nederst.
+    # num_decimals: antall desimaler etter komma i tabellene med resultater
+    names = [r['name'] for r in resultater]
+    params = pd.concat([r['params'] for r in resultater],axis=1,keys=names,sort=False)
+    pvalues = pd.concat([r['pvalues'] for r in resultater],axis=1,keys=names,sort=False)
+    pvalues = pvalues.reindex(index=params.index,columns=params.columns)
+
+    coef = formater_tall_array(params.to_numpy(),num_decimals)
+    coef = np.where(pd.isna(coef),coef,coef.astype(str)+stjerner(pvalues.to_numpy()).astype(object))
+    tabeller = [pd.DataFrame(coef,index=params.index.str.replace('^Intercept$','Konstant',regex=True),columns=names)]
+
+    # Radene fra bootstrap og placebo står i hver sin blokk under 
+    # koeffisientene, med variablene i samme rekkefølge som koeffisientene
+    navn = list(dict.fromkeys(i for r in resultater for i in r['params'].index))
+    ekstra = []
+    for r in resultater:
+        rader = pd.Series(dtype=object)
+        if r['ki'] is not None:
+            ki = np.char.add(np.char.add(formater_tall_array(r['ki'].iloc[0],num_decimals).astype(str),'; '),
+                formater_tall_array(r['ki'].iloc[1],num_decimals).astype(str))
+            rader = pd.concat([rader,pd.Series(np.char.add(np.char.add('[',ki),']'),
+                index=r['ki'].columns+' (bootstrap 95% KI)',dtype=object)])
+        if r['placebo'] is not None:
+            rader = pd.concat([rader,pd.Series(formater_tall_array(r['placebo'],num_decimals),
+                index=r['placebo'].index+' (placebo p-verdi)',dtype=object)])
+        ekstra.append(rader)
+    ekstra_rader = list(dict.fromkeys(i for rader in ekstra for i in rader.index))
+    rekkefolge = ['Konstant' if i == 'Intercept' else i for i in navn]
+    for suffix in [' (bootstrap 95% KI)',' (placebo p-verdi)']:
+        rekkefolge += [i+suffix for i in navn if i+suffix in ekstra_rader]
+    rekkefolge += [i for i in ekstra_rader if i not in rekkefolge]
+    if len(ekstra_rader) > 0:
+        tabeller.append(pd.concat(ekstra,axis=1,keys=names,sort=False))
+
+    nobs = pd.Series([r['nobs'] for r in resultater],dtype=float)
+    rsquared = np.round(np.array([r['rsquared'] for r in resultater],dtype=float),num_decimals)
+    nederst = {
+        'Antall observasjoner': nobs.map('{:,.0f}'.format).str.replace(',',' ').to_numpy(),
+        'R2': np.char.replace(rsquared.astype(str),'.',','),
+        }
+    fe_rader = list(dict.fromkeys(['År FE','Bransje FE']+[fe for r in resultater for fe in r['fe']]))
+    for fe in fe_rader:
+        nederst[fe] = np.where([r['fe'].get(fe,False) for r in resultater],'Ja','Nei')
+    tabeller.append(pd.DataFrame(nederst,index=names).T.astype(object))
+
+    # Faste effekter som ikke er i fe_navn står over R2
+    rader = rader_nederst[:-2]+[fe for fe in fe_rader if fe not in rader_nederst]+rader_nederst[-2:]
+    return ordne_resultattabell(pd.concat(tabeller,sort=False),rekkefolge,rader)
+
+
+def ordne_resultattabell(results_df,rekkefolge=None,nederst=None):
+    # Flytter radene i nederst (standard: rader_nederst) til bunnen av 
+    # tabellen med én reindex. De andre radene står i rekkefolge (standard:
+    # rekkefølgen i tabellen).
+    if rekkefolge is None:
+        rekkefolge = results_df.index
+    if nederst is None:
+        nederst = rader_nederst
+    rader = [i for i in rekkefolge if i not in nederst]
+    return results_df.reindex(rader+[i for i in nederst if i in results_df.index])
+
+# Formatene resultattabellene kan lagres i (se lagre_tabell())
+tabellformater = ['xlsx','csv','parquet','tex']
+
+def til_latex(df):
+    # Tabellen som en enkel LaTeX-tabell (tabular)
+    def escape(values):
+        return pd.Series(values,dtype=object).fillna('').astype(str).str.replace(r'([&%$#_{}])',r'\\\1',regex=True)
+    body = escape(df.index)
+    for c in df.columns:
+        body = body.str.cat(escape(df[c].to_numpy()),sep=' & ')
+    header = ' & '.join(escape([df.index.name or '']+list(df.columns)))
+    lines = ['\\begin{tabular}{l'+'r'*df.shape[1]+'}','\\hline',header+' \\\\','\\hline']
+    lines += list(body+' \\\\')
+    lines += ['\\hline','\\end{tabular}']
+    return '\n'.join(lines)+'\n'
+
+def skriv_tabell(file_path,df,f):
+    if f == 'xlsx':
+        df.to_excel(file_path)
+    elif f == 'csv':
+        df.to_csv(file_path,sep=';')
+    elif f == 'parquet':
+        df.to_parquet(file_path)
+    elif f == 'tex':
+        with open(file_path,'w',encoding='utf-8') as fil:
+            fil.write(til_latex(df))
+
+def lagre_tabell(df,file_name,formater=('xlsx',),skriver=None,erstatt=False):
+    # Lagrer tabellen som file_name.<format> for hvert format i formater
+    # (se tabellformater). CSV-filene bruker semikolon som skilletegn, 
+    # siden tallene har komma som desimaltegn. Hver fil skrives først til
+    # en midlertidig fil, og i bakgrunnen dersom skriver er gitt (se Skriver
+    # i "funksjoner_behandling.py"). Med erstatt=True erstatter tabellen en 
+    # tidligere versjon som ennå ikke er skrevet.
+    for f in formater:
+        if f not in tabellformater:
+            raise Exception("Feil: formatene må være blant {}".format(tabellformater))
+    for f in formater:
+        if skriver is None:
+            skriv_atomisk(file_name+'.'+f,skriv_tabell,df,f)
         else:
-            series_results[i] = coef
+            skriver.skriv(file_name+'.'+f,skriv_tabell,df,f,erstatt=erstatt)
 
-    # Antall observasjoner
-    series_results['Antall observasjoner'] = thousand_seperator(X.shape[0])
 
-    # R squared
-    series_results['R2'] = np.round(model.rsquared,num_decimals).astype(str).replace('.', ',')
+##################################################################
+##  Estimering per bransje og for rullerende vinduer
+##################################################################
+def grupper_per_verdi(celler,column):
+    # Én gruppe per verdi av kolonnen, f.eks. per bransje
+    values = sorted(celler[column].dropna().unique())
+    return {'{}={}'.format(column,v): (celler[column]==v).to_numpy() for v in values}
 
-    # Fixed effects
-    if fixed_effects_year:
-        series_results['År FE']  = 'Ja'
-    else:
-        series_results['År FE']  = 'Nei'
-    if fixed_effects_Bransje:
-        series_results['Bransje FE']  = 'Ja'
+
+def rullerende_vinduer(celler,column='regnaar',width=5):
+    # Én gruppe per vindu med width påfølgende verdier, f.eks. regnskapsår
+    values = np.sort(celler[column].unique())
+    grupper = {}
+    for i in range(len(values)-width+1):
+        name = '{}={}-{}'.format(column,values[i],values[i+width-1])
+        grupper[name] = celler[column].between(values[i],values[i+width-1]).to_numpy()
+    return grupper
+
+
+def estimer_grupper(var,data,grupper,cluster=('orgnr',),mellomlager=None,
+                    cell_columns=('Bransje','regnaar'),fe_columns=('regnaar','Bransje'),klyngerobust=True,
+                    engine='formula',fjern_singletons=False):
+    # Estimerer modellen for hver gruppe av celler, der cellene er 
+    # kombinasjonene av cell_columns. grupper er en funksjon som får 
+    # tabellen med cellene og gir en dict med navn -> boolsk array over
+    # cellene (se grupper_per_verdi() og rullerende_vinduer()). Summene per
+    # celle beregnes én gang for alle gruppene (se Cellestatistikk i 
+    # "funksjoner_estimering.py"). fe_columns er de faste effektene (som 
+    # fixed_effects i estimer_modell_tall()), og må være konstante innenfor
+    # cellene: kolonnene (eller for f.eks. 'Bransje*regnaar' hver av dem) må
+    # være blant cell_columns. Faste effekter for foretak (orgnr) kan derfor 
+    # ikke estimeres fra cellesummene. engine og fjern_singletons som i 
+    # estimer_modell_tall(). Kolonner i cell_columns som ikke finnes i data
+    # hentes fra mellomlageret (f.eks. variabler i variabeldefinisjoner).
+    # Med klyngerobust=False brukes kun cellesummene (se Cellestatistikk).
+    # Returnerer én rad per gruppe og variabel.
+    for fe in fe_columns:
+        if not all(c in cell_columns for c in fe.split('*')):
+            raise Exception("Feil: faste effekter for '{}' kan ikke estimeres fra summer per celle (cellene er {})".format(fe,list(cell_columns)))
+    if engine not in ['formula','absorb']:
+        raise Exception("Feil: ukjent engine '{}'".format(engine))
+    if mellomlager is not None:
+        y,X = mellomlager.design(var,data)
+        rows = data.index.to_numpy()
+        cells = pd.DataFrame({c: data[c] if c in data.columns else mellomlager.kolonne(c)[rows] for c in cell_columns},
+            index=data.index)
     else:
-        series_results['Bransje FE']  = 'Nei'
+        y = data[var[0]]
+        X = data[var[1:]]
+        cells = data[list(cell_columns)].copy()
+    for fe in fe_columns:
+        if '*' in fe:
+            cells[fe] = kombiner([cells[c].to_numpy() for c in fe.split('*')])
+    statistikk = Cellestatistikk(y,X,cells,[data[c] for c in cluster])
+    return statistikk.estimer_grupper(grupper(statistikk.celler),fe_columns,klyngerobust,engine,fjern_singletons)
 
-    # Legger til regresjonsresultatene til tabell med 
-    # resultater fra andre modeller
-    series_results.name = 'Modell ('+file_name+')'
 
-    results_df = pd.concat([results_df,series_results],axis=1)
+##################################################################
+##  Utvalg (sample selection) med masker
+##################################################################
+# Bransjer som ekskluderes fra analysene
+bransjer_ekskludert = [
+    'L', # L - Omsetning og drift av fast eiendom
+    'K', # K - Finansiering og forsikring
+    'O', # O - Off.adm., forsvar, sosialforsikring
+    'D', # D - Kraftforsyning
+    'E', # E - Vann, avløp, renovasjon
+    '0', # companies for investment and holding purposes only
+    'MISSING', # Missing
+]
 
-    return results_df
+
+def maske_bransjer(data):
+    return np.asarray(~data['Bransje'].isin(bransjer_ekskludert))
+
+
+def maske_ikke_manglende(data,column):
+    return np.asarray(pd.notnull(data[column]))
+
+
+def maske_positiv(data,column):
+    # Manglende verdier gir False (NaN > 0 er False)
+    return np.asarray(data[column]>0)
+
+
+class Utvalgsmasker:
+    # Kriteriene for utvalget evalueres én gang for alle rader i data og 
+    # lagres som boolske masker. Et utvalg settes sammen av maskene i samme
+    # rekkefølge som i sample_selection(), slik at antall observasjoner som 
+    # ekskluderes i hvert steg blir det samme. Kun radnumrene i det endelige
+    # utvalget lages. Kolonner som ikke finnes i data (f.eks. variabler fra
+    # tidligere år, se Panel) hentes med kolonne(navn).
+    def __init__(self,data,kolonne=None):
+        self.data = data
+        self.kolonne = kolonne
+        self.masker = {}
+
+    def maske(self,kriterium,column=None):
+        key = (kriterium,column)
+        if key not in self.masker:
+            data = self.data
+            if (column is not None) and (column not in data.columns) and (self.kolonne is not None):
+                data = pd.DataFrame({column: self.kolonne(column)},index=data.index)
+            if kriterium == 'bransjer':
+                self.masker[key] = maske_bransjer(data)
+            elif kriterium == 'ikke_manglende':
+                self.masker[key] = maske_ikke_manglende(data,column)
+            elif kriterium == 'positiv':
+                self.masker[key] = maske_positiv(data,column)
+            else:
+                raise Exception("Feil: ukjent kriterium '{}' i Utvalgsmasker".format(kriterium))
+        return self.masker[key]
+
+    def utvalg(self,num_prev,var_log,costs_for_response):
+        # Returnerer radnumrene i utvalget og tabellen over utvalget
+        sample_selection_series = pd.Series(dtype=float)
+        text_initial_sample = 'Alle årsregnskaper 2008-2021'
+        sample_selection_series[text_initial_sample] = thousand_seperator(self.data.shape[0])
+
+        # Exclude industries
+        ind = self.maske('bransjer')
+        sample_selection_series['Ekskludert de nevnte bransjene'] = thousand_seperator(np.sum(~ind))
+
+        # we include only firm-year observations of firms where 
+        # also a firm-year from the previous accounting year is available
+        col_name_1 = 'Ingen årsregnskap det foregående året'
+        col_name_2 = 'Ingen årsregnskap de to foregående årene'
+        if (num_prev==1)|(num_prev==2):
+            m = self.maske('ikke_manglende','Salg_prev')
+            sample_selection_series[col_name_1] = thousand_seperator(np.sum(ind & ~m))
+            ind = ind & m
+        if num_prev==2:
+            m = self.maske('ikke_manglende','Salg_prev_prev')
+            sample_selection_series[col_name_2] = thousand_seperator(np.sum(ind & ~m))
+            ind = ind & m
+        else:
+            sample_selection_series[col_name_2] = None
+        if (num_prev!=1)&(num_prev!=2):
+            print('ERROR defining num_prev in function exclude_missing_prev_year()')
+
+        # Empty columns
+        sample_selection_series[''] = None
+        sample_selection_series[costs_for_response+':'] = None
+
+        # Removing zero and negative
+        obs_before = np.sum(ind)
+        for var in var_log:
+            ind = ind & self.maske('positiv',var)
+        sample_selection_series['Ikke-positiv verdi for regnskapsposter'] = thousand_seperator(obs_before-np.sum(ind))
+
+        # Adding final sample size
+        rows = np.flatnonzero(ind)
+        sample_selection_series['Endelig utvalg for analyser'] = thousand_seperator(len(rows))
+        return rows,sample_selection_series
 
 
 def exclude_missing_prev_year(num_prev,data,sample_selection_series):
     col_name_1 = 'Ingen årsregnskap det foregående året'
     col_name_2 = 'Ingen årsregnskap de to foregående årene'
     if (num_prev==1)|(num_prev==2):
-        ind = pd.isnull(data['Salg_prev'])==False
+        ind = maske_ikke_manglende(data,'Salg_prev')
         data = data[ind]
         data = data.reset_index(drop=True) # Reset index
         sample_selection_series[col_name_1] = thousand_seperator(np.sum(ind==False))
     if num_prev==2:
-        ind = pd.isnull(data['Salg_prev_prev'])==False
+        ind = maske_ikke_manglende(data,'Salg_prev_prev')
         data = data[ind]
         data = data.reset_index(drop=True) # Reset index
         sample_selection_series[col_name_2] = thousand_seperator(np.sum(ind==False))
@@ -135,13 +619,7 @@ def thousand_seperator(number):
 
 
 def exclude_industries(data,sample_selection_series):
-    ind = data['Bransje']!='L' # L - Omsetning og drift av fast eiendom
-    ind = ind & (data['Bransje']!='K') # K - Finansiering og forsikring
-    ind = ind & (data['Bransje']!='O') # O - Off.adm., forsvar, sosialforsikring
-    ind = ind & (data['Bransje']!='D') # D - Kraftforsyning
-    ind = ind & (data['Bransje']!='E') # E - Vann, avløp, renovasjon
-    ind = ind & (data['Bransje']!='0') # companies for investment and holding purposes only
-    ind = ind & (data['Bransje']!='MISSING') # Missing
+    ind = maske_bransjer(data)
 
     data = data[ind]
     data = data.reset_index(drop=True) # Reset index 
@@ -153,41 +631,417 @@ def exclude_industries(data,sample_selection_series):
 
 
 def removing_zero_and_negative_ratios(var_log,data,sample_selection_series):
-    obs_before = data.shape[0]
-
+    # Kombinerer maskene for alle variablene før data filtreres (én kopi)
+    ind = np.ones(data.shape[0],dtype=bool)
     for var in var_log:
-        ind = data[var]<=0
-        ind = ind | (data[var].isnull())
-        data = data[ind==False]
-        data = data.reset_index(drop=True) # Reset index 
+        ind = ind & maske_positiv(data,var)
+    data = data[ind]
+    data = data.reset_index(drop=True) # Reset index 
 
     col_name = 'Ikke-positiv verdi for regnskapsposter'
-    sample_selection_series[col_name] = thousand_seperator(obs_before-data.shape[0])
+    sample_selection_series[col_name] = thousand_seperator(np.sum(ind==False))
 
     return data,sample_selection_series
 
 
-def sample_selection(data,num_prev,var_log,file_name,sample_selection_table,costs_for_response):
-    sample_selection_series = pd.Series(dtype=float)
-    text_initial_sample = 'Alle årsregnskaper 2008-2021'
-    sample_selection_series[text_initial_sample] = thousand_seperator(data.shape[0])
+def sample_selection(data,num_prev,var_log,file_name,sample_selection_table,costs_for_response,masker=None):
+    # Utvalget lages fra maskene i Utvalgsmasker, slik at data kun kopieres
+    # én gang. Send inn masker (Utvalgsmasker for data) for å gjenbruke 
+    # maskene mellom modellene.
+    if masker is None:
+        masker = Utvalgsmasker(data)
+    rows,sample_selection_series = masker.utvalg(num_prev,var_log,costs_for_response)
+    data = data.iloc[rows].reset_index(drop=True) # Reset index
 
-    # Exclude industries
-    data,sample_selection_series = exclude_industries(data,sample_selection_series)
+    # Merging with table
+    sample_selection_table['Modell ({})'.format(file_name)] = sample_selection_series
 
-    # we include only firm-year observations of firms where 
-    # also a firm-year from the previous accounting year is available
-    data,sample_selection_series = exclude_missing_prev_year(num_prev,data,sample_selection_series)
+    return data,sample_selection_table
 
-    # Empty columns
-    sample_selection_series[''] = None
-    sample_selection_series[costs_for_response+':'] = None
 
-    # Removing zero and negative
-    data,sample_selection_series = removing_zero_and_negative_ratios(var_log,data,sample_selection_series)
+def antall_bytes(value):
+    if isinstance(value,(tuple,list)):
+        return int(np.sum([antall_bytes(v) for v in value]))
+    if isinstance(value,pd.DataFrame):
+        return int(value.memory_usage(index=False).sum())
+    if isinstance(value,(pd.Series,np.ndarray)):
+        return int(value.nbytes)
+    return 0
 
-    # Adding final sample size and merging with table
-    sample_selection_series['Endelig utvalg for analyser'] = thousand_seperator(data.shape[0])
-    sample_selection_table['Modell ({})'.format(file_name)] = sample_selection_series
 
-    return data,sample_selection_table
\ No newline at end of file
+class Mellomlager:
+    # Mellomlager (cache) for analysene i "analysere.py". Utvalg (sample
+    # selection), variabler for regresjonene og dummyvariabler for de faste
+    # effektene beregnes én gang og gjenbrukes på tvers av modeller og
+    # kostnader (Driftskostnader/Varekostnader):
+    #   - Variabler i variabeldefinisjoner beregnes for alle rader i data_all
+    #     første gang de brukes, og hentes deretter for radene i utvalget.
+    #     En definisjon er en funksjon som får en funksjon k, der k(navn)
+    #     gir en kolonne i data_all eller en annen definert variabel.
+    #   - Utvalg lages fra masker som beregnes én gang per kriterium (se
+    #     Utvalgsmasker), og lagres med nøkkel (kostnad, num_prev, var_log).
+    #   - Designmatriser lagres med nøkkel (utvalg, variabler, faste effekter).
+    #   - Med panel (se Panel i "funksjoner_panel.py") lages variabler fra
+    #     tidligere år som ikke finnes i data_all (f.eks. 'Salg_prev_prev_prev')
+    #     første gang de brukes, og lagres som de andre variablene.
+    # Når mellomlageret bruker mer enn max_bytes, fjernes det som er brukt
+    # minst nylig. data_all må ha indeks 0,...,n-1.
+    # Med modellager (se Modellager) hentes resultatene for modeller som er
+    # estimert i en tidligere kjøring fra disk.
+    def __init__(self,data_all,variabeldefinisjoner,max_bytes=2*1024**3,modellager=None,panel=None):
+        self.data_all = data_all
+        self.modellager = modellager
+        self.panel = panel
+        self.variabeldefinisjoner = variabeldefinisjoner
+        self.max_bytes = max_bytes
+        self.lager = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # Maskene for kriteriene i utvalget (se Utvalgsmasker)
+        self.masker = Utvalgsmasker(data_all,self.kolonne)
+
+    def hent(self,key,fun):
+        with self.lock:
+            if key in self.lager:
+                self.lager.move_to_end(key)
+                self.hits += 1
+                return self.lager[key]
+            self.misses += 1
+        value = fun()
+        with self.lock:
+            if key not in self.lager:
+                self.lager[key] = value
+                self.bytes += antall_bytes(value)
+            while (self.bytes > self.max_bytes) & (len(self.lager) > 1):
+                key_removed,value_removed = self.lager.popitem(last=False)
+                self.bytes -= antall_bytes(value_removed)
+        return value
+
+    def kolonne(self,name):
+        if name in self.data_all.columns:
+            return self.data_all[name].to_numpy()
+        if name not in self.variabeldefinisjoner:
+            if self.panel is None:
+                raise Exception("Feil: finner ikke variabelen '{}' i data_all eller variabeldefinisjonene".format(name))
+            def lag_lagget():
+                with maaling.steg('Variabel fra tidligere år ({})'.format(name),self.data_all.shape[0]):
+                    return self.panel.lag(name)
+            return self.hent(('kolonne',name),lag_lagget)
+        fun = self.variabeldefinisjoner[name]
+        def lag_kolonne():
+            with np.errstate(all='ignore'): # log av ikke-positive verdier fjernes i utvalget
+                return np.asarray(fun(self.kolonne),dtype=np.float64)
+        return self.hent(('kolonne',name),lag_kolonne)
+
+    def sample_selection(self,num_prev,var_log,file_name,sample_selection_table,costs_for_response):
+        key = ('utvalg',costs_for_response,num_prev,tuple(var_log))
+        def lag_utvalg():
+            with maaling.steg('Utvalg (Modell {}) {}'.format(file_name,costs_for_response)) as steg:
+                rows,sample_selection_series = self.masker.utvalg(num_prev,var_log,costs_for_response)
+                steg['rader'] = len(rows)
+            return rows,sample_selection_series
+        rows,sample_selection_series = self.hent(key,lag_utvalg)
+
+        sample_selection_table['Modell ({})'.format(file_name)] = sample_selection_series
+        data = self.data_all.iloc[rows]
+        data.attrs['utvalg_key'] = key
+        return data,sample_selection_table
+
+    def fe_dummies(self,data,column,prefix):
+        key = ('fe',data.attrs['utvalg_key'],column,prefix)
+        def lag_dummies():
+            if column == 'regnaar':
+                values = self.data_all[column].astype(int)
+            else:
+                values = self.data_all[column].astype(object)
+            codes,levels = self.hent(('fe_koder',column),lambda: pd.factorize(values,sort=True))
+            codes = codes[data.index.to_numpy()]
+            # Kategoriene i utvalget, unntatt den siste (som pd.get_dummies)
+            present = np.flatnonzero(np.bincount(codes[codes>=0],minlength=len(levels))>0)[:-1]
+            dummies = codes[:,None]==present[None,:]
+            return pd.DataFrame(dummies,index=data.index,columns=[prefix+str(levels[i]) for i in present])
+        return self.hent(key,lag_dummies)
+
+    def design(self,var,data,fe_columns=()):
+        key = ('design',data.attrs['utvalg_key'],tuple(var),tuple(fe_columns))
+        def lag_design():
+            with maaling.steg('Designmatrise',data.shape[0]):
+                rows = data.index.to_numpy()
+                y = pd.Series(self.kolonne(var[0])[rows],index=data.index,name=var[0])
+                X = pd.DataFrame({v: self.kolonne(v)[rows] for v in var[1:]},index=data.index)
+                for column,prefix in fe_columns:
+                    X = pd.concat([X,self.fe_dummies(data,column,prefix)],axis=1)
+            return y,X
+        return self.hent(key,lag_design)
+
+    def utvalg_hash(self,data):
+        # Hash av firma-årene (orgnr, regnaar) i utvalget
+        def lag_hash():
+            rows = data.index.to_numpy()
+            sha256 = hashlib.sha256(np.ascontiguousarray(self.data_all['orgnr'].to_numpy()[rows]).tobytes())
+            sha256.update(np.ascontiguousarray(self.data_all['regnaar'].to_numpy()[rows]).tobytes())
+            return sha256.hexdigest()
+        return self.hent(('utvalg_hash',data.attrs['utvalg_key']),lag_hash)
+
+    def variabel_hash(self,name):
+        # Hash av definisjonen av variabelen og variablene den bygger på.
+        # Kolonner i data_all og variabler fra tidligere år (se Panel) er
+        # dekket av dataversjonen (se Modellager).
+        if name not in self.variabeldefinisjoner:
+            return name
+        fun = self.variabeldefinisjoner[name]
+        navn = [c for c in fun.__code__.co_consts if isinstance(c,str)]
+        for cell in fun.__closure__ or []:
+            # Navnene i closure, f.eks. i produkt('DlnSalg','EINT')
+            values = cell.cell_contents if isinstance(cell.cell_contents,(tuple,list)) else [cell.cell_contents]
+            navn += [c for c in values if isinstance(c,str)]
+        avhengige = [self.variabel_hash(c) for c in navn if (c in self.variabeldefinisjoner) and (c != name)]
+        return hashlib.sha256(repr((name,kode_hash(fun),avhengige)).encode()).hexdigest()
+
+    def modell_nokkel(self,var,data,**spec):
+        # Nøkkelen til modellen i modellageret
+        return self.modellager.nokkel(self.utvalg_hash(data),[self.variabel_hash(v) for v in var],sorted(spec.items()))
+
+
+
+##################################################################
+##  Modellager: resultater fra tidligere kjøringer på disk
+##################################################################
+def dataversjon(folder_name='../data_behandlet',data_format='parquet'):
+    # Versjonen av data_behandlet: navn, størrelse og endringstidspunkt for
+    # filene som leses i les_data_behandlet(). Endres hver gang data lagres.
+    if data_format == 'csv':
+        file_paths = [csv_behandlet_path(folder_name,k) for k in csv_komprimering]
+    else:
+        parquet_folder = os.path.join(folder_name,'data_behandlet_parquet')
+        file_paths = []
+        for root,dirs,files in os.walk(parquet_folder):
+            file_paths += [os.path.join(root,f) for f in files if not f.startswith('.')]
+    sha256 = hashlib.sha256(data_format.encode())
+    for file_path in sorted(p for p in file_paths if os.path.exists(p)):
+        stat = os.stat(file_path)
+        sha256.update('{};{};{}\n'.format(os.path.relpath(file_path,folder_name),stat.st_size,stat.st_mtime_ns).encode())
+    return sha256.hexdigest()
+
+
+def kode_hash(fun):
+    # Hash av koden til en funksjon (f.eks. en lambda i variabeldefinisjoner),
+    # uavhengig av linjenummer. Verdiene i closure (f.eks. kostnaden i 
+    # 'lnCost_{cost}') tas med, og koden til funksjonene den kaller (f.eks.
+    # terskelklasse()) og funksjoner i closure tas med på samme måte.
+    sha256 = hashlib.sha256()
+    funksjoner = set()
+    def legg_til_funksjon(fun):
+        if fun in funksjoner:
+            return
+        funksjoner.add(fun)
+        legg_til(fun.__code__,fun.__globals__)
+        for cell in fun.__closure__ or []:
+            if isinstance(cell.cell_contents,types.FunctionType):
+                legg_til_funksjon(cell.cell_contents)
+            else:
+                sha256.update(repr(cell.cell_contents).encode())
+    def legg_til(code,globale):
+        sha256.update(code.co_code)
+        sha256.update(repr(code.co_names).encode())
+        for name in code.co_names:
+            if isinstance(globale.get(name),types.FunctionType):
+                legg_til_funksjon(globale[name])
+        for c in code.co_consts:
+            if hasattr(c,'co_code'):
+                legg_til(c,globale)
+            else:
+                sha256.update(repr(c).encode())
+    legg_til_funksjon(fun)
+    return sha256.hexdigest()
+
+
+# Hash av koden for estimeringen (se Modellager). Beregnes første gang den brukes.
+_kodeversjon = None
+
+def kodeversjon():
+    global _kodeversjon
+    if _kodeversjon is None:
+        import inspect
+        import importlib.metadata
+        import funksjoner_estimering
+        import funksjoner_panel
+        sha256 = hashlib.sha256()
+        for fun in [estimer_modell_tall,model_preparing,fe_dummies,Mellomlager.design,Mellomlager.fe_dummies]:
+            sha256.update(inspect.getsource(fun).encode())
+        for module in [funksjoner_estimering,funksjoner_panel]:
+            with open(module.__file__,'rb') as f:
+                sha256.update(f.read())
+        for package in ['statsmodels','pandas','numpy']:
+            sha256.update(importlib.metadata.version(package).encode())
+        _kodeversjon = sha256.hexdigest()
+    return _kodeversjon
+
+
+class Modellager:
+    # Lagrer resultatene fra estimer_modell_tall() (koeffisienter, p-verdier,
+    # kovariansmatrise, antall observasjoner, R2, osv.) på disk som
+    # folder_name/<nøkkel>.pkl, slik at modeller som ikke er endret hentes
+    # fra en tidligere kjøring i stedet for å estimeres på nytt. Nøkkelen er
+    # en hash av dataversjonen (se dataversjon()), radene i utvalget, 
+    # variablene (navn og definisjon), spesifikasjonen (engine, cluster, 
+    # faste effekter, bootstrap, osv.) og koden for estimeringen (se 
+    # Mellomlager.modell_nokkel()). Når filene til sammen er større enn 
+    # max_bytes, slettes de som er brukt minst nylig.
+    def __init__(self,folder_name,data_versjon,max_bytes=512*1024**2):
+        self.folder_name = folder_name
+        self.data_versjon = data_versjon
+        self.max_bytes = max_bytes
+        os.makedirs(folder_name,exist_ok=True)
+
+    def nokkel(self,*deler):
+        return hashlib.sha256(repr((self.data_versjon,kodeversjon())+deler).encode()).hexdigest()
+
+    def file_path(self,key):
+        return os.path.join(self.folder_name,key+'.pkl')
+
+    def hent(self,key):
+        # Resultatet for nøkkelen, eller None om det ikke finnes. Filer som
+        # ikke kan leses (ødelagt fil, eller lagret med en annen versjon av 
+        # pandas, numpy eller koden) slettes, og modellen estimeres på nytt.
+        try:
+            with open(self.file_path(key),'rb') as f:
+                resultat = pickle.load(f)
+            os.utime(self.file_path(key)) # Sist brukt
+        except FileNotFoundError:
+            return None
+        except Exception:
+            try:
+                os.remove(self.file_path(key))
+            except OSError:
+                pass
+            return None
+        return resultat
+
+    def lagre(self,key,resultat):
+        def skriv(file_path):
+            with open(file_path,'wb') as f:
+                pickle.dump(resultat,f,protocol=pickle.HIGHEST_PROTOCOL)
+        skriv_atomisk(self.file_path(key),skriv,varig=False)
+        self.rydd()
+
+    def rydd(self):
+        # Sletter filene som er brukt minst nylig til størrelsen er under max_bytes
+        files = []
+        for f in os.listdir(self.folder_name):
+            if f.endswith('.pkl') and not f.startswith('.'):
+                try:
+                    stat = os.stat(os.path.join(self.folder_name,f))
+                except OSError:
+                    continue
+                files.append((stat.st_mtime,stat.st_size,f))
+        total = sum(size for mtime,size,f in files)
+        for mtime,size,f in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.folder_name,f))
+            except OSError:
+                pass
+            total -= size
+
+    def storrelse(self):
+        files = [f for f in os.listdir(self.folder_name) if f.endswith('.pkl') and not f.startswith('.')]
+        return len(files),sum(os.path.getsize(os.path.join(self.folder_name,f)) for f in files)
+
+
+##################################################################
+##  Kjøring av alle modeller (modell x kostnad x spesifikasjon)
+##################################################################
+def fyll_inn_kostnad(liste,costs_for_response):
+    # 'lnCost_{cost}' -> 'lnCost_Varekostnader', osv.
+    return [v.format(cost=costs_for_response) for v in liste]
+
+
+# Mellomlageret som arbeidsprosessene i kjor_modeller() bruker. Det settes
+# før prosessene startes, slik at de deler data med hovedprosessen (fork).
+_mellomlager_batch = None
+
+def _kjor_modell(jobb):
+    # Stegene i maaling returneres til hovedprosessen
+    costs_for_response,modell,spec = jobb
+    var = fyll_inn_kostnad(modell['var'],costs_for_response)
+    var_log = fyll_inn_kostnad(modell['var_log'],costs_for_response)
+    with maaling.samle() as records:
+        data,temp_table = _mellomlager_batch.sample_selection(
+            modell['num_prev'],var_log,modell['file_name'],pd.DataFrame(),costs_for_response)
+        resultat = estimer_modell_tall(var,data,modell['file_name'],mellomlager=_mellomlager_batch,**spec)
+    for record in records:
+        if not record['steg'].endswith(costs_for_response):
+            record['steg'] = record['steg']+' '+costs_for_response
+    return resultat,temp_table.iloc[:,0],records
+
+
+def forbered_modeller(modeller,costs_for_response_list,spesifikasjoner,mellomlager):
+    # Jobbene for kjor_modeller(): alle kombinasjoner av modell (se 'modeller'
+    # i "analysere.py"), kostnad og spesifikasjon (argumenter til 
+    # estimer_modell()), som ((kostnad, spesifikasjon), jobb). Utvalg og 
+    # variabler beregnes her i hovedprosessen, og dette må skje før 
+    # arbeidsprosessene startes (fork), slik at de arver mellomlageret.
+    global _mellomlager_batch
+    _mellomlager_batch = mellomlager
+
+    jobber = []
+    for costs_for_response in costs_for_response_list:
+        for spec_name,spec in spesifikasjoner.items():
+            for modell in modeller:
+                jobber.append(((costs_for_response,spec_name),(costs_for_response,modell,spec)))
+
+    for key,(costs_for_response,modell,spec) in jobber:
+        data,temp_table = mellomlager.sample_selection(modell['num_prev'],
+            fyll_inn_kostnad(modell['var_log'],costs_for_response),
+            modell['file_name'],pd.DataFrame(),costs_for_response)
+        for v in fyll_inn_kostnad(modell['var'],costs_for_response):
+            mellomlager.kolonne(v)
+        if mellomlager.modellager is not None:
+            mellomlager.utvalg_hash(data)
+    return jobber
+
+
+def kjor_modeller(jobber,executor=None,ved_modell=None):
+    # Estimerer jobbene fra forbered_modeller(), parallelt i executor (se
+    # start_executor() i "funksjoner_behandling.py") eller etter hverandre
+    # med executor=None. Returnerer en dict med (kostnad, spesifikasjon) ->
+    # (results_df, sample_selection_table).
+    # ved_modell(kostnad, spesifikasjon, results_df, sample_selection_table)
+    # kalles hver gang en modell er ferdig, med tabellene for modellene som
+    # er ferdige så langt, f.eks. for å lagre resultatene med en gang.
+    keys = [key for key,jobb in jobber]
+    jobs = [jobb for key,jobb in jobber]
+
+    results = [None]*len(jobs)
+
+    def tabeller(key):
+        # Formaterer de ferdige modellene for (kostnad, spesifikasjon) på én gang
+        resultater_spec = []
+        sample_selection_table = pd.DataFrame()
+        for i in range(len(jobs)):
+            if (keys[i] != key) or (results[i] is None):
+                continue
+            resultat,sample_selection_series,records = results[i]
+            resultater_spec.append(resultat)
+            sample_selection_table['Modell ({})'.format(jobs[i][1]['file_name'])] = sample_selection_series
+        return formater_resultater(resultater_spec),sample_selection_table
+
+    def ferdig(i,result):
+        results[i] = result
+        maaling.legg_til(result[2])
+        if ved_modell is not None:
+            ved_modell(*keys[i],*tabeller(keys[i]))
+
+    if executor is not None:
+        futures = {executor.submit(_kjor_modell,jobb): i for i,jobb in enumerate(jobs)}
+        for future in as_completed(futures):
+            ferdig(futures[future],future.result())
+    else:
+        for i,jobb in enumerate(jobs):
+            ferdig(i,_kjor_modell(jobb))
+
+    return {key: tabeller(key) for key in dict.fromkeys(keys)}
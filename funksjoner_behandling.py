@@ -0,0 +1,904 @@
+import numpy as np
+import pandas as pd
+
+import os
+import time
+import json
+import hashlib
+import threading
+from collections import deque
+from contextlib import nullcontext
+
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from funksjoner_maaling import maaling, peak_memory_mb
+from funksjoner_validering import validering, sjekk_unike, sjekk_avslutningsdato, sjekk_belop, sjekk_makroserier
+
+# Kolonner fra årsregnskapsfilene i 'data4' som blir benyttet i
+# "behandle_data_og_lag_variabler.py", med datatype som settes ved innlasting
+kolonner_kategori = [
+    'naeringskoder_level_1',
+    'orgform',
+]
+kolonner_regnskapstall = [
+    'Salgsinntekt',
+    'Sum inntekter',
+    'Driftsresultat',
+    'Varekostnad',
+    'Endring i beholdning av varer under tilvirkning og ferdig tilvirkede varer',
+    'SUM EIENDELER',
+    'Loennskostnad',
+    'Varer',
+    'Sum varer',
+    'Biologiske eiendeler',
+    'Sum fordringer',
+    'Kundefordringer',
+    'Leverandoergjeld',
+    'sum_eiendeler_EUR',
+    'sum_omsetning_EUR',
+]
+
+def dtypes_aarsregnskap(amounts_float32=False):
+    dtypes = {
+        'orgnr': 'int32',
+        'regnaar': 'int16',
+        'avslutningsdato': 'object',
+    }
+    for c in kolonner_kategori:
+        dtypes[c] = 'category'
+    for c in kolonner_regnskapstall:
+        dtypes[c] = 'float32' if amounts_float32 else 'float64'
+    return dtypes
+
+
+##################################################################
+##  Datatyper for data_behandlet
+##################################################################
+# Kolonner i data_behandlet med fast datatype. Regnskapstallene er float64,
+# eller float32 med amounts_float32 = True. Variabler fra tidligere 
+# regnskapsår ('Salg_prev', osv.) får samme datatype som kolonnen de er 
+# laget fra, med NaN for manglende verdier.
+dtypes_behandlet = {
+    'orgnr': 'int32', # organisasjonsnummer har 9 siffer
+    'regnaar': 'int16',
+    'Bransje': 'category',
+    'orgform': 'category',
+    'bnp': 'float64',
+    'bnp_prev': 'float64',
+}
+kolonner_belop = [
+    'Salg',
+    'Driftskostnader',
+    'Varekostnader',
+    'Eiendeler',
+    'Lonnskostnader',
+    'Leverandorgjeld',
+    'Varelager',
+    'Kundefordringer',
+    'Salg_ikke_deflatert',
+    'Lonnskostnader_ikke_deflatert',
+    'Eiendeler_ikke_deflatert',
+    'sum_eiendeler_EUR',
+    'sum_omsetning_EUR',
+]
+
+
+def dtype_behandlet(column,amounts_float32=False):
+    # Datatypen til en kolonne i data_behandlet. Med amounts_float32=None 
+    # godtas både float32 og float64 for regnskapstallene. None betyr at
+    # kolonnen ikke har fast datatype.
+    if column in dtypes_behandlet:
+        return dtypes_behandlet[column]
+    while column.endswith('_prev') and (column not in kolonner_belop):
+        column = column[:-len('_prev')]
+    if column in kolonner_belop:
+        if amounts_float32 is None:
+            return ('float32','float64')
+        return 'float32' if amounts_float32 else 'float64'
+    return None
+
+
+def sjekk_schema(data,amounts_float32=None):
+    # Sjekker at kolonnene i data har datatypene i dtype_behandlet()
+    feil = []
+    for column in data.columns:
+        dtype = dtype_behandlet(column,amounts_float32)
+        if dtype is None:
+            continue
+        if str(data[column].dtype) not in np.atleast_1d(dtype):
+            feil.append('{} er {} (forventet {})'.format(column,data[column].dtype,' eller '.join(np.atleast_1d(dtype))))
+    if len(feil) > 0:
+        raise Exception("Feil: datatypene i data_behandlet er ikke som forventet: "+', '.join(feil))
+    return data
+
+
+def bruk_schema(data,amounts_float32=False):
+    # Gjør om kolonnene i data til datatypene i dtype_behandlet(), og 
+    # sjekker at heltallene ikke blir endret av konverteringen
+    for column in data.columns:
+        dtype = dtype_behandlet(column,amounts_float32)
+        if (dtype is None) or isinstance(dtype,tuple) or (str(data[column].dtype) == dtype):
+            continue
+        if dtype.startswith('int'):
+            values = data[column].to_numpy()
+            if pd.isnull(values).any():
+                raise Exception("Feil: {} har manglende verdier".format(column))
+            info = np.iinfo(dtype)
+            if (values.min() < info.min) | (values.max() > info.max):
+                raise Exception("Feil: {} har verdier utenfor {}".format(column,dtype))
+        data[column] = data[column].astype(dtype)
+    return sjekk_schema(data,amounts_float32)
+
+
+def concat_med_kategorier(data_list):
+    # pd.concat gjør kategoriske kolonner om til object dersom kategoriene
+    # er ulike, så vi slår sammen kategoriene før vi setter sammen
+    data_list = [d for d in data_list if d.shape[1]>0]
+    if len(data_list) == 0:
+        return pd.DataFrame()
+    for c in data_list[0].columns:
+        if isinstance(data_list[0][c].dtype, pd.CategoricalDtype):
+            categories = pd.api.types.union_categoricals(
+                [d[c] for d in data_list], ignore_order=True).categories
+            for d in data_list:
+                d[c] = d[c].cat.set_categories(categories)
+    return pd.concat(data_list, ignore_index=True)
+
+
+def read_aarsregnskap(file_path,regnaar_max=2021,amounts_float32=False,chunksize=None):
+    dtypes = dtypes_aarsregnskap(amounts_float32)
+
+    # Ikke alle årsfilene har alle regnskapstallene. Leser derfor kun
+    # overskriftene først, og legger til manglende regnskapstall som NaN
+    kolonner_fil = set(pd.read_csv(file_path,sep=';',nrows=0).columns)
+    kolonner_mangler = [c for c in kolonner_regnskapstall if c not in kolonner_fil]
+    dtypes = {c: dtypes[c] for c in dtypes if c not in kolonner_mangler}
+
+    reader = pd.read_csv(file_path,
+        sep=';',
+        usecols=list(dtypes.keys()),
+        dtype=dtypes,
+        chunksize=chunksize,
+        )
+    if chunksize is None:
+        reader = [reader]
+
+    # Tar kun med regnskapsår <= regnaar_max allerede ved innlesing
+    data_list = []
+    for chunk in reader:
+        data_list.append(chunk[chunk['regnaar']<=regnaar_max])
+    data = concat_med_kategorier(data_list)
+    for c in kolonner_mangler:
+        data[c] = np.full(len(data), np.nan, dtype='float32' if amounts_float32 else 'float64')
+    return data
+
+
+def read_KPI(file_path):
+    # Konsumprisindeks per måned, med indeks på formen 201512
+    CPI_data = pd.read_csv(file_path,
+        sep=';',
+        skiprows=2
+        )
+    CPI_data.index.name = None
+    del CPI_data['consumption group']
+    CPI_data.rename(columns = {'Consumer Price Index (2015=100)':'CPI'}, inplace = True)
+
+    CPI_data['month'] = CPI_data['month'].str.replace('M','',regex=False).astype(int)
+    CPI_data = CPI_data.set_index('month')
+    CPI_data.index.name = None
+    return CPI_data['CPI']
+
+
+def lag_variabler(data):
+    # Argumentasjon for .fillna(0):
+    # "There are no missing values for the financial information in Appendix A. If a value is missing in 
+    # the dataset for any of the items listed in Appendix A, it indicates that no value was provided when 
+    # the financial statement was reported, that is, the value is zero."
+    # Wahlstrøm, R. R. (2022). Financial statements of companies in Norway. arXiv:2203.12842. https://doi.org/10.48550/arXiv.2203.12842
+
+    # Salg
+    data['Salg']   = data['Salgsinntekt'].fillna(0)
+
+    # Driftskostnader
+    data['Driftskostnader'] = data['Sum inntekter'].fillna(0)-data['Driftsresultat'].fillna(0)
+
+    # Varekostnader
+    data['Varekostnader']  =\
+        data['Varekostnad'].fillna(0)+\
+        data['Endring i beholdning av varer under tilvirkning og ferdig tilvirkede varer'].fillna(0)
+
+    # Eiendeler
+    data['Eiendeler']   = data['SUM EIENDELER'].fillna(0)
+
+    # Lønnskostnader
+    data['Lonnskostnader'] = data['Loennskostnad'].fillna(0)
+
+    # Bransje
+    data = data.rename(columns={
+        'naeringskoder_level_1': 'Bransje',
+        })
+
+    # Varelager
+    inventories = data['Varer'].copy()
+    ind = pd.isnull(inventories)
+    inventories.loc[ind] = data['Sum varer'].loc[ind]
+    data['Varelager']         = inventories.fillna(0) + data['Biologiske eiendeler'].fillna(0)
+
+    # Kundefordringer
+    kundefordringer = data['Sum fordringer'].copy()
+    ind = pd.isnull(kundefordringer)
+    kundefordringer.loc[ind] = data['Kundefordringer'].loc[ind]
+    data['Kundefordringer'] = kundefordringer.fillna(0)
+
+    # Leverandørgjeld
+    data['Leverandorgjeld']        = data['Leverandoergjeld'].fillna(0)
+
+    # Omsetning og eiendeler i EUR
+    data['sum_eiendeler_EUR'] = data['sum_eiendeler_EUR'].fillna(0)
+    data['sum_omsetning_EUR'] = data['sum_omsetning_EUR'].fillna(0)
+
+    return data
+
+
+# Regnskapstall som blir deflatert med konsumprisindeksen
+columns_to_deflate = [
+    'Salg',
+    'Driftskostnader',
+    'Varekostnader',
+    'Eiendeler',
+    'Lonnskostnader',
+    'Leverandorgjeld',
+    'Varelager',
+    'Kundefordringer',
+]
+
+def read_BNP(file_path):
+    # Bruttonasjonalprodukt per år
+    bnp_data    = pd.read_csv(file_path,sep=';')
+    bnp_data.columns = bnp_data.columns.astype(int)
+    return bnp_data.T[0]
+
+
+def avslutningsmaaned(avslutningsdato):
+    # Avslutningsdato '2019-12-31' -> 201912. Det er få unike datoer, så vi 
+    # gjør strengoperasjonene kun på de unike verdiene.
+    codes,uniques = pd.factorize(avslutningsdato)
+    if (codes<0).any():
+        raise Exception("Feil: mangler avslutningsdato for {} rader".format(np.sum(codes<0)))
+    maaned = pd.Series(uniques).astype(str).str.slice(0,7).str.replace('-','',regex=False).astype(int)
+    return maaned.to_numpy()[codes]
+
+
+def hent_serie(serie,keys,serie_name=''):
+    # Slår opp verdier i en serie (f.eks. KPI eller BNP) for alle rader ved 
+    # hjelp av indeksposisjoner. keys er én array, eller en liste med arrays 
+    # dersom serien har MultiIndex (f.eks. (Bransje, regnaar)).
+    if isinstance(keys,list):
+        keys = pd.MultiIndex.from_arrays(keys)
+    pos = serie.index.get_indexer(keys)
+    if (pos<0).any():
+        missing = pd.unique(np.asarray(keys,dtype=object)[pos<0])
+        raise Exception("Feil: {} mangler verdier for {} rader, f.eks. {}".format(
+            serie_name,np.sum(pos<0),list(missing[:5])))
+    return np.take(serie.to_numpy(dtype=np.float64),pos)
+
+
+def koble_makroserier(data,makroserier,ind=None):
+    # Legger til makroserier som float-kolonner. makroserier er en dict med
+    # kolonnenavn -> (serie, nøkkelkolonne(r), forskyvning), der forskyvning
+    # legges til (den siste) nøkkelen, f.eks. -1 for fjorårets verdi. Rader 
+    # utenfor ind får manglende verdi.
+    if ind is None:
+        ind = np.ones(data.shape[0],dtype=bool)
+    ind = np.asarray(ind)
+    for name,(serie,key_columns,offset) in makroserier.items():
+        if isinstance(key_columns,list):
+            keys = [data[c].to_numpy()[ind] for c in key_columns]
+            keys[-1] = keys[-1]+offset
+        else:
+            keys = data[key_columns].to_numpy()[ind]+offset
+        values = np.full(data.shape[0],np.nan)
+        values[ind] = hent_serie(serie,keys,name)
+        data[name] = values
+    return data
+
+
+def deflater(data,CPI_data,columns=columns_to_deflate):
+    # Avslutningsdato = Balansedato og sluttdato for regnskapets regnskapsår
+    data_avslutningsmaaned = avslutningsmaaned(data['avslutningsdato'])
+
+    data['Salg_ikke_deflatert']           = data['Salg']
+    data['Lonnskostnader_ikke_deflatert'] = data['Lonnskostnader']
+    data['Eiendeler_ikke_deflatert']      = data['Eiendeler']
+    CPIs = hent_serie(CPI_data,data_avslutningsmaaned,'CPI')
+    for c in columns:
+        data[c] = data[c] / CPIs
+    return data
+
+
+def behandle_aarsregnskap(file_path,regnaar_max=2021,amounts_float32=False,chunksize=None,CPI_data=None):
+    # Leser én årsfil og lager variabler for den. Kjøres i egen prosess
+    # eller tråd når årsfilene leses parallelt.
+    # Stegene registreres i maaling, og resultatene av sjekkene i 
+    # validering, og begge returneres til hovedprosessen. Dersom en alvorlig
+    # sjekk feiler, stopper behandlingen med en gang.
+    start = time.perf_counter()
+    name = os.path.basename(file_path)
+    with maaling.samle() as records, validering.samle() as kontroller:
+        with maaling.steg('Lesing ({})'.format(name)) as steg:
+            data = read_aarsregnskap(file_path,regnaar_max,amounts_float32,chunksize)
+            steg['rader'] = data.shape[0]
+        with maaling.steg('Validering ({})'.format(name),data.shape[0]):
+            validering.valider('Årsfil {}'.format(name),sjekk_unike(data)+sjekk_avslutningsdato(data,CPI_data),data.shape[0])
+        if CPI_data is not None:
+            with maaling.steg('Variabler ({})'.format(name),data.shape[0]):
+                data = lag_variabler(data)
+            with maaling.steg('Deflatering med KPI ({})'.format(name),data.shape[0]):
+                data = deflater(data,CPI_data)
+            with maaling.steg('Validering av regnskapstall ({})'.format(name),data.shape[0]):
+                validering.valider('Regnskapstall {}'.format(name),sjekk_belop(data),data.shape[0])
+    seconds = time.perf_counter()-start
+    return data,seconds,peak_memory_mb(),records,kontroller
+
+
+def executor_for(num_workers,parallel_backend='process'):
+    if parallel_backend == 'process':
+        # Skriptene har ingen "if __name__ == '__main__'"-blokk, så prosesser
+        # startet med 'spawn' ville kjørt hele skriptet på nytt. Vi bruker
+        # derfor 'fork' der det finnes, og ellers tråder.
+        if 'fork' in mp.get_all_start_methods():
+            return ProcessPoolExecutor(num_workers,mp_context=mp.get_context('fork'))
+    elif parallel_backend != 'thread':
+        raise Exception("Feil: parallel_backend må være 'process' eller 'thread'")
+    return ThreadPoolExecutor(num_workers)
+
+
+def start_executor(num_workers,parallel_backend='process'):
+    # Som executor_for(), men prosessene startes med en gang. Med 'fork'
+    # startes alle prosessene ved første jobb, og det bør skje før andre 
+    # tråder (f.eks. i Skriver) startes.
+    executor = executor_for(num_workers,parallel_backend)
+    executor.submit(int).result()
+    return executor
+
+
+def load_aarsregnskaper(folder_name,regnaar_max=2021,amounts_float32=False,chunksize=None,
+                        CPI_data=None,num_workers=1,parallel_backend='process',files=None):
+    # Dersom CPI_data er gitt blir variablene laget og deflatert for hver fil
+    # før filene settes sammen. Med num_workers>1 blir filene behandlet
+    # parallelt; rekkefølgen på filene, og dermed resultatet, er den samme.
+    # files angir hvilke filer i folder_name som skal leses (standard: alle).
+    # Regnskapsårene i hver fil lagres i data.attrs['regnaar_per_fil'].
+    if files is None:
+        files = os.listdir(folder_name)
+    args = [(folder_name+f,regnaar_max,amounts_float32,chunksize,CPI_data) for f in files]
+    if num_workers > 1:
+        with executor_for(num_workers,parallel_backend) as executor:
+            results = executor.map(behandle_aarsregnskap,*zip(*args))
+            results = list(results)
+    else:
+        results = map(lambda a: behandle_aarsregnskap(*a),args)
+
+    data_list = []
+    regnaar_per_fil = {}
+    for current_file,(data_loaded,seconds,peak_memory,records,kontroller) in zip(files,results):
+        maaling.legg_til(records)
+        validering.legg_til(kontroller)
+        file_year = int(current_file[0:4])
+        data_list.append(data_loaded)
+        regnaar_per_fil[current_file] = [int(r) for r in np.unique(data_loaded['regnaar'])]
+        print('Imported for accounting year {} ({:,} rows, {:,.0f} rows/sec, peak memory {:,.0f} MB)'.format(
+            file_year,
+            data_loaded.shape[0],
+            data_loaded.shape[0]/max(seconds,1e-9),
+            peak_memory,
+            ))
+
+    # Setter sammen alle år kun én gang
+    data = concat_med_kategorier(data_list)
+    data.attrs['regnaar_per_fil'] = regnaar_per_fil
+    print('Peak memory after loading: {:,.0f} MB'.format(peak_memory_mb()))
+    return data
+
+
+def lag_suffix(lag):
+    # 1 -> '_prev', 2 -> '_prev_prev', osv.
+    return '_prev'*lag
+
+
+def lag_lagget_variabler(data,columns_lags):
+    # Lager variabler fra tidligere regnskapsår for alle rader i én omgang.
+    # columns_lags angir hvilke kolonner som skal laget for hvert antall år
+    # tilbake i tid, f.eks. {1: ['Salg','Varelager'], 2: ['Salg']}.
+    #
+    # Data sorteres på (orgnr, regnaar). Når firma-år er unike, ligger 
+    # regnskapsåret k år tilbake i tid for samme foretak (dersom det finnes) 
+    # mellom 1 og k rader foran i sortert rekkefølge. Vi sjekker derfor 
+    # forskyvningene 1,...,k og krever at regnskapsåret er nøyaktig k år 
+    # tidligere, slik at hull i tidsserien gir manglende verdi.
+    orgnr = data['orgnr'].to_numpy()
+    regnaar = data['regnaar'].to_numpy().astype(np.int64)
+    order = np.lexsort((regnaar,orgnr))
+    orgnr_sorted = orgnr[order]
+    regnaar_sorted = regnaar[order]
+    num_rows = len(order)
+
+    duplicated = (orgnr_sorted[1:]==orgnr_sorted[:-1]) & (regnaar_sorted[1:]==regnaar_sorted[:-1])
+    if duplicated.any():
+        raise Exception("Feil: ikke alle firma-år er unike ({} duplikater)".format(np.sum(duplicated)))
+
+    data_lags = pd.DataFrame(index=data.index)
+    for lag,columns in columns_lags.items():
+        # Posisjon (i sortert rekkefølge) til raden lag år tilbake i tid, -1 om den mangler
+        pos = np.full(num_rows,-1,dtype=np.int64)
+        for shift in range(1,lag+1):
+            match = (orgnr_sorted[shift:]==orgnr_sorted[:-shift]) &\
+                (regnaar_sorted[shift:]-regnaar_sorted[:-shift]==lag)
+            pos[shift:][match] = np.flatnonzero(match)
+        found = pos>=0
+
+        for c in columns:
+            values_sorted = data[c].to_numpy(dtype=np.float64)[order]
+            lagged_sorted = np.full(num_rows,np.nan)
+            lagged_sorted[found] = values_sorted[pos[found]]
+            lagged = np.empty(num_rows)
+            lagged[order] = lagged_sorted
+            data_lags[c+lag_suffix(lag)] = lagged
+    return data_lags
+
+
+##################################################################
+##  Skriving av filer i bakgrunnen
+##################################################################
+# Komprimering av CSV-filen med behandlet data, og filendelsen den gir.
+# Delene av filen legges til etter hverandre, og formatene under tåler det.
+csv_komprimering = {
+    None:   '',
+    'gzip': '.gz',
+    'bz2':  '.bz2',
+    'xz':   '.xz',
+    'zstd': '.zst',
+}
+
+def csv_behandlet_path(folder_name,komprimering=None):
+    if komprimering not in csv_komprimering:
+        raise Exception("Feil: komprimeringen av CSV må være en av {}".format(list(csv_komprimering)))
+    return os.path.join(folder_name,'data_behandlet.csv'+csv_komprimering[komprimering])
+
+
+def tmp_path(file_path):
+    # Midlertidig fil i samme mappe. Filendelsen beholdes (pandas velger
+    # format og komprimering ut fra den), og punktum først gjør at filen
+    # ikke blir lest som en del av en partisjon (se les_partisjoner()).
+    return os.path.join(os.path.dirname(file_path),'.tmp-'+os.path.basename(file_path))
+
+
+def fullfor_fil(file_path,varig=True):
+    # Gir den midlertidige filen endelig navn med os.replace(), slik at 
+    # file_path aldri er halvveis skrevet. Med varig = True skrives filen og
+    # mappen til disk (fsync) først, slik at filen også overlever et strømbrudd.
+    tmp = tmp_path(file_path)
+    if varig:
+        # Åpnes med skrivetilgang, som os.fsync() krever på Windows
+        with open(tmp,'r+b') as f:
+            os.fsync(f.fileno())
+    os.replace(tmp,file_path)
+    if varig and hasattr(os,'O_DIRECTORY'): # Ikke på Windows
+        fd = os.open(os.path.dirname(os.path.abspath(file_path)),os.O_RDONLY|os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def skriv_atomisk(file_path,fun,*args,varig=True):
+    # fun(path,*args) skriver filen til path
+    os.makedirs(os.path.dirname(os.path.abspath(file_path)),exist_ok=True)
+    fun(tmp_path(file_path),*args)
+    fullfor_fil(file_path,varig)
+
+
+def legg_til_fil(file_path,fun,*args,forste=False):
+    # fun(path,*args) legger til en del av filen (f.eks. med mode='a'). Den
+    # ferdige filen får endelig navn med fullfor_fil().
+    tmp = tmp_path(file_path)
+    if forste and os.path.exists(tmp):
+        os.remove(tmp)
+    os.makedirs(os.path.dirname(os.path.abspath(file_path)),exist_ok=True)
+    fun(tmp,*args)
+
+
+class Skriver:
+    # Skriver filer i en egen tråd, slik at beregningene kan fortsette mens
+    # filene skrives. Jobbene utføres i rekkefølgen de legges til:
+    #
+    #     with Skriver() as skriver:
+    #         skriver.skriv(file_path,fun,data)       # fun(path,data)
+    #         skriver.legg_til(csv_path,fun,del_1,forste=True)
+    #         skriver.legg_til(csv_path,fun,del_2)
+    #         skriver.fullfor(csv_path)
+    #
+    # Alle filer skrives først til en midlertidig fil (se skriv_atomisk()).
+    # max_ventende begrenser antall jobber som venter (og dermed data som 
+    # holdes i minnet); skriv() og legg_til() venter da på skriveren. Med
+    # erstatt=True i skriv() erstattes en ventende jobb for samme fil, slik 
+    # at kun den nyeste versjonen skrives. Feil i skriveren gis videre ved
+    # neste kall, og senest i vent().
+    def __init__(self,max_ventende=None,varig=True):
+        self.max_ventende = max_ventende
+        self.varig = varig
+        self.jobber = deque()
+        self.aktiv = None
+        self.feil = None
+        self.stopp = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.kjor,daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        if exc_type is not None:
+            # Ved feil i beregningene skrives ikke de ventende filene
+            with self.cond:
+                self.jobber.clear()
+            self.avslutt()
+            return False
+        self.lukk()
+        return False
+
+    def sjekk_feil(self):
+        if self.feil is not None:
+            raise self.feil
+
+    def legg_inn(self,jobb,erstatt=False):
+        with self.cond:
+            self.sjekk_feil()
+            if erstatt:
+                for i,ventende in enumerate(self.jobber):
+                    if ventende[:2] == jobb[:2]:
+                        self.jobber[i] = jobb
+                        return
+            while (self.max_ventende is not None) and (len(self.jobber) >= self.max_ventende) and (self.feil is None):
+                self.cond.wait()
+            self.sjekk_feil()
+            self.jobber.append(jobb)
+            self.cond.notify_all()
+
+    def skriv(self,file_path,fun,*args,erstatt=False):
+        self.legg_inn(('skriv',file_path,fun,args),erstatt)
+
+    def legg_til(self,file_path,fun,*args,forste=False):
+        self.legg_inn(('legg_til',file_path,fun,args,forste))
+
+    def fullfor(self,file_path):
+        self.legg_inn(('fullfor',file_path))
+
+    def utfor(self,jobb):
+        if jobb[0] == 'skriv':
+            skriv_atomisk(jobb[1],jobb[2],*jobb[3],varig=self.varig)
+        elif jobb[0] == 'legg_til':
+            legg_til_fil(jobb[1],jobb[2],*jobb[3],forste=jobb[4])
+        else:
+            fullfor_fil(jobb[1],self.varig)
+
+    def kjor(self):
+        while True:
+            with self.cond:
+                while (len(self.jobber) == 0) and not self.stopp:
+                    self.cond.wait()
+                if len(self.jobber) == 0:
+                    return
+                self.aktiv = self.jobber.popleft()
+                self.cond.notify_all()
+            try:
+                if self.feil is None:
+                    self.utfor(self.aktiv)
+            except BaseException as e:
+                self.feil = e
+            with self.cond:
+                self.aktiv = None
+                self.cond.notify_all()
+
+    def vent(self):
+        # Venter til alle jobbene er utført
+        with self.cond:
+            while ((len(self.jobber) > 0) or (self.aktiv is not None)) and (self.feil is None):
+                self.cond.wait()
+        self.sjekk_feil()
+
+    def avslutt(self):
+        with self.cond:
+            self.stopp = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def lukk(self):
+        try:
+            self.vent()
+        finally:
+            self.avslutt()
+
+
+def csv_bytes(data,header=True,komprimering=None):
+    # data som (komprimert) CSV. Komprimerte deler kan legges etter 
+    # hverandre i samme fil.
+    innhold = data.to_csv(None,index=False,sep=';',header=header).encode('utf-8')
+    if komprimering == 'gzip':
+        import gzip
+        return gzip.compress(innhold)
+    if komprimering == 'bz2':
+        import bz2
+        return bz2.compress(innhold)
+    if komprimering == 'xz':
+        import lzma
+        return lzma.compress(innhold)
+    if komprimering == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("Feil: komprimering_csv = 'zstd' krever pakken zstandard")
+        return zstandard.ZstdCompressor().compress(innhold)
+    return innhold
+
+
+def skriv_bytes(file_path,innhold):
+    # innhold er bytes, eller en Future med bytes (se legg_til_csv())
+    if hasattr(innhold,'result'):
+        innhold = innhold.result()
+    with open(file_path,'ab') as f:
+        f.write(innhold)
+
+
+def legg_til_csv(skriver,file_path,data,forste=False,komprimering=None,executor=None):
+    # Legger til data i CSV-filen i bakgrunnen. Med executor (se 
+    # start_executor()) formateres CSV-teksten i en annen prosess, slik at 
+    # verken hovedprosessen eller skriveren venter på formateringen.
+    if executor is None:
+        skriver.legg_til(file_path,lambda path: skriv_bytes(path,csv_bytes(data,forste,komprimering)),forste=forste)
+    else:
+        skriver.legg_til(file_path,skriv_bytes,executor.submit(csv_bytes,data,forste,komprimering),forste=forste)
+
+
+def lagre_csv_per_aar(data,file_path,komprimering=None,skriver=None,executor=None):
+    # Lagrer data (sortert på regnskapsår) som CSV ett regnskapsår om gangen,
+    # i bakgrunnen dersom skriver er gitt
+    if skriver is None:
+        with Skriver() as skriver:
+            return lagre_csv_per_aar(data,file_path,komprimering,skriver,executor)
+    regnaar = data['regnaar'].to_numpy()
+    grenser = np.flatnonzero(np.diff(regnaar))+1
+    for i,(start,stop) in enumerate(zip(np.r_[0,grenser],np.r_[grenser,len(regnaar)])):
+        legg_til_csv(skriver,file_path,data.iloc[start:stop],i == 0,komprimering,executor)
+    if len(regnaar) == 0:
+        legg_til_csv(skriver,file_path,data,True,komprimering)
+    skriver.fullfor(file_path)
+
+
+def partisjon_path(folder_name,regnaar):
+    return os.path.join(folder_name,'regnaar={}'.format(regnaar),'part-0.parquet')
+
+
+def skriv_parquet(file_path,data,komprimering='snappy'):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(data,preserve_index=False)
+    pq.write_table(table,file_path,compression=komprimering)
+
+
+def lagre_partisjon(data_aar,folder_name,regnaar,komprimering='snappy',skriver=None):
+    # komprimering: 'snappy', 'zstd', 'gzip' eller None. Filen skrives i
+    # bakgrunnen dersom skriver er gitt (se Skriver).
+    file_path = partisjon_path(folder_name,regnaar)
+    if skriver is None:
+        skriv_atomisk(file_path,skriv_parquet,data_aar,komprimering)
+    else:
+        skriver.skriv(file_path,skriv_parquet,data_aar,komprimering)
+
+
+def lagre_parquet(data,folder_name,komprimering='snappy',skriver=None):
+    # Lagrer data som Parquet med én partisjon per regnskapsår:
+    # folder_name/regnaar=2008/part-0.parquet, osv.
+    import shutil
+    if os.path.exists(folder_name):
+        shutil.rmtree(folder_name)
+    for regnaar,data_aar in data.groupby('regnaar',sort=True):
+        lagre_partisjon(data_aar,folder_name,regnaar,komprimering,skriver)
+
+
+def lagre_partisjoner(data,folder_name,regnaar_list,komprimering='snappy',skriver=None):
+    # Erstatter kun partisjonene for regnskapsårene i regnaar_list. 
+    # Partisjoner for år uten rader i data blir slettet.
+    import shutil
+    for regnaar in regnaar_list:
+        data_aar = data[data['regnaar']==regnaar]
+        if data_aar.shape[0] > 0:
+            lagre_partisjon(data_aar,folder_name,regnaar,komprimering,skriver)
+        elif os.path.exists(os.path.dirname(partisjon_path(folder_name,regnaar))):
+            shutil.rmtree(os.path.dirname(partisjon_path(folder_name,regnaar)))
+
+
+def les_partisjoner(folder_name,columns=None,years=None):
+    # Leser partisjonene (alle, eller kun regnskapsårene i years) som én 
+    # DataFrame. Filene blir minnekartlagt (memory_map) i stedet for kopiert.
+    # Filer som begynner med punktum (midlertidige filer, se tmp_path()) 
+    # blir ikke lest.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    tables = []
+    for partition in sorted(os.listdir(folder_name)):
+        if partition.startswith('.'):
+            continue
+        regnaar = int(partition.replace('regnaar=',''))
+        if (years is not None) and (regnaar not in years):
+            continue
+        for part in sorted(os.listdir(os.path.join(folder_name,partition))):
+            if part.startswith('.'):
+                continue
+            tables.append(pq.read_table(
+                os.path.join(folder_name,partition,part),
+                columns=columns,
+                memory_map=True,
+                ))
+    table = pa.concat_tables(tables,promote_options='default')
+    return table.to_pandas(split_blocks=True,self_destruct=True)
+
+
+##################################################################
+##  Behandling uten å holde alle regnskapsår i minnet (out-of-core)
+##################################################################
+def spill_aarsregnskap(file_path,spill_folder,part,columns,regnaar_max=2021,amounts_float32=False,
+                       chunksize=None,CPI_data=None):
+    # Behandler én årsfil og skriver radene for hvert regnskapsår til 
+    # spill_folder/regnaar=YYYY/part-<part>.parquet. Kun kolonnene i columns 
+    # beholdes.
+    data,seconds,peak_memory,records,kontroller = behandle_aarsregnskap(file_path,regnaar_max,amounts_float32,chunksize,CPI_data)
+    data = data[[c for c in data.columns if c in columns]]
+    regnaar_list = []
+    for regnaar,data_aar in data.groupby('regnaar',sort=True):
+        file_path_part = os.path.join(spill_folder,'regnaar={}'.format(regnaar),'part-{:05d}.parquet'.format(part))
+        os.makedirs(os.path.dirname(file_path_part),exist_ok=True)
+        data_aar.to_parquet(file_path_part,index=False)
+        regnaar_list.append(int(regnaar))
+    return regnaar_list,data.shape[0],seconds,peak_memory,records,kontroller
+
+
+def behandle_out_of_core(folder_name,spill_folder,parquet_folder,columns_lags,makroserier,columns_to_keep,
+                         regnaar_min,regnaar_max=2021,amounts_float32=False,chunksize=None,CPI_data=None,
+                         num_workers=1,parallel_backend='process',csv_path=None,
+                         komprimering_parquet='snappy',komprimering_csv=None):
+    # Gir de samme dataene som load_aarsregnskaper(), lag_lagget_variabler(),
+    # koble_makroserier() og lagre_parquet() i "behandle_data_og_lag_variabler.py",
+    # men uten at alle regnskapsår er i minnet samtidig:
+    #   1. Hver årsfil behandles (variabler og deflatering) og skrives til 
+    #      midlertidige partisjoner per regnskapsår i spill_folder.
+    #   2. Regnskapsårene behandles ett om gangen i stigende rekkefølge. Kun 
+    #      de max_lag foregående årene holdes i minnet for å lage variablene 
+    #      fra tidligere regnskapsår.
+    # Radene i hvert år kommer i samme rekkefølge som filene. Dersom csv_path
+    # er gitt, lagres data også som CSV sortert på regnskapsår. Hvert år 
+    # skrives i bakgrunnen (se Skriver) mens de neste årene behandles.
+    # Returnerer regnskapsårene i hver fil.
+    import shutil
+    files = os.listdir(folder_name)
+    columns = list(dict.fromkeys(columns_to_keep+[c for cs in columns_lags.values() for c in cs]))
+    if os.path.exists(spill_folder):
+        shutil.rmtree(spill_folder)
+    args = [(folder_name+f,spill_folder,i,columns,regnaar_max,amounts_float32,chunksize,CPI_data) for i,f in enumerate(files)]
+    if num_workers > 1:
+        with executor_for(num_workers,parallel_backend) as executor:
+            results = list(executor.map(spill_aarsregnskap,*zip(*args)))
+    else:
+        results = map(lambda a: spill_aarsregnskap(*a),args)
+
+    regnaar_per_fil = {}
+    for current_file,(regnaar_list,num_rows,seconds,peak_memory,records,kontroller) in zip(files,results):
+        maaling.legg_til(records)
+        validering.legg_til(kontroller)
+        regnaar_per_fil[current_file] = regnaar_list
+        print('Imported for accounting year {} ({:,} rows, {:,.0f} rows/sec, peak memory {:,.0f} MB)'.format(
+            int(current_file[0:4]),
+            num_rows,
+            num_rows/max(seconds,1e-9),
+            peak_memory,
+            ))
+
+    max_lag = max(columns_lags.keys())
+    if os.path.exists(parquet_folder):
+        shutil.rmtree(parquet_folder)
+    window = [] # (regnaar, data) for de max_lag foregående årene
+    forste_csv = True
+    # Høyst to år venter på skriving, slik at minnebruken er begrenset. Med
+    # num_workers>1 formateres CSV-filen i egne prosesser.
+    with (start_executor(num_workers,parallel_backend) if num_workers > 1 else nullcontext()) as executor, \
+            Skriver(max_ventende=2) as skriver_parquet, Skriver(max_ventende=2) as skriver_csv:
+        for regnaar in sorted({r for regnaar_list in regnaar_per_fil.values() for r in regnaar_list}):
+            data_aar = les_partisjoner(spill_folder,years=[regnaar])
+            kontroller = sjekk_unike(data_aar)
+            if regnaar >= regnaar_min:
+                kontroller += sjekk_makroserier(data_aar,makroserier)
+            validering.valider('Regnskapsår {}'.format(regnaar),kontroller,data_aar.shape[0])
+            with maaling.steg('Variabler fra tidligere år ({})'.format(regnaar),data_aar.shape[0]):
+                data_window = concat_med_kategorier([d for r,d in window]+[data_aar])
+                num_prev_rows = data_window.shape[0]-data_aar.shape[0]
+                data_lags = lag_lagget_variabler(data_window,columns_lags).iloc[num_prev_rows:].reset_index(drop=True)
+            window = [(r,d) for r,d in window+[(regnaar,data_aar)] if r > regnaar-max_lag]
+
+            if regnaar < regnaar_min:
+                continue
+            data = pd.concat([data_aar,data_lags],axis=1)
+            data = koble_makroserier(data,makroserier)
+            data = bruk_schema(data[columns_to_keep],amounts_float32)
+            with maaling.steg('Lagring ({})'.format(regnaar),data.shape[0]):
+                lagre_partisjon(data,parquet_folder,regnaar,komprimering_parquet,skriver_parquet)
+                if csv_path is not None:
+                    legg_til_csv(skriver_csv,csv_path,data,forste_csv,komprimering_csv,executor)
+                    forste_csv = False
+            print('Behandlet regnskapsår {} ({:,} rows, peak memory {:,.0f} MB)'.format(regnaar,data.shape[0],peak_memory_mb()))
+        if (csv_path is not None) and not forste_csv:
+            skriver_csv.fullfor(csv_path)
+
+    shutil.rmtree(spill_folder)
+    return regnaar_per_fil
+
+
+##################################################################
+##  Manifest for inkrementell behandling
+##################################################################
+def fil_hash(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path,'rb') as f:
+        for block in iter(lambda: f.read(2**20),b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def les_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path,'r') as f:
+        return json.load(f)
+
+
+def lagre_manifest(manifest,manifest_path):
+    # Skriver til en midlertidig fil og gir den nytt navn, slik at 
+    # manifestet aldri blir halvveis skrevet
+    with open(manifest_path+'.tmp','w') as f:
+        json.dump(manifest,f,indent=1)
+    os.replace(manifest_path+'.tmp',manifest_path)
+
+
+def sammenlign_med_manifest(folder_name,manifest,hash_filer=True):
+    # Finner årsfiler som er nye eller endret siden forrige kjøring, og filer 
+    # som er slettet. Hash blir kun beregnet når størrelse eller mtime er endret,
+    # og kun med hash_filer=True (ved inkrementell behandling). Filer uten 
+    # hash i manifestet regnes som endret dersom størrelse eller mtime er endret.
+    files_manifest = manifest['files'] if manifest is not None else {}
+    files_info = {}
+    files_changed = []
+    for current_file in os.listdir(folder_name):
+        stat = os.stat(folder_name+current_file)
+        info = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        old = files_manifest.get(current_file)
+        uendret = (old is not None) and (old['size']==info['size']) and (old['mtime']==info['mtime'])
+        if uendret:
+            info['sha256'] = old.get('sha256')
+        else:
+            info['sha256'] = fil_hash(folder_name+current_file) if hash_filer else None
+        if uendret or ((old is not None) and (info['sha256'] is not None) and (old.get('sha256')==info['sha256'])):
+            info['regnaar'] = old['regnaar']
+        else:
+            files_changed.append(current_file)
+        files_info[current_file] = info
+    files_deleted = [f for f in files_manifest if f not in files_info]
+    return files_changed,files_deleted,files_info
+
+
+def berorte_regnaar(regnaar_changed,max_lag):
+    # Et endret regnskapsår påvirker seg selv og variablene fra tidligere 
+    # regnskapsår ('_prev', '_prev_prev', ...) for de max_lag neste årene
+    return sorted({int(r)+k for r in regnaar_changed for k in range(max_lag+1)})
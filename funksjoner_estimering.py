@@ -0,0 +1,550 @@
+import numpy as np
+import pandas as pd
+
+##################################################################
+##  Faste effekter ved demeaning (within-transformasjon)
+##################################################################
+def faktoriser(values):
+    # Koder (0,...,L-1) og antall nivåer. Manglende verdier blir et eget nivå.
+    codes,uniques = pd.factorize(np.asarray(values),use_na_sentinel=False)
+    return codes,len(uniques)
+
+
+def demean(M,fe_codes,tol=1e-12,maxiter=10000):
+    # Trekker fra gruppegjennomsnittene for hver av de faste effektene i
+    # fe_codes (liste med (codes, antall nivåer)) fra kolonnene i M. Med
+    # flere faste effekter gjentas dette til gruppegjennomsnittene er ~0
+    # (alternating projections). Med én fast effekt er én runde nok.
+    M = np.array(M,dtype=np.float64,copy=True)
+    if M.ndim == 1:
+        M = M[:,None]
+    counts = [np.bincount(codes,minlength=num_levels) for codes,num_levels in fe_codes]
+    scale = np.maximum(np.abs(M).max(axis=0),1.0)
+
+    for iteration in range(maxiter):
+        max_change = 0.0
+        for (codes,num_levels),count in zip(fe_codes,counts):
+            for j in range(M.shape[1]):
+                means = np.bincount(codes,weights=M[:,j],minlength=num_levels)/count
+                M[:,j] -= means[codes]
+                max_change = max(max_change,np.abs(means).max()/scale[j])
+        if (len(fe_codes) <= 1) or (max_change < tol):
+            break
+    return M
+
+
+def kombiner(values_list):
+    # Koder for kombinasjonene av verdiene i flere kolonner, f.eks. 
+    # Bransje x regnaar for faste effekter av bransje og år sammen
+    codes = np.zeros(len(values_list[0]),dtype=np.int64)
+    for values in values_list:
+        codes_column,num_levels = faktoriser(values)
+        codes = codes*num_levels+codes_column
+    return faktoriser(codes)[0]
+
+
+def uten_singletons(fe_codes):
+    # Maske for radene som beholdes når observasjoner som er alene i en
+    # gruppe for en av de faste effektene (singletons) fjernes. Singletons 
+    # forklares perfekt av sin faste effekt, og påvirker ikke koeffisientene,
+    # men gir for mange observasjoner i R2 og i frihetsgradene for 
+    # standardfeilene. Gjentas til det ikke er flere singletons, siden 
+    # fjerningen kan lage nye (som i Statas reghdfe).
+    keep = np.ones(len(fe_codes[0][0]),dtype=bool)
+    while True:
+        num_removed = 0
+        for codes,num_levels in fe_codes:
+            counts = np.bincount(codes[keep],minlength=num_levels)
+            singletons = keep & (counts[codes]==1)
+            num_removed += int(np.sum(singletons))
+            keep &= ~singletons
+        if num_removed == 0:
+            break
+    return keep
+
+
+def nostet(codes,klynger):
+    # True dersom hvert nivå av den faste effekten ligger i én klynge (f.eks.
+    # faste effekter for foretak når det klynges på orgnr)
+    num_levels = len(np.unique(codes))
+    num_pairs = len(np.unique(codes.astype(np.int64)*klynger.num_groups+klynger.codes))
+    return num_pairs == num_levels
+
+
+def antall_komponenter(fe_1,fe_2):
+    # Antall sammenhengende komponenter i grafen der nivåene til to faste
+    # effekter er noder og hver observasjon er en kant mellom sine to nivåer
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    (codes_1,num_levels_1),(codes_2,num_levels_2) = fe_1,fe_2
+    num_nodes = num_levels_1+num_levels_2
+    graph = coo_matrix((np.ones(len(codes_1),dtype=np.int8),(codes_1,num_levels_1+codes_2)),shape=(num_nodes,num_nodes))
+    return connected_components(graph,directed=False)[0]
+
+
+def antall_fe_parametere(fe_codes,klynger=()):
+    # Antall parametere de faste effektene svarer til i en modell med
+    # konstantledd, der én kategori per fast effekt utelates. For de to
+    # første faste effektene trekkes i tillegg fra antall sammenhengende 
+    # komponenter utover én (Abowd, Creecy og Kramarz, 2002), f.eks. når
+    # foretak kun finnes i ett av to sett med regnskapsår. For de andre er
+    # antallet en øvre grense. Faste effekter som er nøstet i en av 
+    # klyngeinndelingene (se nostet()) telles ikke med, siden de ikke tar 
+    # frihetsgrader fra de klyngerobuste standardfeilene (som i reghdfe).
+    fe_codes = [fe for fe in fe_codes if not any(nostet(fe[0],k) for k in klynger)]
+    num_params = int(np.sum([num_levels-1 for codes,num_levels in fe_codes]))
+    if len(fe_codes) >= 2:
+        num_params -= antall_komponenter(fe_codes[0],fe_codes[1])-1
+    return num_params
+
+
+##################################################################
+##  Klyngerobust kovariansmatrise
+##################################################################
+class Klynger:
+    # Klyngene (f.eks. orgnr) faktoriseres og sorteres én gang, slik at 
+    # summen av scores per klynge kan beregnes med np.add.reduceat for 
+    # alle kolonner samtidig
+    def __init__(self,groups):
+        groups = np.asarray(groups)
+        if groups.dtype.kind in 'iu':
+            codes = groups
+        else:
+            codes,num_levels = faktoriser(groups)
+        self.order = np.argsort(codes,kind='stable')
+        codes_sorted = codes[self.order]
+        self.starts = np.flatnonzero(np.r_[True,codes_sorted[1:]!=codes_sorted[:-1]])
+        self.num_groups = len(self.starts)
+        self.nobs = len(codes)
+        # Nummererer klyngene 0,...,G-1 i sortert rekkefølge
+        self.codes = np.empty(self.nobs,dtype=np.int64)
+        self.codes[self.order] = np.cumsum(np.r_[False,codes_sorted[1:]!=codes_sorted[:-1]])
+
+    def sum(self,scores):
+        return np.add.reduceat(scores[self.order],self.starts,axis=0)
+
+    def subset(self,ind):
+        return Klynger(self.codes[ind])
+
+    def intersection(self,other):
+        # Klynger for snittet av to klyngeinndelinger (f.eks. foretak og år)
+        return Klynger(self.codes*other.num_groups+other.codes)
+
+
+def cluster_cov(scores,bread,klynger,k_params,klynger2=None):
+    # Klyngerobust (CRV1) kovariansmatrise med samme småutvalgskorreksjon
+    # som statsmodels: G/(G-1) * (N-1)/(N-K). Med klynger2 beregnes 
+    # toveis klynging (Cameron, Gelbach og Miller, 2011): V1 + V2 - V12.
+    # Denne er ikke nødvendigvis positiv semidefinit (f.eks. med få år), og
+    # kan gi negative varianser. Da settes de negative egenverdiene til 0, 
+    # som Cameron, Gelbach og Miller foreslår.
+    if not isinstance(klynger,Klynger):
+        klynger = Klynger(klynger)
+    if klynger2 is not None:
+        if not isinstance(klynger2,Klynger):
+            klynger2 = Klynger(klynger2)
+        cov = cluster_cov(scores,bread,klynger,k_params) +\
+            cluster_cov(scores,bread,klynger2,k_params) -\
+            cluster_cov(scores,bread,klynger.intersection(klynger2),k_params)
+        eigenvalues,eigenvectors = np.linalg.eigh((cov+cov.T)/2)
+        if np.any(eigenvalues < 0):
+            cov = (eigenvectors*np.maximum(eigenvalues,0)) @ eigenvectors.T
+        return cov
+
+    nobs = scores.shape[0]
+    num_groups = klynger.num_groups
+    scores_sum = klynger.sum(scores)
+    meat = scores_sum.T @ scores_sum
+    cov = bread @ meat @ bread
+    return cov*(num_groups/(num_groups-1.0))*((nobs-1.0)/(nobs-k_params))
+
+
+##################################################################
+##  OLS med absorberte faste effekter
+##################################################################
+class OLSResultat:
+    # Resultat fra ols_absorb() og ols_formula() med de samme navnene som 
+    # statsmodels benytter
+    def __init__(self,params,cov,rsquared,nobs,k_params,num_singletons=0):
+        from scipy import stats # importeres først når den brukes
+
+        self.params = params
+        self.cov = cov
+        self.bse = pd.Series(np.sqrt(np.diag(cov)),index=params.index)
+        self.tvalues = params/self.bse
+        self.pvalues = pd.Series(2*stats.norm.sf(np.abs(self.tvalues)),index=params.index)
+        self.rsquared = rsquared
+        self.nobs = nobs
+        self.k_params = k_params
+        self.num_singletons = num_singletons
+
+    def cov_params(self):
+        return pd.DataFrame(self.cov,index=self.params.index,columns=self.params.index)
+
+
+def ols_absorb(y,X,fixed_effects,groups,fjern_singletons=False):
+    # OLS der de faste effektene (liste med arrays, f.eks. [regnaar, Bransje])
+    # absorberes ved demeaning i stedet for å legges inn som dummyvariabler.
+    # Minnebruken er den samme uansett antall nivåer, slik at også faste
+    # effekter for foretak (orgnr) kan brukes.
+    # groups er klyngene (én array, eller liste med to for toveis klynging).
+    # Koeffisientene og R2 er de samme som med dummyvariabler. 
+    # Konstantleddet er gjennomsnittet av de faste effektene (som i Statas
+    # reghdfe), og ikke nivået for de utelatte kategoriene som med 
+    # dummyvariabler. De klyngerobuste standardfeilene følger reghdfe: 
+    # faste effekter som er nøstet i en klyngeinndeling telles ikke med i K
+    # i småutvalgskorreksjonen (N-1)/(N-K) (se antall_fe_parametere()). De
+    # er derfor mindre enn med dummyvariabler i statsmodels når f.eks. 
+    # foretak er fast effekt og det klynges på orgnr, eller når regnaar er
+    # fast effekt og det klynges på regnaar (toveis klynging). Ellers er 
+    # de like.
+    # Med fjern_singletons=True fjernes singletons (se uten_singletons()),
+    # og antall observasjoner og R2 er da som i reghdfe.
+    names = list(X.columns)
+    y = np.asarray(y,dtype=np.float64)
+    X = np.asarray(X,dtype=np.float64)
+    if not isinstance(groups,list):
+        groups = [groups]
+
+    # Fjerner rader med manglende verdier (som statsmodels/patsy)
+    ind = np.isfinite(y) & np.isfinite(X).all(axis=1)
+    num_singletons = 0
+    if fjern_singletons and (len(fixed_effects) > 0):
+        rows = np.flatnonzero(ind)
+        keep = uten_singletons([faktoriser(np.asarray(fe)[ind]) for fe in fixed_effects])
+        num_singletons = int(np.sum(~keep))
+        ind[rows[~keep]] = False
+    y,X = y[ind],X[ind]
+    klynger = [Klynger(np.asarray(g)[ind]) for g in groups]
+    fe_codes = [faktoriser(np.asarray(fe)[ind]) for fe in fixed_effects]
+    nobs = y.shape[0]
+
+    M = demean(np.column_stack([y,X]),fe_codes)
+    if len(fe_codes) > 0:
+        means = np.concatenate([[y.mean()],X.mean(axis=0)])
+        M = M+means # Legger til totalgjennomsnittene for å beregne konstantleddet
+
+    y_tilde = M[:,0]
+    X_tilde = np.column_stack([np.ones(nobs),M[:,1:]])
+    bread = np.linalg.pinv(X_tilde.T @ X_tilde)
+    params = bread @ (X_tilde.T @ y_tilde)
+    resid = y_tilde - X_tilde @ params
+
+    # Antall parametere i modellen med dummyvariabler
+    k_params = X_tilde.shape[1] + antall_fe_parametere(fe_codes,klynger)
+
+    cov = cluster_cov(X_tilde*resid[:,None],bread,klynger[0],k_params,*klynger[1:])
+    rsquared = 1 - (resid @ resid)/np.sum((y-y.mean())**2)
+
+    params = pd.Series(params,index=['Intercept']+names)
+    return OLSResultat(params,cov,rsquared,nobs,k_params,num_singletons)
+
+
+def ols_formula(string_formula,df,groups):
+    # OLS med statsmodels (faste effekter som dummyvariabler i formelen), 
+    # men med klyngerobuste standardfeil fra cluster_cov()
+    from statsmodels.formula.api import ols
+
+    model = ols(formula=string_formula,data=df).fit()
+    if not isinstance(groups,list):
+        groups = [groups]
+    # Radene som ble brukt (patsy fjerner rader med manglende verdier)
+    row_labels = model.model.data.row_labels
+    klynger = [Klynger(pd.Series(np.asarray(g),index=df.index).loc[row_labels].to_numpy()) for g in groups]
+
+    exog = model.model.exog
+    scores = exog*np.asarray(model.resid)[:,None]
+    cov = cluster_cov(scores,np.asarray(model.normalized_cov_params),klynger[0],exog.shape[1],*klynger[1:])
+    return OLSResultat(model.params,cov,model.rsquared,int(model.nobs),exog.shape[1])
+
+
+##################################################################
+##  Bootstrap og placebotester
+##################################################################
+def klynge_kryssprodukter(X,y,klynger):
+    # X_g'X_g (G x k x k) og X_g'y_g (G x k) for hver klynge g
+    X_sorted = X[klynger.order]
+    k = X.shape[1]
+    A = np.empty((klynger.num_groups,k,k))
+    for i in range(k):
+        A[:,i,i:] = np.add.reduceat(X_sorted[:,i:i+1]*X_sorted[:,i:],klynger.starts,axis=0)
+        A[:,i:,i] = A[:,i,i:]
+    b = klynger.sum(X*y[:,None])
+    return A,b
+
+
+# Resampling-objektene som replikasjonene bruker. De registreres før 
+# prosessene startes, slik at de deles med hovedprosessen (fork).
+_resampling_lager = {}
+
+def _bootstrap_batch(jobb):
+    key,seed,num_replications = jobb
+    r = _resampling_lager[key]
+    rng = np.random.default_rng(seed)
+    G = r.klynger.num_groups
+    # Antall ganger hver klynge trekkes (trekning med tilbakelegging)
+    W = rng.multinomial(G,np.full(G,1.0/G),size=num_replications).astype(np.float64)
+    k = r.A_g.shape[1]
+    A = (W @ r.A_g.reshape(G,k*k)).reshape(num_replications,k,k)
+    b = W @ r.b_g
+    try:
+        return np.linalg.solve(A,b[:,:,None])[:,:,0]
+    except np.linalg.LinAlgError:
+        return (np.linalg.pinv(A) @ b[:,:,None])[:,:,0]
+
+
+def _placebo_batch(jobb):
+    key,seed,num_replications = jobb
+    r = _resampling_lager[key]
+    rng = np.random.default_rng(seed)
+    n = len(r.y)
+    Y = np.empty((n,num_replications))
+    for j in range(num_replications):
+        # Tilfeldig rekkefølge innenfor hver permutasjonsgruppe (f.eks. år)
+        order = np.lexsort((rng.random(n),r.perm_codes))
+        Y[r.perm_order,j] = r.y[order]
+    # X_tilde er demeanet, så X_tilde'y = X_tilde'(y demeanet). y trenger
+    # derfor ikke å demeanes på nytt etter permutasjonen.
+    return (r.bread @ (r.X_tilde.T @ Y)).T
+
+
+class Resampling:
+    # Firmaklyngede bootstrap-konfidensintervaller og placebotester for 
+    # koeffisientene i en modell med faste effekter. y og X demeanes én gang.
+    #   - Bootstrap: klyngene (første kolonne i groups) trekkes med
+    #     tilbakelegging. Med vekter w_g (antall trekninger av klynge g) er
+    #     koeffisientene (sum w_g X_g'X_g)^-1 (sum w_g X_g'y_g), der
+    #     kryssproduktene per klynge er beregnet på forhånd. Designet 
+    #     demeanes ikke på nytt for hver replikasjon.
+    #   - Placebo: y permuteres innenfor permutation_groups (f.eks. 
+    #     regnskapsår), og modellen estimeres på nytt. p-verdien er andelen
+    #     placebokoeffisienter som er større i absoluttverdi enn estimatet.
+    # Replikasjonene kjøres i grupper på batch_size, der hver gruppe har sitt
+    # eget frø fra np.random.SeedSequence(seed). Resultatet er dermed det
+    # samme uansett antall prosesser. Med fjern_singletons=True brukes de
+    # samme radene som i ols_absorb().
+    def __init__(self,y,X,fixed_effects,groups,permutation_groups=None,batch_size=50,fjern_singletons=False):
+        self.names = list(X.columns)
+        y = np.asarray(y,dtype=np.float64)
+        X = np.asarray(X,dtype=np.float64)
+        if isinstance(groups,list):
+            groups = groups[0]
+        ind = np.isfinite(y) & np.isfinite(X).all(axis=1)
+        if fjern_singletons and (len(fixed_effects) > 0):
+            rows = np.flatnonzero(ind)
+            keep = uten_singletons([faktoriser(np.asarray(fe)[ind]) for fe in fixed_effects])
+            ind[rows[~keep]] = False
+        fe_codes = [faktoriser(np.asarray(fe)[ind]) for fe in fixed_effects]
+        M = demean(np.column_stack([y[ind],X[ind]]),fe_codes)
+        if len(fe_codes) == 0:
+            M = M-M.mean(axis=0)
+        self.y = y[ind]
+        self.X_tilde = M[:,1:]
+        self.bread = np.linalg.pinv(self.X_tilde.T @ self.X_tilde)
+        self.params = pd.Series(self.bread @ (self.X_tilde.T @ M[:,0]),index=self.names)
+        self.klynger = Klynger(np.asarray(groups)[ind])
+        self.A_g,self.b_g = klynge_kryssprodukter(self.X_tilde,M[:,0],self.klynger)
+        if permutation_groups is None:
+            self.perm_codes = np.zeros(len(self.y),dtype=np.int64)
+        else:
+            self.perm_codes = faktoriser(np.asarray(permutation_groups)[ind])[0]
+        self.perm_order = np.argsort(self.perm_codes,kind='stable')
+        self.batch_size = batch_size
+
+    def kjor(self,fun,num_replications,seed,num_workers=1,parallel_backend='process'):
+        from funksjoner_behandling import executor_for
+
+        num_batches = int(np.ceil(num_replications/self.batch_size))
+        seeds = np.random.SeedSequence(seed).spawn(num_batches)
+        key = id(self)
+        jobs = [(key,s,min(self.batch_size,num_replications-i*self.batch_size)) for i,s in enumerate(seeds)]
+        _resampling_lager[key] = self
+        try:
+            if num_workers > 1:
+                with executor_for(num_workers,parallel_backend) as executor:
+                    results = list(executor.map(fun,jobs))
+            else:
+                results = [fun(jobb) for jobb in jobs]
+        finally:
+            del _resampling_lager[key]
+        return pd.DataFrame(np.vstack(results),columns=self.names)
+
+    def bootstrap(self,num_replications,seed=0,num_workers=1,parallel_backend='process'):
+        return self.kjor(_bootstrap_batch,num_replications,seed,num_workers,parallel_backend)
+
+    def placebo(self,num_replications,seed=0,num_workers=1,parallel_backend='process'):
+        return self.kjor(_placebo_batch,num_replications,seed,num_workers,parallel_backend)
+
+    def konfidensintervall(self,params_bootstrap,alpha=0.05):
+        # Persentilintervall fra bootstrap-replikasjonene
+        return params_bootstrap.quantile([alpha/2,1-alpha/2])
+
+    def placebo_pvalues(self,params_placebo):
+        return (params_placebo.abs() >= self.params.abs()).mean()
+
+
+##################################################################
+##  Estimering per gruppe fra tilstrekkelige observatorer per celle
+##################################################################
+class Cellestatistikk:
+    # Radene deles i celler (f.eks. (Bransje, regnaar)), og summene av
+    # w w' for w = [1, X, y] beregnes per celle i én gruppert gjennomgang.
+    # En gruppe er en vilkårlig union av celler (f.eks. én bransje, eller 
+    # regnskapsårene i et rullerende vindu). Normalligningene for modellen
+    # med konstantledd, X og dummyvariabler for de faste effektene 
+    # (kolonner i cells som er konstante innenfor cellene) settes sammen 
+    # fra cellesummene, uten å gå gjennom radene på nytt. Koeffisientene og
+    # R2 er de samme som med engine='formula' på radene i gruppen, eller
+    # som med engine='absorb' (se estimer()).
+    # De klyngerobuste standardfeilene krever residualene, og beregnes i én 
+    # ekstra gjennomgang av radene i gruppen (radene er sortert på celle).
+    # Med klyngerobust=False beregnes standardfeilene (uten klynging) fra 
+    # cellesummene alene, og radene brukes ikke.
+    def __init__(self,y,X,cells,groups):
+        self.names = list(X.columns)
+        y = np.asarray(y,dtype=np.float64)
+        X = np.asarray(X,dtype=np.float64)
+        if not isinstance(groups,list):
+            groups = [groups]
+        ind = np.isfinite(y) & np.isfinite(X).all(axis=1)
+        cells = cells[ind]
+
+        # Cellene nummereres 0,...,C-1
+        cell_codes = np.zeros(int(np.sum(ind)),dtype=np.int64)
+        for column in cells.columns:
+            codes,num_levels = faktoriser(cells[column])
+            cell_codes = cell_codes*num_levels+codes
+        cell_codes,num_cells = faktoriser(cell_codes)
+        klynger_celler = Klynger(cell_codes)
+        order = klynger_celler.order
+        first_rows = order[klynger_celler.starts]
+        self.celler = cells.iloc[first_rows].reset_index(drop=True)
+        self.cell_of_row = klynger_celler.codes[order] # cellen til hver rad etter sortering
+        self.counts = np.diff(np.r_[klynger_celler.starts,len(order)])
+
+        # Radene sortert på celle
+        self.X = X[ind][order]
+        self.y = y[ind][order]
+        self.groups = [np.asarray(g)[ind][order] for g in groups]
+
+        # Summene av w w' per celle
+        W = np.column_stack([np.ones(len(self.y)),self.X,self.y])
+        self.A = np.empty((self.celler.shape[0],W.shape[1],W.shape[1]))
+        for i in range(W.shape[1]):
+            self.A[:,i,i:] = np.add.reduceat(W[:,i:i+1]*W[:,i:],np.r_[0,np.cumsum(self.counts)[:-1]],axis=0)
+            self.A[:,i:,i] = self.A[:,i,i:]
+
+    def normalligninger(self,subset,fe_columns):
+        # Z'Z, Z'y og y'y for radene i cellene i subset, der 
+        # Z = [1, X, dummyvariabler for hver kolonne i fe_columns]
+        k = len(self.names)+1
+        A = self.A[subset]
+        A_sum = A.sum(axis=0)
+        ZZ_blocks = [[A_sum[:k,:k]]]
+        Zy_blocks = [A_sum[:k,k]]
+        fe_levels = []
+        for column in fe_columns:
+            codes,num_levels = faktoriser(self.celler[column].to_numpy()[subset])
+            fe_levels.append((codes,num_levels))
+            S = np.zeros((num_levels,k+1))
+            np.add.at(S,codes,A[:,0,:]) # summene av [1, X, y] per nivå
+            ZZ_blocks[0].append(S[:,:k].T)
+            Zy_blocks.append(S[:,k])
+        for i,(codes_i,num_levels_i) in enumerate(fe_levels):
+            row = [ZZ_blocks[0][i+1].T]
+            for codes_j,num_levels_j in fe_levels:
+                C = np.zeros((num_levels_i,num_levels_j))
+                np.add.at(C,(codes_i,codes_j),A[:,0,0]) # antall rader
+                row.append(C)
+            ZZ_blocks.append(row)
+        ZZ = np.block(ZZ_blocks)
+        Zy = np.concatenate(Zy_blocks)
+        return ZZ,Zy,A_sum[k,k],fe_levels
+
+    def uten_singletons(self,subset,fe_columns):
+        # Som uten_singletons(), men for hele celler: de faste effektene er
+        # konstante innenfor cellene, så en singleton er en celle med én rad
+        # som er alene om nivået sitt
+        subset = np.array(subset,dtype=bool)
+        fe_codes = [faktoriser(self.celler[column].to_numpy()) for column in fe_columns]
+        while True:
+            num_removed = 0
+            for codes,num_levels in fe_codes:
+                counts = np.bincount(codes[subset],weights=self.counts[subset],minlength=num_levels)
+                singletons = subset & (counts[codes]==1)
+                num_removed += int(np.sum(singletons))
+                subset &= ~singletons
+            if num_removed == 0:
+                break
+        return subset
+
+    def estimer(self,subset,fe_columns,klyngerobust=True,engine='formula',fjern_singletons=False):
+        # OLS for radene i cellene i subset (boolsk array over cellene). Med
+        # engine='absorb' fjernes singletons (fjern_singletons=True), og 
+        # faste effekter som er nøstet i en klyngeinndeling telles ikke med i
+        # K, som i ols_absorb()
+        subset = np.asarray(subset,dtype=bool)
+        num_singletons = 0
+        if (engine == 'absorb') and fjern_singletons and (len(fe_columns) > 0):
+            subset_alle = subset
+            subset = self.uten_singletons(subset,fe_columns)
+            num_singletons = int(np.sum(self.counts[subset_alle & ~subset]))
+        k = len(self.names)+1
+        ZZ,Zy,yy,fe_levels = self.normalligninger(subset,fe_columns)
+        ZZ_inv = np.linalg.pinv(ZZ)
+        b = ZZ_inv @ Zy
+        nobs = int(ZZ[0,0])
+        k_params = int(np.linalg.matrix_rank(ZZ))
+        rss = yy - b @ Zy
+        tss = yy - Zy[0]**2/nobs
+        rsquared = 1 - rss/tss
+        params = pd.Series(b[1:k],index=self.names)
+        if not klyngerobust:
+            cov = ZZ_inv[1:k,1:k]*rss/(nobs-k_params)
+            return OLSResultat(params,cov,rsquared,nobs,k_params,num_singletons)
+
+        # Residualene og radene i (Z'Z)^-1 Z' for koeffisientene til X 
+        # (Frisch-Waugh-Lovell), for radene i gruppen
+        rows = np.repeat(subset,self.counts)
+        cell_index = np.cumsum(subset)-1 # cellens nummer blant cellene i subset
+        cell_of_row = cell_index[self.cell_of_row[rows]]
+        H = ZZ_inv[1:k,:]
+        fitted_cell = np.full(int(np.sum(subset)),b[0])
+        H_cell = np.tile(H[:,0],(len(fitted_cell),1))
+        start = k
+        for codes,num_levels in fe_levels:
+            fitted_cell += b[start:start+num_levels][codes]
+            H_cell += H[:,start:start+num_levels][:,codes].T
+            start += num_levels
+        X = self.X[rows]
+        resid = self.y[rows] - X @ b[1:k] - fitted_cell[cell_of_row]
+        scores = (X @ H[:,1:k].T + H_cell[cell_of_row])*resid[:,None]
+
+        klynger = [Klynger(g[rows]) for g in self.groups]
+        if engine == 'absorb':
+            k_params = k + antall_fe_parametere([(codes[cell_of_row],num_levels) for codes,num_levels in fe_levels],klynger)
+        cov = cluster_cov(scores,np.eye(k-1),klynger[0],k_params,*klynger[1:])
+        return OLSResultat(params,cov,rsquared,nobs,k_params,num_singletons)
+
+    def estimer_grupper(self,grupper,fe_columns,klyngerobust=True,engine='formula',fjern_singletons=False):
+        # grupper: dict med navn -> boolsk array over cellene (se celler).
+        # Returnerer en tabell med én rad per gruppe og variabel.
+        tabell = []
+        for name,subset in grupper.items():
+            subset = np.asarray(subset,dtype=bool)
+            if self.counts[subset].sum() <= len(self.names)+1:
+                continue
+            model = self.estimer(subset,fe_columns,klyngerobust,engine,fjern_singletons)
+            tabell.append(pd.DataFrame({
+                'Gruppe': name,
+                'Variabel': self.names,
+                'Koeffisient': model.params.to_numpy(),
+                'Standardfeil': model.bse.to_numpy(),
+                'p-verdi': model.pvalues.to_numpy(),
+                'Antall observasjoner': model.nobs,
+                'R2': model.rsquared,
+                }))
+        if len(tabell) == 0:
+            return pd.DataFrame(columns=['Gruppe','Variabel','Koeffisient','Standardfeil','p-verdi','Antall observasjoner','R2'])
+        return pd.concat(tabell,ignore_index=True)
@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+
+import os
+import sys
+import time
+import json
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource # Finnes ikke på Windows
+except ImportError:
+    resource = None
+
+##################################################################
+##  Måling av tid og minnebruk per steg
+##################################################################
+def peak_memory_mb():
+    # Høyeste minnebruk (RSS) for prosessen så langt
+    if resource is None:
+        return np.nan
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss/1024**2 # bytes på macOS
+    return maxrss/1024 # kilobytes på Linux
+
+
+def cpu_time():
+    # CPU-tid for prosessen og for avsluttede underprosesser (f.eks. fra
+    # ProcessPoolExecutor)
+    t = os.times()
+    return t.user+t.system+t.children_user+t.children_system
+
+
+class Maaling:
+    # Registrerer veggtid, CPU-tid, høyeste minnebruk (RSS) og antall rader
+    # for hvert steg i behandlingen og analysene:
+    #
+    #     with maaling.steg('Lasting') as steg:
+    #         data = ...
+    #         steg['rader'] = data.shape[0]
+    #
+    # Steg kan ligge inne i hverandre ('nivaa' i rapporten). Med profiler =
+    # 'cprofile' eller 'pyinstrument' profileres hvert steg på øverste nivå,
+    # og resultatet lagres i profil_folder.
+    #
+    # Steg som kjøres i arbeidsprosesser samles med samle() og returneres
+    # til hovedprosessen, som legger dem til med legg_til().
+    def __init__(self,profiler=None,profil_folder='resultater/profiler'):
+        self.profiler = profiler
+        self.profil_folder = profil_folder
+        self.start = time.time()
+        self.records = []
+        self.lock = threading.Lock()
+        self.lokal = threading.local()
+        self.num_profiles = 0
+
+    def nivaa(self):
+        return getattr(self.lokal,'nivaa',0)
+
+    @contextmanager
+    def samle(self):
+        # Stegene i blokken legges i listen records i stedet for i self.records
+        records = []
+        buffer_old = getattr(self.lokal,'buffer',None)
+        self.lokal.buffer = records
+        try:
+            yield records
+        finally:
+            self.lokal.buffer = buffer_old
+
+    def legg_til(self,records):
+        buffer = getattr(self.lokal,'buffer',None)
+        if buffer is not None:
+            buffer.extend(records)
+        else:
+            with self.lock:
+                self.records.extend(records)
+
+    @contextmanager
+    def steg(self,name,rader=None):
+        record = {'steg': name, 'nivaa': self.nivaa(), 'rader': rader, 'pid': os.getpid()}
+        profiler = self.start_profiler() if record['nivaa'] == 0 else None
+        self.lokal.nivaa = record['nivaa']+1
+        record['start_s'] = time.time()-self.start
+        wall_start = time.perf_counter()
+        cpu_start = cpu_time()
+        try:
+            yield record
+        finally:
+            record['veggtid_s'] = time.perf_counter()-wall_start
+            record['cputid_s'] = cpu_time()-cpu_start
+            record['peak_rss_mb'] = peak_memory_mb()
+            self.lokal.nivaa = record['nivaa']
+            if profiler is not None:
+                self.stopp_profiler(profiler,name)
+            self.legg_til([record])
+
+    def start_profiler(self):
+        if self.profiler is None:
+            return None
+        if self.profiler == 'cprofile':
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler
+        if self.profiler == 'pyinstrument':
+            try:
+                import pyinstrument
+            except ImportError:
+                raise Exception("Feil: profiler = 'pyinstrument' krever pakken pyinstrument")
+            profiler = pyinstrument.Profiler()
+            profiler.start()
+            return profiler
+        raise Exception("Feil: profiler må være None, 'cprofile' eller 'pyinstrument'")
+
+    def stopp_profiler(self,profiler,name):
+        os.makedirs(self.profil_folder,exist_ok=True)
+        with self.lock:
+            self.num_profiles += 1
+            file_name = os.path.join(self.profil_folder,'{}_{}_{}'.format(
+                ''.join(c if c.isalnum() else '_' for c in name),os.getpid(),self.num_profiles))
+        if self.profiler == 'cprofile':
+            profiler.disable()
+            profiler.dump_stats(file_name+'.prof')
+        else:
+            profiler.stop()
+            with open(file_name+'.html','w') as f:
+                f.write(profiler.output_html())
+
+    def tabell(self):
+        columns = ['steg','nivaa','rader','start_s','veggtid_s','cputid_s','peak_rss_mb','pid']
+        with self.lock:
+            return pd.DataFrame(self.records,columns=columns).sort_values('start_s',kind='stable').reset_index(drop=True)
+
+    def lagre(self,folder_name,name):
+        # Lagrer rapporten som folder_name/maaling_<name>.json og .csv
+        os.makedirs(folder_name,exist_ok=True)
+        tabell = self.tabell()
+        file_name = os.path.join(folder_name,'maaling_'+name)
+        tabell.to_csv(file_name+'.csv',index=False,sep=';')
+        with open(file_name+'.json','w') as f:
+            json.dump({
+                'tidspunkt': time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(self.start)),
+                'veggtid_s': time.time()-self.start,
+                'peak_rss_mb': peak_memory_mb(),
+                'steg': json.loads(tabell.to_json(orient='records')),
+                },f,indent=1)
+        print(tabell[tabell['nivaa']==0].to_string(index=False))
+        return tabell
+
+
+# Målingene for kjøringen. Skriptene setter maaling.profiler.
+maaling = Maaling()
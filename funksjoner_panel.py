@@ -0,0 +1,184 @@
+import numpy as np
+
+from funksjoner_behandling import lag_suffix
+
+import copy
+import threading
+
+##################################################################
+##  Panelindeks: variabler fra tidligere regnskapsår ved behov
+##################################################################
+def del_lag(name):
+    # 'Salg_prev_prev' -> ('Salg', 2), 'Salg' -> ('Salg', 0)
+    lag = 0
+    while name.endswith(lag_suffix(lag+1)):
+        lag += 1
+    return name[:len(name)-len(lag_suffix(lag))],lag
+
+
+class Panel:
+    # Kompakt, sortert indeks over firma-årene i data_behandlet (før
+    # utvalget i "analysere.py" filtreres), slik at variabler fra et
+    # vilkårlig antall år tilbake i tid kan lages når de brukes, uten å
+    # kjøre "behandle_data_og_lag_variabler.py" på nytt:
+    #
+    #     panel.lag('Salg_prev_prev_prev')   # Salg tre år tilbake i tid
+    #
+    # Indeksen er nøkkelen orgnr*10000+regnaar for hver rad, sortert. Raden
+    # k år tilbake i tid for samme foretak finnes med ett binærsøk per rad, og
+    # hull i tidsserien gir manglende verdi (som i lag_lagget_variabler() i
+    # "funksjoner_behandling.py").
+    #
+    # Variablene fra tidligere år som allerede er lagret i data_behandlet
+    # (se columns_lags i "behandle_data_og_lag_variabler.py") brukes så langt
+    # det går: Salg fra tre år tilbake for 2010 er Salg_prev_prev for 2009.
+    # Slik får også de første regnskapsårene verdier fra årene før
+    # regnaar_min.
+    #
+    # data har kolonnene orgnr og regnaar for alle rader i data_behandlet, og
+    # rader er radnumrene (i data) til radene i analysen (data_all).
+    # Kolonnene som trengs leses med les(columns) første gang de brukes, og
+    # kolonner er alle kolonnene i data_behandlet (se kolonner_behandlet() i
+    # "funksjoner.py").
+    def __init__(self,data,rader=None,les=None,kolonner=None):
+        self.orgnr = data['orgnr'].to_numpy()
+        self.regnaar = data['regnaar'].to_numpy()
+        keys = self.orgnr.astype(np.int64)*10000+self.regnaar.astype(np.int64)
+        self.order = np.argsort(keys,kind='stable')
+        self.keys_sorted = keys[self.order]
+        if np.any(self.keys_sorted[1:]==self.keys_sorted[:-1]):
+            raise Exception("Feil: ikke alle firma-år er unike i Panel")
+        if rader is None:
+            rader = np.arange(len(keys))
+        self.rader = np.asarray(rader)
+        self.keys_alle = keys
+        self.keys = keys[self.rader]
+        self.les = les
+        self.kolonner = list(data.columns) if kolonner is None else list(kolonner)
+        self.posisjoner = {}
+        self.verdier = {}
+        self.lock = threading.Lock()
+
+    def med_rader(self,rader):
+        # Panel med samme indeks og kolonner (som bare leses én gang), for
+        # andre rader i analysen
+        panel = copy.copy(self)
+        panel.rader = np.asarray(rader)
+        panel.keys = self.keys_alle[panel.rader]
+        panel.posisjoner = {}
+        return panel
+
+    def posisjon(self,lag):
+        # Radnummer (i data) til samme foretak lag år tilbake i tid for hver
+        # rad i analysen, -1 om det mangler
+        if lag not in self.posisjoner:
+            if lag == 0:
+                pos = self.rader
+            else:
+                target = self.keys-lag
+                idx = np.minimum(np.searchsorted(self.keys_sorted,target),len(self.keys_sorted)-1)
+                found = self.keys_sorted[idx]==target
+                pos = np.where(found,self.order[idx],-1)
+            self.posisjoner[lag] = pos
+        return self.posisjoner[lag]
+
+    def kolonne(self,name):
+        # Kolonnen name for alle rader i data, lest fra data_behandlet
+        with self.lock:
+            if name not in self.verdier:
+                if self.les is None:
+                    raise Exception("Feil: kan ikke lese kolonnen '{}' i Panel".format(name))
+                data = self.les([name,'orgnr','regnaar'])
+                if not (np.array_equal(data['orgnr'].to_numpy(),self.orgnr) and
+                        np.array_equal(data['regnaar'].to_numpy(),self.regnaar)):
+                    raise Exception("Feil: radene i data_behandlet er endret etter at data ble lest")
+                self.verdier[name] = data[name].to_numpy(dtype=np.float64)
+            return self.verdier[name]
+
+    def lag(self,name):
+        # Verdiene til name (f.eks. 'Salg_prev_prev_prev') for radene i
+        # analysen. Vi bruker først den lagrede kolonnen med flest år tilbake
+        # i tid (høyst lag), hentet fra raden de resterende årene tilbake.
+        # Verdier som mangler (f.eks. fordi foretaket mangler årsregnskap
+        # for året imellom) hentes fra de lagrede kolonnene med færre år.
+        column,lag = del_lag(name)
+        lagret = [l for l in range(lag,-1,-1) if column+lag_suffix(l) in self.kolonner]
+        if len(lagret) == 0:
+            raise Exception("Feil: finner ikke variabelen '{}' i data_behandlet eller variabeldefinisjonene".format(name))
+        result = np.full(len(self.rader),np.nan)
+        for l in lagret:
+            missing = np.flatnonzero(np.isnan(result))
+            if len(missing) == 0:
+                break
+            pos = self.posisjon(lag-l)[missing]
+            found = pos>=0
+            result[missing[found]] = self.kolonne(column+lag_suffix(l))[pos[found]]
+        return result
+
+
+##################################################################
+##  Byggeklosser for variabeldefinisjoner
+##################################################################
+# Funksjoner som lager definisjoner til variabeldefinisjoner i
+# "analysere.py", der k('navn') gir en kolonne i data, en variabel fra
+# tidligere år (f.eks. 'Salg_prev_prev_prev', se Panel) eller en annen
+# definert variabel. For eksempel:
+#
+#     'lnSalgPrev2':    vekst('Salg',2),
+#     'DlnSalgPrev2':   ved_nedgang('lnSalgPrev2','lnSalg'),
+#     'I_prev2_lnSalg': produkt('I_prev2','lnSalg'),
+def log_forhold(teller,nevner):
+    # ln(teller/nevner)
+    return lambda k: np.log(k(teller)/k(nevner))
+
+
+def vekst(column,lag=0):
+    # Logaritmisk vekst fra året lag+1 til året lag år tilbake i tid,
+    # f.eks. vekst('Salg') = ln(Salg/Salg_prev)
+    return log_forhold(column+lag_suffix(lag),column+lag_suffix(lag+1))
+
+
+def nedgang(name):
+    # Dummy for negativ verdi (f.eks. nedgang i salget)
+    return lambda k: k(name)<0
+
+
+def oppgang(name):
+    # Dummy for positiv verdi (f.eks. økning i salget)
+    return lambda k: k(name)>0
+
+
+def ved_nedgang(name,verdi=None):
+    # verdi (eller name) når name er negativ, ellers 0
+    if verdi is None:
+        verdi = name
+    return lambda k: (k(name)<0)*k(verdi)
+
+
+def produkt(*names):
+    # Interaksjon mellom variablene i names
+    def fun(k):
+        result = k(names[0])
+        for name in names[1:]:
+            result = result*k(name)
+        return result
+    return fun
+
+
+def terskelklasse(values,terskler):
+    # Den største terskelen i terskler som verdien er større enn (-inf om
+    # ingen, eller om verdien mangler). For hver terskel t i terskler er
+    # values > t da det samme som terskelklasse(values,terskler) >= t, slik
+    # at et utvalg med en av tersklene er en union av celler (se
+    # delutvalg i "analysere.py").
+    values = np.asarray(values,dtype=np.float64)
+    terskler = np.sort(np.asarray(terskler,dtype=np.float64))
+    klasse = np.r_[-np.inf,terskler][np.searchsorted(terskler,values,side='left')]
+    klasse[np.isnan(values)] = -np.inf
+    return klasse
+
+
+def terskel(column,terskler):
+    # Den største terskelen i terskler som column er større enn (se
+    # terskelklasse()), f.eks. for delutvalg etter lønnskostnader
+    return lambda k: terskelklasse(k(column),terskler)
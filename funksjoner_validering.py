@@ -0,0 +1,218 @@
+import numpy as np
+import pandas as pd
+
+import os
+import json
+import threading
+from contextlib import contextmanager
+
+##################################################################
+##  Innstillinger for sjekkene
+##################################################################
+# Regnskapstallene som sjekkes etter at variablene er laget og deflatert
+kolonner_verdisjekk = [
+    'Salg',
+    'Driftskostnader',
+    'Varekostnader',
+]
+
+# Kolonnene blant kolonner_verdisjekk som normalt ikke er negative.
+# Negative verdier gir en advarsel, siden analysene uansett kun bruker
+# positive verdier (se sample_selection() i "funksjoner.py").
+kolonner_ikke_negative = [
+    'Salg',
+    'Driftskostnader',
+]
+
+# Største tillatte absoluttverdi for regnskapstallene (i kroner). Større
+# verdier tyder på feil enhet i årsfilen og gir feil.
+maks_belop = 1e13
+
+# Antall eksempler (f.eks. orgnr) som tas med for hver sjekk
+antall_eksempler = 5
+
+##################################################################
+##  Vektoriserte sjekker
+##################################################################
+# Hver sjekk returnerer en liste med resultater på formen
+# {'sjekk': navn, 'antall': antall rader som feiler, 'alvorlig': True/False,
+#  'eksempler': [...]}. Alvorlige sjekker stopper kjøringen (se
+# Validering.valider() under), de andre gir kun en advarsel.
+def resultat(name,mask,alvorlig,eksempler=None):
+    mask = np.asarray(mask,dtype=bool)
+    if eksempler is None:
+        eksempler = np.flatnonzero(mask)
+    else:
+        eksempler = np.asarray(eksempler)[mask]
+    return {
+        'sjekk': name,
+        'antall': int(np.sum(mask)),
+        'alvorlig': alvorlig,
+        'eksempler': [e.item() if hasattr(e,'item') else e for e in pd.unique(eksempler)[:antall_eksempler]],
+        }
+
+
+def duplikater(keys):
+    # Maske for rader med samme nøkkel som en annen rad, bortsett fra den
+    # første. keys er en liste med arrays, f.eks. [orgnr, regnaar]. Radene
+    # sorteres på nøklene, og like nøkler ligger da etter hverandre.
+    keys = [np.asarray(k) for k in keys]
+    order = np.lexsort(keys[::-1])
+    same = np.ones(max(len(order)-1,0),dtype=bool)
+    for k in keys:
+        k_sorted = k[order]
+        same &= k_sorted[1:]==k_sorted[:-1]
+    mask = np.zeros(len(order),dtype=bool)
+    mask[order[1:][same]] = True
+    return mask
+
+
+def mangler_i_serie(serie,keys):
+    # Maske for nøkler som ikke finnes i serien (f.eks. KPI eller BNP),
+    # eller der verdien i serien mangler. keys er én array, eller en liste
+    # med arrays dersom serien har MultiIndex.
+    if isinstance(keys,list):
+        keys = pd.MultiIndex.from_arrays(keys)
+    pos = serie.index.get_indexer(keys)
+    mask = pos<0
+    mask[~mask] = pd.isnull(serie.to_numpy()[pos[~mask]])
+    return mask
+
+
+def sjekk_unike(data,columns=('orgnr','regnaar')):
+    # Alle firma-år skal være unike
+    mask = duplikater([data[c].to_numpy() for c in columns])
+    return [resultat('Duplikate firma-år',mask,True,data[columns[0]].to_numpy())]
+
+
+def sjekk_avslutningsdato(data,CPI_data=None):
+    # Avslutningsdatoen må finnes og ha formen 'YYYY-MM-DD', og måneden må
+    # finnes i KPI (se deflater() i "funksjoner_behandling.py"). Sjekkene
+    # gjøres på de unike datoene.
+    codes,uniques = pd.factorize(data['avslutningsdato'])
+    maaned = pd.to_numeric(pd.Series(uniques,dtype=object).astype(str).str.slice(0,7).str.replace('-','',regex=False),
+        errors='coerce').to_numpy()
+    finnes = codes>=0
+    ugyldig = np.append(np.isnan(maaned),False)[codes] & finnes
+    orgnr = data['orgnr'].to_numpy()
+    resultater = [
+        resultat('Mangler avslutningsdato',~finnes,True,orgnr),
+        resultat('Ugyldig avslutningsdato',ugyldig,True,np.append(uniques,None)[codes]),
+        ]
+    gyldig = np.append(~np.isnan(maaned),False)[codes]
+    maaned_rader = np.append(np.nan_to_num(maaned),0).astype(np.int64)[codes]
+    if CPI_data is not None:
+        uten_kpi = np.append(mangler_i_serie(CPI_data,np.nan_to_num(maaned).astype(np.int64)),False)[codes] & gyldig
+        resultater.append(resultat('Avslutningsdato uten KPI',uten_kpi,True,maaned_rader))
+    annet_aar = gyldig & (maaned_rader//100 != data['regnaar'].to_numpy())
+    resultater.append(resultat('Avslutningsdato i et annet år enn regnaar',annet_aar,False,orgnr))
+    return resultater
+
+
+def sjekk_belop(data,columns=kolonner_verdisjekk):
+    # Regnskapstallene må være endelige og mindre enn maks_belop i
+    # absoluttverdi. Negative verdier i kolonner_ikke_negative gir en advarsel.
+    orgnr = data['orgnr'].to_numpy()
+    resultater = []
+    for c in columns:
+        values = data[c].to_numpy(dtype=np.float64)
+        endelig = np.isfinite(values)
+        resultater.append(resultat('Ikke-endelig verdi for {}'.format(c),~endelig,True,orgnr))
+        resultater.append(resultat('{} større enn {:,.0f} i absoluttverdi'.format(c,maks_belop).replace(',',' '),
+            endelig & (np.abs(values)>maks_belop),True,orgnr))
+        if c in kolonner_ikke_negative:
+            resultater.append(resultat('Negativ verdi for {}'.format(c),values<0,False,orgnr))
+    return resultater
+
+
+def sjekk_makroserier(data,makroserier,ind=None):
+    # Alle rader (i ind) må ha verdier i makroseriene, se koble_makroserier()
+    # i "funksjoner_behandling.py"
+    if ind is None:
+        ind = np.ones(data.shape[0],dtype=bool)
+    ind = np.asarray(ind)
+    resultater = []
+    for name,(serie,key_columns,offset) in makroserier.items():
+        if isinstance(key_columns,list):
+            keys = [data[c].to_numpy()[ind] for c in key_columns]
+            keys[-1] = keys[-1]+offset
+            eksempler = keys[-1]
+        else:
+            keys = data[key_columns].to_numpy()[ind]+offset
+            eksempler = keys
+        resultater.append(resultat('Mangler {}'.format(name),mangler_i_serie(serie,keys),True,eksempler))
+    return resultater
+
+
+##################################################################
+##  Rapport over sjekkene
+##################################################################
+def antall_rader(number):
+    return '{:,.0f}'.format(number).replace(',',' ')
+
+
+class Validering:
+    # Samler resultatene av sjekkene for hvert steg i behandlingen og
+    # analysene, og stopper kjøringen dersom en alvorlig sjekk feiler:
+    #
+    #     validering.valider('Årsfil 2019.csv',sjekk_unike(data)+sjekk_belop(data))
+    #
+    # Som for Maaling i "funksjoner_maaling.py" samles resultatene fra
+    # arbeidsprosesser med samle() og legges til i hovedprosessen med
+    # legg_til().
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+        self.lokal = threading.local()
+
+    @contextmanager
+    def samle(self):
+        records = []
+        buffer_old = getattr(self.lokal,'buffer',None)
+        self.lokal.buffer = records
+        try:
+            yield records
+        finally:
+            self.lokal.buffer = buffer_old
+
+    def legg_til(self,records):
+        buffer = getattr(self.lokal,'buffer',None)
+        if buffer is not None:
+            buffer.extend(records)
+        else:
+            with self.lock:
+                self.records.extend(records)
+
+    def valider(self,steg,resultater,rader=None):
+        # Registrerer resultatene, skriver ut sjekkene som feiler og stopper
+        # med en feilmelding (med antall rader per sjekk) dersom noen av de
+        # alvorlige sjekkene feiler
+        records = [{'steg': steg, 'rader': rader, **r} for r in resultater]
+        self.legg_til(records)
+        for r in records:
+            if r['antall'] > 0:
+                print('Validering ({}): {} - {} rader, f.eks. {}{}'.format(
+                    steg,r['sjekk'],antall_rader(r['antall']),r['eksempler'],'' if r['alvorlig'] else ' (advarsel)'))
+        feil = [r for r in records if r['alvorlig'] and (r['antall'] > 0)]
+        if len(feil) > 0:
+            raise Exception("Feil: datavalidering feilet for {}: {}".format(steg,'; '.join(
+                '{} ({} rader, f.eks. {})'.format(r['sjekk'],antall_rader(r['antall']),r['eksempler']) for r in feil)))
+
+    def tabell(self):
+        columns = ['steg','sjekk','rader','antall','alvorlig','eksempler']
+        with self.lock:
+            return pd.DataFrame(self.records,columns=columns)
+
+    def lagre(self,folder_name,name):
+        # Lagrer rapporten som folder_name/validering_<name>.json og .csv
+        os.makedirs(folder_name,exist_ok=True)
+        tabell = self.tabell()
+        file_name = os.path.join(folder_name,'validering_'+name)
+        tabell.to_csv(file_name+'.csv',index=False,sep=';')
+        with open(file_name+'.json','w') as f:
+            json.dump(json.loads(tabell.to_json(orient='records')),f,indent=1)
+        return tabell
+
+
+# Resultatene av sjekkene for kjøringen
+validering = Validering()
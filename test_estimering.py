@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+
+from funksjoner_estimering import ols_absorb, uten_singletons, antall_fe_parametere, faktoriser, cluster_cov
+
+# Tester av ols_absorb() mot OLS med dummyvariabler. Standardfeilene følger
+# konvensjonen i Statas reghdfe: K i småutvalgskorreksjonen
+# G/(G-1) * (N-1)/(N-K) teller ikke faste effekter som er nøstet i
+# klyngeinndelingen, og trekker fra sammenhengende komponenter utover én
+# for de to første faste effektene. Referansen beregnes direkte fra
+# designet med dummyvariabler, med K satt etter denne regelen.
+#
+# Kjøres med 'python -m pytest test_estimering.py' eller
+# 'python test_estimering.py'.
+
+def lag_data(seed=0,num_firms=40,years=range(2010,2016)):
+    rng = np.random.default_rng(seed)
+    orgnr,regnaar = [a.ravel() for a in np.meshgrid(np.arange(num_firms),np.array(years),indexing='ij')]
+    keep = rng.random(len(orgnr)) > 0.2
+    orgnr,regnaar = orgnr[keep],regnaar[keep]
+    # Et foretak med kun én observasjon (singleton)
+    orgnr = np.r_[orgnr,num_firms]
+    regnaar = np.r_[regnaar,years[0]]
+    x = rng.normal(size=len(orgnr))
+    y = 0.5*x + rng.normal(size=num_firms+1)[orgnr] + 0.1*(regnaar-years[0]) + rng.normal(size=len(orgnr))
+    return pd.DataFrame({'orgnr': orgnr,'regnaar': regnaar,'x': x,'y': y})
+
+
+def dummy_design(data,fixed_effects):
+    # [1, x, dummyvariabler] der første nivå av hver fast effekt utelates
+    columns = [np.ones(len(data)),data['x'].to_numpy()]
+    for fe in fixed_effects:
+        codes,num_levels = faktoriser(data[fe].to_numpy())
+        columns += [(codes==level).astype(float) for level in range(1,num_levels)]
+    return np.column_stack(columns)
+
+
+def crv1(design,resid,clusters,k_params):
+    bread = np.linalg.pinv(design.T @ design)
+    scores = pd.DataFrame(design*resid[:,None]).groupby(clusters).sum().to_numpy()
+    nobs,num_groups = len(resid),len(np.unique(clusters))
+    cov = bread @ scores.T @ scores @ bread
+    return cov*(num_groups/(num_groups-1.0))*((nobs-1.0)/(nobs-k_params))
+
+
+def referanse(data,fixed_effects):
+    design = dummy_design(data,fixed_effects)
+    params = np.linalg.lstsq(design,data['y'].to_numpy(),rcond=None)[0]
+    resid = data['y'].to_numpy() - design @ params
+    return design,params,resid
+
+
+def test_foretak_nostet_i_klynge():
+    # Faste effekter for foretak og år, klynget på orgnr: foretakene er
+    # nøstet i klyngene og telles ikke med i K
+    data = lag_data()
+    model = ols_absorb(data['y'],data[['x']],[data['orgnr'],data['regnaar']],data['orgnr'],fjern_singletons=True)
+
+    # Singleton-foretaket er fjernet
+    data = data[data['orgnr'].duplicated(keep=False)].reset_index(drop=True)
+    assert model.nobs == len(data)
+    assert model.num_singletons == 1
+
+    design,params,resid = referanse(data,['orgnr','regnaar'])
+    assert np.allclose(model.params['x'],params[1],atol=1e-10)
+    assert np.isclose(model.rsquared,1-resid@resid/np.sum((data['y']-data['y'].mean())**2))
+
+    num_years = data['regnaar'].nunique()
+    k_reghdfe = 2 + (num_years-1)
+    assert model.k_params == k_reghdfe
+    se_reghdfe = np.sqrt(crv1(design,resid,data['orgnr'].to_numpy(),k_reghdfe)[1,1])
+    assert np.isclose(model.bse['x'],se_reghdfe,rtol=1e-8)
+
+    # Med alle dummyvariablene i K (som statsmodels) blir standardfeilen større
+    se_alle = np.sqrt(crv1(design,resid,data['orgnr'].to_numpy(),design.shape[1])[1,1])
+    assert se_alle > model.bse['x']*1.01
+
+
+def test_to_komponenter():
+    # Foretakene i to grupper som er observert i hver sin periode: grafen
+    # mellom foretak og år har to komponenter, og én parameter til er
+    # redundant. Klynging på observasjon, slik at ingen faste effekter er
+    # nøstet. K er da rangen til designet med dummyvariabler.
+    data_a = lag_data(1,20,range(2010,2013))
+    data_b = lag_data(2,20,range(2013,2016))
+    data_b['orgnr'] += 100
+    data = pd.concat([data_a,data_b],ignore_index=True)
+    clusters = np.arange(len(data))
+    model = ols_absorb(data['y'],data[['x']],[data['orgnr'],data['regnaar']],clusters)
+
+    design,params,resid = referanse(data,['orgnr','regnaar'])
+    k_rang = np.linalg.matrix_rank(design)
+    assert model.k_params == k_rang
+    fe_codes = [faktoriser(data['orgnr'].to_numpy()),faktoriser(data['regnaar'].to_numpy())]
+    assert antall_fe_parametere(fe_codes) == (fe_codes[0][1]-1)+(fe_codes[1][1]-1)-1
+    assert np.allclose(model.params['x'],params[1],atol=1e-10)
+    assert np.isclose(model.bse['x'],np.sqrt(crv1(design,resid,clusters,k_rang)[1,1]),rtol=1e-8)
+
+
+def test_singletons_gjentas():
+    # Foretak 2 er singleton; når den fjernes, blir år 2012 en singleton
+    orgnr = np.array([0,0,1,1,2])
+    regnaar = np.array([2010,2011,2010,2011,2012])
+    keep = uten_singletons([faktoriser(orgnr),faktoriser(regnaar)])
+    assert list(keep) == [True,True,True,True,False]
+    orgnr = np.array([0,0,1,1,2,2])
+    regnaar = np.array([2010,2011,2010,2011,2011,2012])
+    keep = uten_singletons([faktoriser(orgnr),faktoriser(regnaar)])
+    assert list(keep) == [True,True,True,True,False,False]
+
+
+def test_toveis_positiv_semidefinit():
+    # V1 + V2 - V12 har her en negativ varians; de negative egenverdiene
+    # settes til 0, slik at standardfeilene er definert
+    foretak = np.repeat(np.arange(10),4)
+    aar = np.tile(np.arange(4),10)
+    bread = np.eye(2)
+    def toveis(scores):
+        return cluster_cov(scores,bread,foretak,2) + cluster_cov(scores,bread,aar,2) - cluster_cov(scores,bread,foretak*4+aar,2)
+
+    scores = np.random.default_rng(2).normal(size=(40,2))
+    V = toveis(scores)
+    assert np.diag(V).min() < 0
+    eigenvalues,eigenvectors = np.linalg.eigh(V)
+    cov = cluster_cov(scores,bread,foretak,2,aar)
+    assert np.allclose(cov,(eigenvectors*np.maximum(eigenvalues,0)) @ eigenvectors.T)
+    assert np.all(np.diag(cov) >= 0)
+
+    # Uendret når V1 + V2 - V12 er positiv semidefinit
+    scores = np.random.default_rng(0).normal(size=(40,2))
+    V = toveis(scores)
+    assert np.linalg.eigvalsh(V).min() > 0
+    assert np.array_equal(cluster_cov(scores,bread,foretak,2,aar),V)
+
+
+if __name__ == '__main__':
+    for name,test in list(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(name,'OK')